@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Checkpointed chain storage for THEMCMC
+
+@author: Tom Williams
+
+v1.00.
+"""
+
+#Ensure python3 compatibility
+from __future__ import absolute_import, print_function, division
+
+import numpy as np
+import pandas as pd
+import os
+
+from emcee.backends import Backend
+from tables import HDF5ExtError
+
+class CheckpointBackend(Backend):
+
+    #Keeps the chain in memory like the default emcee backend, but every
+    #checkpoint_interval steps appends the new steps to an HDF5 file. A
+    #restarted fit can then pick up from the last checkpoint. The sampler
+    #deletes the file once the samples are written out
+
+    def __init__(self,
+                 filename,
+                 checkpoint_interval=50):
+
+        super(CheckpointBackend,self).__init__()
+
+        self.filename = filename
+        self.checkpoint_interval = checkpoint_interval
+        self.saved_iteration = 0
+        self.complete = False
+        self.converged = False
+
+    def load(self,
+             nwalkers,
+             ndim):
+
+        #Start from an empty chain, then fill in whatever has already been
+        #checkpointed (if it matches this run)
+
+        self.reset(nwalkers,ndim)
+        self.saved_iteration = 0
+        self.complete = False
+        self.converged = False
+
+        if not os.path.exists(self.filename):
+            return
+
+        try:
+
+            status_df = pd.read_hdf(self.filename,'status')
+            chain_df = pd.read_hdf(self.filename,'chain')
+            accepted_df = pd.read_hdf(self.filename,'accepted')
+
+            iteration = int(status_df['iteration'][0])
+
+            #Anything past the recorded iteration is from an interrupted
+            #write. Take it out of the file as well, or the steps appended
+            #once we carry on would sit alongside it
+
+            if np.any(chain_df['step'] >= iteration):
+
+                with pd.HDFStore(self.filename) as store:
+                    store.remove('chain',where='step >= %d' % iteration)
+
+                chain_df = chain_df[chain_df['step'] < iteration]
+
+        except (KeyError,IOError,ValueError,RuntimeError,HDF5ExtError):
+
+            #Nothing usable has been written out yet, or the file's been
+            #corrupted
+
+            os.remove(self.filename)
+            return
+
+        chain_df = chain_df.sort_values(['step','walker'])
+
+        theta_cols = ['theta_'+str(i) for i in range(ndim)]
+        saved_theta_cols = [col for col in chain_df.columns if col.startswith('theta_')]
+
+        if len(chain_df) != iteration*nwalkers or \
+            sorted(saved_theta_cols) != sorted(theta_cols) or \
+            len(accepted_df) != nwalkers:
+
+            #Doesn't match this run, so start again
+
+            os.remove(self.filename)
+            return
+
+        self.chain = chain_df[theta_cols].values.reshape(iteration,nwalkers,ndim)
+        self.log_prob = chain_df['log_prob'].values.reshape(iteration,nwalkers)
+        self.accepted = accepted_df['accepted'].values.astype(self.dtype)
+        self.iteration = iteration
+
+        self.saved_iteration = iteration
+        self.complete = bool(status_df['complete'][0])
+
+        if 'converged' in status_df.columns:
+            self.converged = bool(status_df['converged'][0])
+
+    def save_step(self,
+                  state,
+                  accepted):
+
+        super(CheckpointBackend,self).save_step(state,accepted)
+
+        if self.iteration-self.saved_iteration >= self.checkpoint_interval:
+            self.flush()
+
+    def flush(self,
+              complete=False,
+              converged=False):
+
+        #Append any steps we haven't saved yet, then update the status. The
+        #status goes last, so an interrupted write is ignored on reload.
+        #Whether an adaptive run converged is kept with it, since a resumed
+        #run that's already complete can't redo the check (that needs the
+        #change in tau between checks)
+
+        steps = np.arange(self.saved_iteration,self.iteration)
+
+        chain = self.chain[self.saved_iteration:self.iteration]
+
+        chain_dict = {'step':np.repeat(steps,self.nwalkers),
+                      'walker':np.tile(np.arange(self.nwalkers),len(steps))}
+
+        for i in range(self.ndim):
+            chain_dict['theta_'+str(i)] = chain[:,:,i].flatten()
+
+        chain_dict['log_prob'] = self.log_prob[self.saved_iteration:self.iteration].flatten()
+
+        with pd.HDFStore(self.filename) as store:
+
+            if len(steps) > 0:
+                store.append('chain',pd.DataFrame(chain_dict),format='table',
+                             data_columns=['step'])
+
+            store.put('accepted',pd.DataFrame({'accepted':self.accepted}))
+            store.put('status',pd.DataFrame({'iteration':[self.iteration],
+                                             'complete':[complete],
+                                             'converged':[converged]}))
+
+        self.saved_iteration = self.iteration
+        self.complete = complete
+        self.converged = converged
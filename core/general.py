@@ -12,8 +12,15 @@ from __future__ import absolute_import, print_function, division
 
 import numpy as np
 import pandas as pd
+import json
+import os
 
 from scipy.constants import h,k,c
+from scipy.linalg import cholesky,solve_triangular
+
+#Grain types in the THEMIS model grid
+
+grain_types = ['sCM20','lCM20','aSilM5']
 
 def convert_to_luminosity(flux,
                           distance,
@@ -37,23 +44,844 @@ def convert_to_luminosity(flux,
 
 def read_sed(isrf,
              alpha,
-             sCM20_df,
-             lCM20_df,
-             aSilM5_df):
+             model_grid,
+             interpolate=False):
     
     #Read in the SED that corresponds to this
     #combination of ISRF strength and alpha 
-    #(rounded to nearest 0.01)
+    #(rounded to nearest grid point). These are
+    #views into the grid, so don't modify them!
     
-    if '%.2f' % isrf in ['-0.00']:
-        isrf = np.abs(isrf)
-
-    small_grains = sCM20_df['alpha_sCM20:%.2f,logU:%.2f' % (alpha,isrf)].values.copy()
-    large_grains = lCM20_df['alpha_sCM20:%.2f,logU:%.2f' % (alpha,isrf)].values.copy()
-    silicates = aSilM5_df['alpha_sCM20:%.2f,logU:%.2f' % (alpha,isrf)].values.copy()
+    if interpolate:
+        
+        #Compressed grids are linear in the coefficients, so interpolate
+        #those and then rebuild the spectrum
+        
+        return tuple(model_spectra(interpolate_grid(grain_grid(model_grid,grain_type),
+                                                    alpha,
+                                                    isrf,
+                                                    model_grid['alpha'],
+                                                    model_grid['logU']),
+                                   model_grid,
+                                   grain_type) for grain_type in grain_types)
+    
+    idx_alpha = grid_index(alpha,model_grid['alpha'])
+    idx_isrf = grid_index(isrf,model_grid['logU'])
+    
+    small_grains,\
+        large_grains,\
+        silicates = [model_spectra(grain_grid(model_grid,grain_type)[idx_alpha,idx_isrf],
+                                   model_grid,
+                                   grain_type) for grain_type in grain_types]
     
     return small_grains,large_grains,silicates
 
+def is_compressed(model_grid):
+    
+    return grain_types[0]+'_basis' in model_grid
+
+def grain_grid(model_grid,
+               grain_type):
+    
+    #The (n_alpha x n_logU x ...) grid for this grain type. For a compressed
+    #grid this holds the coefficients of the basis spectra, otherwise the
+    #spectra themselves
+    
+    if is_compressed(model_grid):
+        return model_grid[grain_type+'_coefficients']
+    
+    return model_grid[grain_type]
+
+def model_spectra(grid_values,
+                  model_grid,
+                  grain_type):
+    
+    #Turn values taken from grain_grid back into spectra
+    
+    if is_compressed(model_grid):
+        return np.dot(grid_values,model_grid[grain_type+'_basis'])
+    
+    return grid_values
+
+def read_filters(filter_names):
+    
+    #Create a dictionary of the filters, with wavelength in micron and
+    #transmission normalised to a peak of 1
+    
+    filter_dict = {}
+    
+    for filter_name in filter_names:
+        
+        filter_wavelength,transmission = np.loadtxt('../filters/'+filter_name+'.dat',
+                                         unpack=True)
+        
+        filter_wavelength /= 1e4
+        transmission /= np.max(transmission)
+        
+        filter_dict[filter_name] = filter_wavelength,transmission
+        
+    return filter_dict
+
+def filter_response(wavelength,
+                    filter_dict,
+                    keys):
+    
+    #Since the filter convolution (linear interpolation onto the filter
+    #wavelengths, then trapezium integration normalised by the filter
+    #area) is linear in the SED, fold it into a single (n_filters x
+    #n_wavelength) matrix. Band fluxes are then response.dot(flux)
+    
+    response = np.zeros([len(keys),len(wavelength)])
+    
+    for i,key in enumerate(keys):
+        
+        filter_wavelength,transmission = filter_dict[key]
+        
+        #Trapezium weights for the filter wavelength sampling
+        
+        dx = np.diff(filter_wavelength)
+        
+        trapz_weights = np.zeros(len(filter_wavelength))
+        trapz_weights[:-1] += dx/2
+        trapz_weights[1:] += dx/2
+        
+        weights = transmission*trapz_weights
+        weights /= np.sum(weights)
+        
+        #Linear interpolation weights. Clip so that, like np.interp,
+        #anything off the end of the SED takes the edge value
+        
+        idx = np.searchsorted(wavelength,filter_wavelength)
+        idx = np.clip(idx,1,len(wavelength)-1)
+        
+        frac = (filter_wavelength-wavelength[idx-1])/(wavelength[idx]-wavelength[idx-1])
+        frac = np.clip(frac,0,1)
+        
+        np.add.at(response[i],idx-1,weights*(1-frac))
+        np.add.at(response[i],idx,weights*frac)
+    
+    return response
+
+def grid_axes(model_df):
+    
+    #Pull the alpha_sCM20 and logU axes out of the model grid column
+    #names, which look like 'alpha_sCM20:5.00,logU:0.00'
+    
+    alpha = []
+    isrf = []
+    
+    for col_name in model_df.columns:
+        
+        alpha_name,isrf_name = col_name.split(',')
+        
+        alpha.append(float(alpha_name.split(':')[1]))
+        isrf.append(float(isrf_name.split(':')[1]))
+    
+    alpha = np.array(alpha)
+    isrf = np.array(isrf)
+    
+    return alpha,isrf
+
+def grid_index(value,
+               axis):
+    
+    #Map a parameter onto the nearest point of a regularly spaced grid axis
+    
+    return np.rint( (value-axis[0])/(axis[1]-axis[0]) ).astype(int)
+
+def grid_weights(value,
+                 axis):
+    
+    #Index of the grid point below each value, and the fractional distance
+    #to the next one. Values off the ends of the axis take the edge value
+    
+    position = np.clip( (value-axis[0])/(axis[1]-axis[0]),0,len(axis)-1)
+    
+    idx = np.minimum(np.floor(position).astype(int),len(axis)-2)
+    
+    return idx,position-idx
+
+def interpolate_grid(grid,
+                     alpha,
+                     isrf,
+                     alpha_axis,
+                     isrf_axis):
+    
+    #Bilinearly interpolate an (n_alpha x n_logU x ...) grid to the given
+    #alpha_sCM20 and logU. These can be scalars or arrays, in which case the
+    #result has an extra leading axis
+    
+    idx_alpha,frac_alpha = grid_weights(alpha,alpha_axis)
+    idx_isrf,frac_isrf = grid_weights(isrf,isrf_axis)
+    
+    #Broadcast the weights against the trailing (e.g. wavelength) axes
+    
+    trailing = (1,)*(np.ndim(grid)-2)
+    
+    frac_alpha = np.reshape(frac_alpha,np.shape(frac_alpha)+trailing)
+    frac_isrf = np.reshape(frac_isrf,np.shape(frac_isrf)+trailing)
+    
+    return (1-frac_alpha)*(1-frac_isrf)*grid[idx_alpha,idx_isrf]+\
+           (1-frac_alpha)*frac_isrf*grid[idx_alpha,idx_isrf+1]+\
+           frac_alpha*(1-frac_isrf)*grid[idx_alpha+1,idx_isrf]+\
+           frac_alpha*frac_isrf*grid[idx_alpha+1,idx_isrf+1]
+
+def interpolation_error(model_grid,
+                        alpha_stride,
+                        isrf_stride,
+                        response=None):
+    
+    #Measure how well a grid keeping only every alpha_stride-th alpha_sCM20
+    #and isrf_stride-th logU reproduces the full grid, interpolating at every
+    #full grid point. Errors are fractional, relative to the peak of each
+    #model. If a filter response matrix is given, compare band fluxes
+    #rather than spectra
+    
+    alpha_axis = model_grid['alpha'][::alpha_stride]
+    isrf_axis = model_grid['logU'][::isrf_stride]
+    
+    errors = {}
+    
+    for grain_type in grain_types:
+        
+        grid = grain_grid(model_grid,grain_type)
+        
+        coarse_grid = np.array(grid[::alpha_stride,::isrf_stride])
+        
+        grain_errors = []
+        
+        #Go a row of alpha_sCM20 at a time to keep the memory down
+        
+        for i,alpha in enumerate(model_grid['alpha']):
+            
+            interpolated = model_spectra(interpolate_grid(coarse_grid,
+                                                          np.full(len(model_grid['logU']),alpha),
+                                                          model_grid['logU'],
+                                                          alpha_axis,
+                                                          isrf_axis),
+                                         model_grid,
+                                         grain_type)
+            
+            spectra = model_spectra(grid[i],
+                                    model_grid,
+                                    grain_type)
+            
+            if response is not None:
+                
+                interpolated = interpolated.dot(response.T)
+                spectra = spectra.dot(response.T)
+            
+            peak = np.max(np.abs(spectra),axis=-1)
+            peak[peak == 0] = 1
+            
+            grain_errors.append(np.max(np.abs(interpolated-spectra),axis=-1)/peak)
+            
+        errors[grain_type] = np.array(grain_errors)
+        
+    return errors
+
+def coarsen_model_grid(model_grid,
+                       grid_dir,
+                       alpha_stride,
+                       isrf_stride):
+    
+    #Write out a copy of the model grid keeping only every alpha_stride-th
+    #alpha_sCM20 and isrf_stride-th logU, to be used with interpolation.
+    #The strides need to keep the ends of the axes
+    
+    if (len(model_grid['alpha'])-1) % alpha_stride != 0 or \
+        (len(model_grid['logU'])-1) % isrf_stride != 0:
+        raise Exception('Grid strides must divide the axes exactly')
+        
+    subset_model_grid(model_grid,
+                      grid_dir,
+                      np.arange(0,len(model_grid['alpha']),alpha_stride),
+                      np.arange(0,len(model_grid['logU']),isrf_stride),
+                      np.arange(len(model_grid['wavelength'])))
+    
+def wavelength_support(wavelength,
+                       filter_dict,
+                       keys,
+                       z_min,
+                       z_max):
+    
+    #Find the SED wavelength samples needed to interpolate onto the filter
+    #curves, for any redshift between z_min and z_max. That's everything
+    #the (rest-frame) filter curves cover, plus the samples either side
+    
+    needed = np.zeros(len(wavelength),dtype=bool)
+    
+    for key in keys:
+        
+        filter_wavelength,_ = filter_dict[key]
+        
+        idx_min = np.searchsorted(wavelength,np.min(filter_wavelength)/(1+z_max))-1
+        idx_max = np.searchsorted(wavelength,np.max(filter_wavelength)/(1+z_min))+1
+        
+        needed[np.max([idx_min,0]):np.min([idx_max,len(wavelength)])] = True
+        
+    return np.where(needed)[0]
+
+def grid_identity(model_grid):
+    
+    #Enough about a model grid to tell if it's been changed: its axes, the
+    #shape of every array and, for memory-mapped arrays, the size and
+    #modification time of the file behind them
+    
+    identity = {'alpha':[float(alpha) for alpha in model_grid['alpha']],
+                'logU':[float(isrf) for isrf in model_grid['logU']],
+                'arrays':{}}
+    
+    for name in sorted(model_grid):
+        
+        array_identity = {'shape':list(np.shape(model_grid[name]))}
+        
+        filename = getattr(model_grid[name],'filename',None)
+        
+        if filename is not None:
+            
+            stat = os.stat(filename)
+            
+            array_identity.update({'file':os.path.abspath(filename),
+                                   'size':stat.st_size,
+                                   'mtime':stat.st_mtime_ns})
+            
+        identity['arrays'][name] = array_identity
+        
+    return identity
+
+def prune_model_grid(model_grid,
+                     grid_dir,
+                     filter_dict,
+                     keys,
+                     z_min,
+                     z_max):
+    
+    #Memory-map a copy of the model grid holding only the wavelengths needed
+    #for these filters over this redshift range, writing it out first if
+    #there isn't already one matching (for the same source grid)
+    
+    pruning = {'filters':sorted(keys),
+               'z_min':float(z_min),
+               'z_max':float(z_max),
+               'source':grid_identity(model_grid)}
+    
+    if os.path.exists(os.path.join(grid_dir,'header.json')):
+        
+        if read_grid_header(grid_dir).get('pruning') == pruning:
+            return read_model_grid(grid_dir)
+        
+    wavelength_idx = wavelength_support(model_grid['wavelength'],
+                                        filter_dict,
+                                        keys,
+                                        z_min,
+                                        z_max)
+    
+    subset_model_grid(model_grid,
+                      grid_dir,
+                      np.arange(len(model_grid['alpha'])),
+                      np.arange(len(model_grid['logU'])),
+                      wavelength_idx,
+                      header_info={'pruning':pruning})
+    
+    return read_model_grid(grid_dir)
+    
+def subset_model_grid(model_grid,
+                      grid_dir,
+                      alpha_idx,
+                      isrf_idx,
+                      wavelength_idx,
+                      header_info=None):
+    
+    #Write out the part of the model grid at these alpha_sCM20, logU and
+    #wavelength indices as a new binary grid. header_info is any extra
+    #information to keep in the header
+    
+    if header_info is None:
+        header_info = {}
+    
+    arrays = {'wavelength':np.array(model_grid['wavelength'])[wavelength_idx],
+              'alpha':np.array(model_grid['alpha'])[alpha_idx],
+              'logU':np.array(model_grid['logU'])[isrf_idx]}
+    
+    shape = [len(arrays['alpha']),
+             len(arrays['logU']),
+             len(arrays['wavelength'])]
+    
+    #For a compressed grid, the basis spectra carry the wavelengths and the
+    #coefficients carry alpha_sCM20 and logU
+    
+    if is_compressed(model_grid):
+        
+        for grain_type in grain_types:
+            
+            arrays[grain_type+'_basis'] = np.array(model_grid[grain_type+'_basis'])[:,wavelength_idx]
+            arrays[grain_type+'_coefficients'] = np.array(model_grid[grain_type+'_coefficients'])[alpha_idx][:,isrf_idx]
+            
+        header = create_compressed_grid_header(arrays,
+                                               shape)
+        
+    else:
+        
+        header = create_grid_header(arrays,
+                                    shape)
+        
+    header.update(header_info)
+    
+    write_grid_header(header,
+                      grid_dir)
+    
+    for name in arrays:
+        
+        grid_array = open_grid_array(header,
+                                     grid_dir,
+                                     name,
+                                     mode='w+')
+        grid_array[:] = arrays[name]
+        grid_array.flush()
+    
+    if is_compressed(model_grid):
+        return
+    
+    for grain_type in grain_types:
+        
+        grid_array = open_grid_array(header,
+                                     grid_dir,
+                                     grain_type,
+                                     mode='w+')
+        
+        #Go a row of alpha_sCM20 at a time to keep the memory down
+        
+        for i,idx in enumerate(alpha_idx):
+            grid_array[i] = model_grid[grain_type][idx][isrf_idx][:,wavelength_idx]
+            
+        grid_array.flush()
+        
+        del grid_array
+        
+def compress_model_grid(model_grid,
+                        grid_dir,
+                        tolerance=1e-3,
+                        chunk_size=10000):
+    
+    #Write out a low-rank version of the model grid. For each grain type,
+    #the spectra are expanded in the leading eigenvectors of their
+    #(normalised) covariance, keeping just enough that every model is
+    #reproduced to within tolerance (as a fraction of its norm). The grid
+    #then holds the basis spectra and a table of coefficients
+    
+    n_alpha = len(model_grid['alpha'])
+    n_isrf = len(model_grid['logU'])
+    n_wavelength = len(model_grid['wavelength'])
+    
+    arrays = {'wavelength':np.array(model_grid['wavelength']),
+              'alpha':np.array(model_grid['alpha']),
+              'logU':np.array(model_grid['logU'])}
+    
+    for grain_type in grain_types:
+        
+        spectra = np.reshape(model_grid[grain_type],(n_alpha*n_isrf,n_wavelength))
+        
+        #Build up the covariance a chunk of models at a time, so the whole
+        #grid never needs to be in memory
+        
+        covariance = np.zeros([n_wavelength,n_wavelength])
+        
+        for start in range(0,len(spectra),chunk_size):
+            
+            chunk = np.array(spectra[start:start+chunk_size])
+            chunk = normalise_spectra(chunk)
+            
+            covariance += chunk.T.dot(chunk)
+            
+        eigenvalues,eigenvectors = np.linalg.eigh(covariance)
+        
+        basis = eigenvectors[:,::-1].T
+        
+        #The fractional residual for each rank follows from the projections
+        #onto the basis, so find the worst model for every rank in one pass
+        
+        max_residual = np.zeros(n_wavelength)
+        
+        for start in range(0,len(spectra),chunk_size):
+            
+            chunk = normalise_spectra(np.array(spectra[start:start+chunk_size]))
+            
+            projections = chunk.dot(basis.T)
+            
+            residual = 1-np.cumsum(projections**2,axis=1)
+            max_residual = np.maximum(max_residual,np.max(residual,axis=0))
+            
+        rank = np.where(np.sqrt(np.clip(max_residual,0,None)) < tolerance)[0]
+        rank = rank[0]+1 if len(rank) > 0 else n_wavelength
+        
+        coefficients = np.zeros([len(spectra),rank])
+        
+        for start in range(0,len(spectra),chunk_size):
+            coefficients[start:start+chunk_size] = np.dot(spectra[start:start+chunk_size],
+                                                          basis[:rank].T)
+        
+        arrays[grain_type+'_basis'] = basis[:rank]
+        arrays[grain_type+'_coefficients'] = np.reshape(coefficients,
+                                                        (n_alpha,n_isrf,rank))
+        
+        print(grain_type+': '+str(rank)+' basis spectra')
+        
+    header = create_compressed_grid_header(arrays,
+                                           [n_alpha,n_isrf,n_wavelength])
+    header['tolerance'] = tolerance
+    
+    write_grid_header(header,
+                      grid_dir)
+    
+    for name in arrays:
+        
+        grid_array = open_grid_array(header,
+                                     grid_dir,
+                                     name,
+                                     mode='w+')
+        grid_array[:] = arrays[name]
+        grid_array.flush()
+        
+        del grid_array
+        
+def normalise_spectra(spectra):
+    
+    #Scale each spectrum to unit norm, so the basis describes the shapes of
+    #the models equally well across the huge range of ISRF strengths
+    
+    norm = np.sqrt(np.sum(spectra**2,axis=1))
+    norm[norm == 0] = 1
+    
+    return spectra/norm[:,np.newaxis]
+
+def check_grid_columns(col_alpha,
+                       col_isrf,
+                       alpha_axis,
+                       isrf_axis):
+    
+    #Models are put in place by grid_index, which only works if the axes
+    #are evenly spaced and every (alpha_sCM20, logU) cell has exactly one
+    #model. Otherwise some cells would be left empty or written twice
+    
+    for name,axis in [('alpha_sCM20',alpha_axis),('logU',isrf_axis)]:
+        
+        if len(axis) < 2:
+            raise Exception('Model grid needs at least two '+name+' values')
+        
+        if not np.allclose(np.diff(axis),axis[1]-axis[0],rtol=1e-6,atol=0):
+            raise Exception('Model grid '+name+' values are not evenly spaced')
+    
+    if len(col_alpha) != len(alpha_axis)*len(isrf_axis):
+        raise Exception('Model grid has %d models, but %d alpha_sCM20 x %d logU values' % (len(col_alpha),
+                                                                                         len(alpha_axis),
+                                                                                         len(isrf_axis)))
+    
+    idx_alpha = grid_index(col_alpha,alpha_axis)
+    idx_isrf = grid_index(col_isrf,isrf_axis)
+    
+    for name,idx,col,axis in [('alpha_sCM20',idx_alpha,col_alpha,alpha_axis),
+                              ('logU',idx_isrf,col_isrf,isrf_axis)]:
+        
+        on_grid = (idx >= 0) & (idx < len(axis))
+        on_grid[on_grid] = np.isclose(axis[idx[on_grid]],col[on_grid],rtol=0,atol=1e-6*(axis[1]-axis[0]))
+        
+        if not np.all(on_grid):
+            raise Exception('Model grid has %d models off the %s axis' % (np.sum(~on_grid),name))
+    
+    filled = np.zeros([len(alpha_axis),len(isrf_axis)],dtype=int)
+    np.add.at(filled,(idx_alpha,idx_isrf),1)
+    
+    if np.any(filled != 1):
+        raise Exception('Model grid is missing %d cells and has %d duplicated' % (np.sum(filled == 0),
+                                                                                  np.sum(filled > 1)))
+    
+    return idx_alpha,idx_isrf
+
+def convert_model_grid(model_file,
+                       grid_dir):
+    
+    #Convert the string-keyed DataFrames in models.h5 into the binary
+    #model grid format read by read_model_grid. Each grain type is held as
+    #a contiguous (n_alpha x n_logU x n_wavelength) array, so models can be
+    #looked up by grid index rather than by column name
+    
+    for grain_type in grain_types:
+        
+        model_df = pd.read_hdf(model_file,grain_type)
+        
+        col_alpha,col_isrf = grid_axes(model_df)
+        
+        #Set up the grid axes and header from the first grain type
+        
+        if grain_type == grain_types[0]:
+            
+            arrays = {'wavelength':pd.read_hdf(model_file,'wavelength')['wavelength'].values,
+                      'alpha':np.unique(col_alpha),
+                      'logU':np.unique(col_isrf)}
+            
+            check_grid_columns(col_alpha,
+                               col_isrf,
+                               arrays['alpha'],
+                               arrays['logU'])
+            
+            header = create_grid_header(arrays,
+                                        [len(arrays['alpha']),
+                                         len(arrays['logU']),
+                                         len(arrays['wavelength'])])
+            
+            write_grid_header(header,
+                              grid_dir)
+            
+            for name in arrays:
+                
+                grid_array = open_grid_array(header,
+                                             grid_dir,
+                                             name,
+                                             mode='w+')
+                grid_array[:] = arrays[name]
+                grid_array.flush()
+                
+        idx_alpha,idx_isrf = check_grid_columns(col_alpha,
+                                                col_isrf,
+                                                arrays['alpha'],
+                                                arrays['logU'])
+        
+        grid_array = open_grid_array(header,
+                                     grid_dir,
+                                     grain_type,
+                                     mode='w+')
+        grid_array[idx_alpha,idx_isrf,:] = model_df.values.T
+        grid_array.flush()
+        
+        del grid_array,model_df
+        
+def create_grid_header(arrays,
+                       shape):
+    
+    #The header is a small JSON file describing the raw little-endian
+    #arrays that make up the grid
+    
+    header = {'format':'themcmc_grid',
+              'version':1,
+              'arrays':{}}
+    
+    for name in ['wavelength','alpha','logU']:
+        
+        header['arrays'][name] = {'file':name+'.bin',
+                                  'dtype':'<f8',
+                                  'shape':[len(arrays[name])]}
+        
+    for grain_type in grain_types:
+        
+        header['arrays'][grain_type] = {'file':grain_type+'.bin',
+                                        'dtype':'<f8',
+                                        'shape':list(shape)}
+        
+    return header
+
+def create_compressed_grid_header(arrays,
+                                  shape):
+    
+    #As create_grid_header, but each grain type is a set of basis spectra
+    #and an (n_alpha x n_logU x n_basis) table of coefficients
+    
+    header = create_grid_header(arrays,
+                                shape)
+    
+    header['compression'] = 'svd'
+    
+    for grain_type in grain_types:
+        
+        del header['arrays'][grain_type]
+        
+        for name in [grain_type+'_basis',grain_type+'_coefficients']:
+            
+            header['arrays'][name] = {'file':name+'.bin',
+                                      'dtype':'<f8',
+                                      'shape':list(np.shape(arrays[name]))}
+            
+    return header
+    
+def write_grid_header(header,
+                      grid_dir):
+    
+    if not os.path.exists(grid_dir):
+        os.makedirs(grid_dir)
+        
+    with open(os.path.join(grid_dir,'header.json'),'w') as header_file:
+        json.dump(header,header_file,indent=4)
+        
+def read_grid_header(grid_dir):
+    
+    with open(os.path.join(grid_dir,'header.json'),'r') as header_file:
+        header = json.load(header_file)
+        
+    return header
+
+def open_grid_array(header,
+                    grid_dir,
+                    name,
+                    mode='r'):
+    
+    array_info = header['arrays'][name]
+    
+    return np.memmap(os.path.join(grid_dir,array_info['file']),
+                     dtype=np.dtype(array_info['dtype']),
+                     mode=mode,
+                     shape=tuple(array_info['shape']))
+
+def read_model_grid(grid_dir):
+    
+    #Memory-map the model grid. Every process that opens the grid shares
+    #the same pages through the page cache, rather than each holding its
+    #own copy
+    
+    header = read_grid_header(grid_dir)
+    
+    model_grid = {}
+    
+    for name in header['arrays']:
+        
+        model_grid[name] = open_grid_array(header,
+                                           grid_dir,
+                                           name)
+        
+    return model_grid
+
+def band_flux_grid(response,
+                   model_grid):
+    
+    #Pass every (alpha_sCM20, logU) model through the filter response
+    #matrix, giving an (n_alpha x n_logU x 3 x n_bands) cube of band fluxes
+    #for sCM20, lCM20 and aSilM5 respectively
+    
+    band_fluxes = np.zeros([len(model_grid['alpha']),
+                            len(model_grid['logU']),
+                            len(grain_types),
+                            response.shape[0]])
+    
+    for i,grain_type in enumerate(grain_types):
+        
+        #For a compressed grid, only the basis spectra need passing through
+        #the filters
+        
+        if is_compressed(model_grid):
+            
+            band_fluxes[:,:,i,:] = np.dot(model_grid[grain_type+'_coefficients'],
+                                          model_grid[grain_type+'_basis'].dot(response.T))
+            
+        else:
+            
+            band_fluxes[:,:,i,:] = np.tensordot(model_grid[grain_type],
+                                                response,
+                                                axes=([2],[1]))
+        
+    return band_fluxes
+
+def factorise_covariance(total_err):
+    
+    #The covariance matrix is fixed for the whole chain, so Cholesky
+    #factorise it once rather than inverting it on every likelihood call
+    
+    return cholesky(total_err,lower=True)
+
+def batch_nnls(fisher,
+               projection,
+               tol=1e-10):
+    
+    #Non-negative least squares for many small problems at once, through
+    #the normal equations: minimise |D a - f|^2 with a >= 0, given
+    #fisher = D^T D (n_problems x k x k) and projection = D^T f (n_problems x
+    #k). This is the Lawson-Hanson active set method, with all the problems
+    #still going taking each step together. Columns should be scaled to
+    #about unit norm, since tol is absolute
+    
+    n,k = projection.shape
+    
+    amplitudes = np.zeros([n,k])
+    passive = np.zeros([n,k],dtype=bool)
+    identity = np.identity(k)
+    
+    def solve_passive(idx):
+        
+        #Least squares on just the passive columns, with the rest held at 0
+        
+        mask = passive[idx,:,np.newaxis] & passive[idx,np.newaxis,:]
+        
+        return np.linalg.solve(np.where(mask,fisher[idx],identity),
+                               np.where(passive[idx],projection[idx],0)[:,:,np.newaxis])[:,:,0]
+    
+    running = np.arange(n)
+    
+    for iteration in range(3*k):
+        
+        gradient = projection[running]-np.matmul(fisher[running],amplitudes[running,:,np.newaxis])[:,:,0]
+        
+        candidates = ~passive[running] & (gradient > tol)
+        improving = np.any(candidates,axis=1)
+        
+        running = running[improving]
+        
+        if len(running) == 0:
+            break
+        
+        #Free up the most promising column
+        
+        best = np.argmax(np.where(candidates[improving],gradient[improving],-np.inf),axis=1)
+        passive[running,best] = True
+        
+        stepping = running
+        
+        for inner in range(k):
+            
+            solution = solve_passive(stepping)
+            
+            infeasible = passive[stepping] & (solution <= 0)
+            blocked = np.any(infeasible,axis=1)
+            
+            amplitudes[stepping[~blocked]] = solution[~blocked]
+            
+            if not np.any(blocked):
+                break
+            
+            #Go as far towards the solution as stays non-negative, and drop
+            #the columns that hit zero
+            
+            current = amplitudes[stepping[blocked]]
+            solution = solution[blocked]
+            
+            with np.errstate(divide='ignore',invalid='ignore'):
+                ratio = np.where(infeasible[blocked],current/(current-solution),np.inf)
+                
+            current += np.min(ratio,axis=1)[:,np.newaxis]*(solution-current)
+            
+            stepping = stepping[blocked]
+            
+            passive[stepping] &= current > tol
+            amplitudes[stepping] = np.where(passive[stepping],current,0)
+            
+    return amplitudes
+
+def calculate_chisq(flux_diff,
+                    cov_cholesky):
+    
+    #chi^2 = r^T C^-1 r = |L^-1 r|^2, using a triangular solve against the
+    #cached Cholesky factor. flux_diff can be a single residual vector or
+    #an (n_residuals x n_bands) array, in which case we get one chi^2 per row
+    
+    whitened = solve_triangular(cov_cholesky,
+                                np.atleast_2d(flux_diff).T,
+                                lower=True,
+                                check_finite=False)
+    
+    chisq = np.sum(whitened**2,axis=0)
+    
+    if np.ndim(flux_diff) == 1:
+        chisq = chisq[0]
+    
+    return chisq
+
 def define_stars(flux_df,
                  gal_row,
                  filter_df,
@@ -10,9 +10,14 @@ v1.00: 20180817.
 #Ensure python3 compatibility
 from __future__ import absolute_import, print_function, division
 
+#Time the imports, for --importprofile
+
+import time
+
+import_start = time.time()
+
 import numpy as np
 import pandas as pd
-import time
 
 #Argument parsing
 import argparse
@@ -24,17 +29,20 @@ import sys
 os.chdir(os.getcwd())
 sys.path.append(os.getcwd())
 
-#THEMCMC imports
+#THEMCMC imports. plotting (matplotlib and corner), code_snippets and
+#astropy are only imported where they're used, so every MPI rank and worker
+#doesn't pay for them when they're not needed
 
 import sampler_themcmc
-import plotting
 import general
-import code_snippets
+import scheduler
+
+import_time = time.time()-import_start
+
+#Heavy modules to list in the --importprofile report
 
-try:
-    from schwimmbad import MPIPool
-except:
-    pass
+profiled_modules = ['numpy','pandas','scipy','emcee','astropy','matplotlib',
+                    'corner','dill','tqdm','psutil','mpi4py','threadpoolctl']
 
 #Set up the argument parser
 
@@ -63,37 +71,155 @@ parser.add_argument('--dustemoutput',action='store_true',default=False,
 parser.add_argument('--fluxes',type=str,default='fluxes',metavar='',
                     help="File containing 'fluxes' to fit.")
 parser.add_argument('--mpi',action='store_true',default=False,
-                    help="Run with MPI (requires Schwimmbad, and --bind-to none).")
+                    help="Run with MPI (requires mpi4py, and --bind-to none). Rank 0 schedules, every other rank is a worker.")
+parser.add_argument('--chunks',type=int,default=4,metavar='',
+                    help="Number of blocks each galaxy's walkers are split into every step, which any idle worker can pick up.")
+parser.add_argument('--threads',type=int,default=0,metavar='',
+                    help="BLAS/OpenMP threads per worker. 0 shares each node's cores out between the workers on it.")
+parser.add_argument('--maxmemory',type=float,default=0,metavar='',
+                    help="Memory (GB) the workers on each node can use between them. 0 uses whatever is free.")
+parser.add_argument('--adaptive',action='store_true',default=False,
+                    help="Run until converged, using the autocorrelation time, rather than a fixed number of steps.")
+parser.add_argument('--taufactor',type=int,default=50,metavar='',
+                    help="In adaptive mode, stop once the chain is this many autocorrelation times long.")
+parser.add_argument('--maxsteps',type=int,default=10000,metavar='',
+                    help="In adaptive mode, maximum number of steps to run.")
+parser.add_argument('--optimise',action='store_true',default=False,
+                    help="Start the walkers from the maximum a posteriori point, rather than heuristic guesses.")
+parser.add_argument('--marginalise',action='store_true',default=False,
+                    help="Only sample alpha_sCM20 and the ISRF strengths, marginalising over the linear amplitudes analytically.")
+parser.add_argument('--interpolate',action='store_true',default=False,
+                    help="Interpolate between model grid points, rather than rounding to the nearest.")
+parser.add_argument('--griddir',type=str,default='models',metavar='',
+                    help="Directory containing the model grid.")
+parser.add_argument('--prune',action='store_true',default=False,
+                    help="Only keep the model wavelengths needed for the filters in filters.csv.")
+parser.add_argument('--checkpoint',type=int,default=50,metavar='',
+                    help="Write the chain to disk every this many steps, so interrupted fits can be resumed.")
+parser.add_argument('--importprofile',action='store_true',default=False,
+                    help="Report how long the imports and setup took, and which heavy modules were loaded.")
 
-args = parser.parse_args()
+#Model grids already read in, so fitting several catalogues from one
+#process (through the themcmc_api package) only does it once
 
-#Create folders for sample pickle jars and plots, if they don't exits
+grid_cache = {}
 
-os.chdir(os.getcwd())
+def make_args(**options):
+    
+    #The same settings as the command line, as keyword arguments (named as
+    #the flags, e.g. overwritesamples=True)
+    
+    args = parser.parse_args([])
+    
+    for option in options:
+        
+        if not hasattr(args,option):
+            raise Exception('Unknown option '+option)
+        
+        setattr(args,option,options[option])
+    
+    return args
 
-if not os.path.exists('../plots') and (args.plotsed or args.plotcorner):
-    os.mkdir('../plots')
-if not os.path.exists('../plots/sed') and args.plotsed:
-    os.mkdir('../plots/sed')
-if not os.path.exists('../plots/corner') and args.plotcorner:
-    os.mkdir('../plots/corner')
-if not os.path.exists('../samples'):
-    os.mkdir('../samples')
-if not os.path.exists('../skirt_output') and args.skirtoutput:
-    os.mkdir('../skirt_output')
-if not os.path.exists('../dustem_output') and args.dustemoutput:
-    os.mkdir('../dustem_output')
-    
-def main(gal_row):
+def load_grid(grid_dir):
+    
+    #Memory-map the model grid, so that every process on the node shares
+    #one copy of it
+    
+    if grid_dir not in grid_cache:
+        
+        if not os.path.exists(os.path.join(grid_dir,'header.json')):
+            raise Exception('No model grid found! Convert models.h5 with general.convert_model_grid')
+        
+        grid_cache[grid_dir] = general.read_model_grid(grid_dir)
+    
+    return grid_cache[grid_dir]
+
+def make_folders():
+    
+    #Create folders for sample pickle jars and plots, if they don't exits
+    
+    if not os.path.exists('../plots') and (args.plotsed or args.plotcorner):
+        os.mkdir('../plots')
+    if not os.path.exists('../plots/sed') and args.plotsed:
+        os.mkdir('../plots/sed')
+    if not os.path.exists('../plots/corner') and args.plotcorner:
+        os.mkdir('../plots/corner')
+    if not os.path.exists('../samples'):
+        os.mkdir('../samples')
+    if not os.path.exists('../skirt_output') and args.skirtoutput:
+        os.mkdir('../skirt_output')
+    if not os.path.exists('../dustem_output') and args.dustemoutput:
+        os.mkdir('../dustem_output')
+        
+def setup(run_args):
+    
+    #Read in the catalogue and the model grid for these settings. Everything
+    #main needs is kept at module level, so the workers (forked from this
+    #process) have it too
+    
+    global args,flux_df,filter_df,model_grid,plot_grid
+    
+    args = run_args
+    
+    make_folders()
+    
+    #For each galaxy, read in fluxes
+    
+    flux_df = pd.read_csv('../'+args.fluxes)
+    filter_df = pd.read_csv('../filters.csv')
+    
+    model_grid = load_grid(args.griddir)
+    
+    #The full SEDs are still used for plotting
+    
+    plot_grid = model_grid
+    grid_dir = args.griddir
+    
+    #Optionally cut the grid down to the wavelengths the filters need, over
+    #the redshift range of the catalogue
+    
+    if args.prune:
+        
+        import astropy.units as u
+        from astropy.cosmology import Planck15, z_at_value
+        
+        filter_keys = list(filter_df.dtypes.index[1:])
+        
+        z_min = z_at_value(Planck15.luminosity_distance,np.min(flux_df['dist'])*u.Mpc)
+        z_max = z_at_value(Planck15.luminosity_distance,np.max(flux_df['dist'])*u.Mpc)
+        
+        grid_dir = os.path.join(args.griddir,'pruned')
         
+        pruning = (grid_dir,tuple(filter_keys),float(z_min),float(z_max))
+        
+        if pruning not in grid_cache:
+            
+            grid_cache[pruning] = general.prune_model_grid(model_grid,
+                                                           grid_dir,
+                                                           general.read_filters(filter_keys),
+                                                           filter_keys,
+                                                           z_min,
+                                                           z_max)
+        
+        model_grid = grid_cache[pruning]
+        
+        print('Pruned model grid to '+str(len(model_grid['wavelength']))+' wavelengths')
+    
+    #Every worker memory-maps the grid
+    
+    sampler_themcmc.init_worker(grid_dir)
+    
+def main(gal_row,
+         pool=None):
+    
     gal_name = flux_df['name'][gal_row]
     
     try:
-    
-        dist = flux_df['dist'][gal_row]
         
+        dist = flux_df['dist'][gal_row]
+    
     except KeyError:
-                      
+        
         raise Exception('No distance found!')
     
     #Parse components
@@ -101,45 +227,61 @@ def main(gal_row):
     try:
         
         components = int(args.components)
-        
+    
     except:
         
         print('oh no')
-        
+    
+    #With several galaxies running at once, progress bars would get mixed up
+    
     samples_df,filter_dict = sampler_themcmc.sample(method=args.method,
                                                     components=components,
                                                     flux_file=args.fluxes,
                                                     filter_file='filters.csv',
                                                     gal_row=gal_row,
-                                                    pandas_dfs=pandas_dfs,
-                                                    mpi=args.mpi,
-                                                    overwrite=args.overwritesamples)
-        
+                                                    model_grid=model_grid,
+                                                    mpi=pool is not None,
+                                                    overwrite=args.overwritesamples,
+                                                    pool=pool,
+                                                    processes=args.chunks,
+                                                    adaptive=args.adaptive,
+                                                    tau_factor=args.taufactor,
+                                                    max_steps=args.maxsteps,
+                                                    checkpoint_interval=args.checkpoint,
+                                                    optimise=args.optimise,
+                                                    marginalise=args.marginalise,
+                                                    interpolate=args.interpolate)
+    
     if args.plotsed:
         
         if not os.path.isfile('../plots/sed/'+gal_name+'_'+args.method+'_'+str(components)+'comp.png') or\
             args.overwritesedplot:
             
             print('Plotting SED')
-        
+            
+            import plotting
+            
             plotting.plot_sed(method=args.method,
                               components=components,
                               flux_df=flux_df,
                               filter_df=filter_df,
-                              pandas_dfs=pandas_dfs,
+                              model_grid=plot_grid,
                               gal_row=gal_row,
                               samples_df=samples_df,
                               filter_dict=filter_dict,
                               units=args.units,
-                              distance=dist)
-            
+                              distance=dist,
+                              interpolate=args.interpolate)
+    
     if args.plotcorner:
-            
+        
         if not os.path.isfile('../plots/corner/'+gal_name+'_'+args.method+'_'+str(components)+'comp.png') or\
             args.overwritecorner:
             
             print('Plotting corner')
             
+            import plotting
+            
             plotting.plot_corner(method=args.method,
                                  components=components,
                                  samples_df=samples_df,
@@ -151,59 +293,119 @@ def main(gal_row):
     if args.dustemoutput:
         
         if not os.path.isfile('../dustem_output/GRAIN_'+gal_name+'_'+args.method+'.dat'):
-        
+            
             print('Writing DustEM GRAIN.dat file')
             
+            import code_snippets
+            
             code_snippets.dustemoutput(method=args.method,
                                        samples_df=samples_df,
                                        gal_name=gal_name)
-                
+    
     if args.skirtoutput:
         
         if not os.path.isfile('../skirt_output/template_'+gal_name+'_'+args.method+'.ski'):
-        
+            
             print('Writing SKIRT code snippet')
             
+            import code_snippets
+            
             code_snippets.skirtoutput(method=args.method,
                                       samples_df=samples_df,
                                       gal_name=gal_name)
+    
+    return samples_df
 
-if __name__ == "__main__":
+def import_profile(start_time):
+    
+    #How long startup took, split into imports and setup (reading the
+    #catalogue and grid), and which of the heavy modules got loaded
+    
+    loaded = [module for module in profiled_modules if module in sys.modules]
+    not_loaded = [module for module in profiled_modules if module not in sys.modules]
+    
+    return 'Imports took %.2fs, setup %.2fs\nLoaded: %s\nNot loaded: %s' % \
+        (import_time,time.time()-start_time,', '.join(loaded),', '.join(not_loaded))
 
-    start_time = time.time()
+def fit(rows=None):
     
-    #For each galaxy, read in fluxes
+    #Fit these rows of the catalogue (all of them by default) with the
+    #settings given to setup. Returns False on MPI worker ranks, which have
+    #nothing left to do once the fitting is over
     
-    flux_df = pd.read_csv('../'+args.fluxes)
-    filter_df = pd.read_csv('../filters.csv')
+    if rows is None:
+        rows = range(len(flux_df))
     
-    #Read in and zip up dataframes
+    #One set of workers fits the galaxies, and the blocks of walkers they
+    #send out at each step go to whichever worker is free. Workers whose
+    #galaxy is done (or has yet to start) help the others, so a few slow
+    #galaxies don't leave the rest of the machine idle
     
-    sCM20_df = pd.read_hdf('models.h5','sCM20')
-    lCM20_df = pd.read_hdf('models.h5','lCM20')
-    aSilM5_df = pd.read_hdf('models.h5','aSilM5')
-    wavelength_df = pd.read_hdf('models.h5','wavelength')
+    #Each worker gets a share of its node's cores for BLAS/OpenMP threads,
+    #rather than every library starting a thread per core in every worker
     
-    pandas_dfs = [sCM20_df,lCM20_df,
-                  aSilM5_df,wavelength_df]
+    n_threads = None
+    
+    if args.threads > 0:
+        n_threads = args.threads
     
     if args.mpi:
         
-        mpi_pool = MPIPool()
+        backend = scheduler.MPIBackend(n_threads=n_threads)
+    
+    else:
+        
+        backend = scheduler.LocalBackend(scheduler.available_cores(),
+                                         n_threads=n_threads)
+    
+    if backend.is_master:
+        print('Fitting using '+str(backend.n_workers)+' workers')
+        print(scheduler.describe_layout(backend))
+    
+    #Start as many workers as there are cores, then measure how much memory
+    #they need on the first galaxy and only run as many at once as fit
+    
+    max_memory = None
+    
+    if args.maxmemory > 0:
+        max_memory = args.maxmemory*1e9
+    
+    planner = scheduler.MemoryPlanner(ceiling=max_memory,
+                                      n_threads=n_threads)
+    
+    if backend.n_workers == 1 and not args.mpi:
         
-        if not mpi_pool.is_master():
-            mpi_pool.wait()
-            sys.exit(0)
+        #Fitting in this process, so it gets the threads
         
-        mpi_pool.map( main,
-                      range(len(flux_df)) )
+        libraries = scheduler.limit_threads(backend.n_threads)
         
-        mpi_pool.close()
+        if len(libraries) > 0:
+            print('Thread pools: '+', '.join(libraries))
         
+        for gal_row in rows:
+            
+            main(gal_row)
+    
     else:
         
-        for gal_row in range(len(flux_df)):
-             
-            main(gal_row)
+        scheduler.run_tasks(rows,
+                            main,
+                            backend,
+                            affinity=sampler_themcmc.chunk_affinity,
+                            planner=planner)
+    
+    return backend.is_master
+
+if __name__ == "__main__":
+    
+    start_time = time.time()
+    
+    setup(parser.parse_args())
+    
+    if args.importprofile:
+        print(import_profile(start_time))
+    
+    if not fit():
+        sys.exit(0)
     
     print('Code complete, took %.2fm' % ( (time.time() - start_time)/60 ))
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Memory measurement for the THEMCMC process planner
+
+@author: Tom Williams
+
+v1.00.
+"""
+
+#Ensure python3 compatibility
+from __future__ import absolute_import, print_function, division
+
+import re
+
+#Header line of each mapping in /proc/<pid>/smaps: address range, perms,
+#offset, device, inode, then the path (if it's file-backed)
+
+mapping_header = re.compile(r'^[0-9a-f]+-[0-9a-f]+ \S+ \S+ \S+ (\d+)\s*(.*)$')
+
+def process_memory(pid='self'):
+    
+    #Memory this process holds privately (which another worker would need
+    #again) and what it shares with the others. The model grid is
+    #memory-mapped, so its pages sit in the page cache once for every
+    #process on the node; the same goes for the libraries. So pages of
+    #file-backed mappings only count as private once they're written to
+    #(copy-on-write), and everything anonymous counts as private. In bytes
+    
+    try:
+        
+        smaps = open('/proc/'+str(pid)+'/smaps')
+    
+    except IOError:
+        
+        #Not Linux, so psutil's unique set size is the best guess (it'll
+        #count grid pages only this process has touched as private)
+        
+        import psutil
+        
+        info = psutil.Process(None if pid == 'self' else pid).memory_full_info()
+        
+        return {'private':info.uss,
+                'shared':info.rss-info.uss}
+    
+    private = 0
+    shared = 0
+    file_backed = False
+    
+    with smaps:
+        
+        for line in smaps:
+            
+            header = mapping_header.match(line)
+            
+            if header is not None:
+                
+                path = header.group(2)
+                file_backed = int(header.group(1)) != 0 and not path.startswith('[')
+                continue
+            
+            field = line.split()
+            
+            if field[0] not in ['Shared_Clean:','Shared_Dirty:','Private_Clean:','Private_Dirty:']:
+                continue
+            
+            size = int(field[1])*1024
+            
+            if field[0] == 'Private_Dirty:' or (field[0] == 'Private_Clean:' and not file_backed):
+                private += size
+            else:
+                shared += size
+    
+    return {'private':private,
+            'shared':shared}
+
+def available_memory():
+    
+    #Memory that can be used on this node without swapping, in bytes
+    
+    try:
+        
+        with open('/proc/meminfo') as meminfo:
+            
+            for line in meminfo:
+                
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1])*1024
+    
+    except IOError:
+        pass
+    
+    from psutil import virtual_memory
+    
+    return virtual_memory().available
@@ -35,23 +35,17 @@ def plot_sed(method,
              components,
              flux_df,
              filter_df,
-             pandas_dfs,
+             model_grid,
              gal_row,
              samples_df,
              filter_dict,
              units,
-             distance):
+             distance,
+             interpolate=False):
     
     gal_name = flux_df['name'][gal_row]
     
-    #Read in the DustEM grid
-    
-    sCM20_df,\
-        lCM20_df,\
-        aSilM5_df,\
-        wavelength_df = pandas_dfs
-    
-    wavelength = wavelength_df['wavelength'].values.copy()
+    wavelength = model_grid['wavelength']
     
     #Take redshift into account
     
@@ -205,9 +199,8 @@ def plot_sed(method,
                 large_grains,\
                 silicates = general.read_sed(isrf,
                                              alpha,
-                                             sCM20_df,
-                                             lCM20_df,
-                                             aSilM5_df)
+                                             model_grid,
+                                             interpolate=interpolate)
             
             y = y_sCM20*small_grains*dust_scaling   
             y_to_percentile_small[:,i,component] = y
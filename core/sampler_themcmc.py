@@ -12,28 +12,23 @@ from __future__ import absolute_import, print_function, division
 
 import numpy as np
 import pandas as pd
-import dill
-from tqdm import tqdm
 from scipy.constants import h,k,c
-from psutil import virtual_memory
 import os
 import sys
 from collections import OrderedDict
+from functools import partial
 
 #emcee-related imports
 
 import emcee
-from multiprocessing import Pool, cpu_count   
-
-#For calculating redshift, given distance
-
-import astropy.units as u
-from astropy.cosmology import Planck15, z_at_value
+from itertools import combinations_with_replacement, product
+from scipy.optimize import nnls, minimize
+from scipy.linalg import cholesky, solve_triangular
 
 #THEMCMC imports
 
 import general
-from fortran_funcs import covariance_matrix,trapz
+from checkpoint import CheckpointBackend
 
 #MAIN SAMPLING FUNCTION
 
@@ -42,20 +37,25 @@ def sample(method,
            flux_file,
            filter_file,
            gal_row,
-           pandas_dfs,
+           model_grid,
            mpi,
-           overwrite):
-    
-    #Read in models
+           overwrite,
+           pool=None,
+           processes=1,
+           adaptive=False,
+           tau_factor=50,
+           max_steps=10000,
+           check_interval=100,
+           checkpoint_interval=50,
+           optimise=False,
+           marginalise=False,
+           nwalkers_marginal=100,
+           interpolate=False):
     
-    global sCM20_df,lCM20_df,aSilM5_df
+    #Workers in the pool hold their own (memory-mapped) copy of the grid,
+    #so just make it available to this process
     
-    #Read in the DustEM grid
-    
-    sCM20_df,\
-        lCM20_df,\
-        aSilM5_df,\
-        wavelength_df = pandas_dfs
+    globals()['model_grid'] = model_grid
     
     #Read in the useful Pandas dataframes
     
@@ -68,32 +68,24 @@ def sample(method,
     #Define the wavelength grid (given by the dustEM output)
     
     global wavelength
-    wavelength = wavelength_df['wavelength'].values.copy()
+    wavelength = model_grid['wavelength']
     
     global frequency
     frequency = 3e8/(wavelength*1e-6)
     
-    default_total = sCM20_df['alpha_sCM20:5.00,logU:0.00'].values.copy()+\
-                    lCM20_df['alpha_sCM20:5.00,logU:0.00'].values.copy()+\
-                    aSilM5_df['alpha_sCM20:5.00,logU:0.00'].values.copy()
-        
+    #For calculating redshift, given distance. astropy is slow to import, so
+    #only load it once there's a galaxy to fit
+    
+    import astropy.units as u
+    from astropy.cosmology import Planck15, z_at_value
+    
     global z
     z = z_at_value(Planck15.luminosity_distance,flux_df['dist'][gal_row]*u.Mpc)
     
     #Create a dictionary of the filters
     
     global filter_dict
-    filter_dict = {}
-    
-    for filter_name in filter_df.dtypes.index[1:]:
-        
-        filter_wavelength,transmission = np.loadtxt('../filters/'+filter_name+'.dat',
-                                         unpack=True)
-        
-        filter_wavelength /= 1e4
-        transmission /= np.max(transmission)
-        
-        filter_dict[filter_name] = filter_wavelength,transmission
+    filter_dict = general.read_filters(filter_df.dtypes.index[1:])
         
     gal_name = flux_df['name'][gal_row]
     
@@ -162,20 +154,18 @@ def sample(method,
             
     else:
         
-        #Make sure the program doesn't run into swap
-
-        ram_footprint = sys.getsizeof(sCM20_df)*4 #approx footprint (generous!)
-        mem = virtual_memory().available #free available RAM
-        
-        procs = cpu_count()
+        chain_file = '../samples/'+gal_name+'_'+method+'_'+str(components)+'comp_chain.h5'
         
-        #Run with the minimum processors that will either (a) not quite run into
-        #swap, (b) maxes out the machine or (c) 4 processes (since it doesn't scale well
-        #beyond that)
+        #Since the redshift and filters are fixed for this galaxy, pass every
+        #model in the grid through the filters once up front. The likelihood
+        #then only needs band flux lookups
         
-        processes = np.min([int(np.floor(mem/ram_footprint)),procs,4])
+        set_band_fluxes(z,
+                        keys)
+            
+        stars_flux = response.dot(stars)
     
-        print('Fitting '+gal_name+' using '+str(processes)+' processes')
+        print('Fitting '+gal_name)
         
         #Build up the matrices for the errors
         
@@ -212,6 +202,26 @@ def sample(method,
         global total_err    
         total_err = rms_err+uncorr_err+corr_err
         
+        #This is constant for the whole chain, so factorise it once here
+        
+        global cov_cholesky
+        cov_cholesky = general.factorise_covariance(total_err)
+        
+        #Everything a worker needs to evaluate the probability for this
+        #galaxy. This is small, so it's sent along with every block of
+        #walkers and the same pool can be reused from galaxy to galaxy
+        
+        galaxy_state = {'method':method,
+                        'components':components,
+                        'obs_flux':obs_flux,
+                        'stars_flux':stars_flux,
+                        'cov_cholesky':cov_cholesky,
+                        'z':z,
+                        'keys':keys,
+                        'interpolate':interpolate}
+        
+        load_galaxy_state(galaxy_state)
+        
         pos = []
         nwalkers = 500
         
@@ -229,9 +239,10 @@ def sample(method,
         
         for log_u in log_u_selection:
             
-            total = sCM20_df['alpha_sCM20:5.00,logU:%.2f' % log_u].values.copy()+\
-                lCM20_df['alpha_sCM20:5.00,logU:%.2f' % log_u].values.copy()+\
-                aSilM5_df['alpha_sCM20:5.00,logU:%.2f' % log_u].values.copy()
+            total = np.sum(general.read_sed(log_u,
+                                            5,
+                                            model_grid,
+                                            interpolate=interpolate),axis=0)
                 
             idx_max = np.where(total == np.max(total))[0][0]
             
@@ -365,45 +376,167 @@ def sample(method,
             
                 pos.append(values_var)
                 
-        #Run this MCMC. Since emcee pickles any arguments passed to it, use as few
-        #as possible and rely on global variables instead!
+        #In marginalised mode, we only sample alpha_sCM20 and the ISRF
+        #strengths. The linear amplitudes are solved for (and marginalised
+        #over) analytically, so we need far fewer walkers
         
-        pool = Pool(processes)
+        sampled_idx = np.arange(ndim)
+        sampled_walkers = nwalkers
+        
+        if marginalise:
+            
+            sampled_idx = nonlinear_index(method,
+                                          components)
+            sampled_walkers = nwalkers_marginal
+            
+            galaxy_state['marginalise'] = True
+            
+            chain_file = chain_file.replace('_chain.h5','_marginal_chain.h5')
+        
+        #Stream the chain to disk every so often, so a pre-empted or crashed
+        #run can pick up from where it left off
+        
+        backend = CheckpointBackend(chain_file,
+                                    checkpoint_interval=checkpoint_interval)
+        
+        if overwrite and os.path.exists(chain_file):
+            os.remove(chain_file)
+            
+        backend.load(sampled_walkers,len(sampled_idx))
+        
+        if backend.iteration > 0:
+            
+            print('Resuming '+gal_name+' from step '+str(backend.iteration))
+        
+        #Optionally, start the walkers from the maximum a posteriori point
+        #rather than the heuristic guesses above, which cuts down the burn-in.
+        #A resumed fit carries on from its last step, so doesn't need it
+        
+        elif optimise:
+            
+            print('Finding starting point for '+gal_name)
+            
+            theta_map = find_map(galaxy_state)
+            
+            pos = initialise_walkers(theta_map,
+                                     nwalkers,
+                                     method,
+                                     components)
+        
+        nwalkers = sampled_walkers
+        ndim = len(sampled_idx)
+        
+        pos = np.array(pos)[:nwalkers,sampled_idx]
+        
+        #Run this MCMC. The probability function is vectorised over walkers,
+        #so each pool task gets a block of walkers rather than a single one
         
         sampler = emcee.EnsembleSampler(nwalkers, 
                                         ndim, 
-                                        lnprob, 
-                                        args=(method,
-                                              components,
-                                              obs_flux,
-                                              stars),
-                                        pool=pool)
+                                        partial(lnprob_chunked,
+                                                pool=pool,
+                                                chunks=processes), 
+                                        args=(galaxy_state,),
+                                        vectorize=True,
+                                        backend=backend)
          
-        #Set a number of steps for the walkers, and throw away
-        #the first half as burn-in
+        #Either run a fixed number of steps for the walkers and throw away
+        #the first half as burn-in, or (in adaptive mode) run until the
+        #chain is many autocorrelation times long and the autocorrelation
+        #time has settled down
+        
+        nsteps = 500
         
+        if adaptive:
+            iterations = max_steps
+        else:
+            iterations = nsteps
+            
+        #Carry on from the last checkpoint, if there is one
+            
+        if backend.iteration > 0:
+            
+            pos = sampler.get_last_sample()
+            
+            if backend.complete:
+                iterations = 0
+            else:
+                iterations = np.max([iterations-backend.iteration,0])
+            
         #If using MPI this gets very messy so don't use
         #tqdm
         
-        nsteps = 500
+        chain_iterator = sampler.sample(pos,
+                                        iterations=iterations)
         
-        if mpi:
+        if not mpi:
             
-            for i,result in enumerate(sampler.sample(pos,
-                                                     iterations=nsteps)):
-                pos,probability,state = result
+            from tqdm import tqdm
             
-        else:
+            chain_iterator = tqdm(chain_iterator,
+                                  total=iterations,
+                                  desc='Fitting '+gal_name)
+            
+        old_tau = np.inf
+        converged = False
+        
+        for result in chain_iterator:
+            
+            pos,probability,state = result
+            
+            if adaptive and sampler.iteration % check_interval == 0:
+                
+                tau = sampler.get_autocorr_time(tol=0)
+                
+                converged = np.all(tau*tau_factor < sampler.iteration) and \
+                            np.all(np.abs(old_tau-tau)/tau < 0.01)
+                
+                old_tau = tau
+                
+                if converged:
+                    break
+                
+        #A run that had already finished keeps its verdict
+        
+        if iterations == 0:
+            converged = backend.converged
+        
+        backend.flush(complete=True,
+                      converged=converged)
+                
+        steps = sampler.iteration
+        tau = sampler.get_autocorr_time(tol=0)
         
-            for i,result in tqdm(enumerate(sampler.sample(pos,
-                                                      iterations=nsteps)),
-                                 total=nsteps,
-                                 desc='Fitting '+gal_name):
-                pos,probability,state = result
+        if adaptive:
+            
+            #Burn-in and thinning follow from the autocorrelation time
+            
+            burn_in = int(np.ceil(2*np.max(tau)))
+            thin = np.max([int(np.floor(0.5*np.min(tau))),1])
+            
+        elif optimise:
+            
+            #Starting at the MAP, we don't need to throw away nearly as much
             
-        pool.close()
+            burn_in = int(np.floor(nsteps/10))
+            thin = 1
             
-        samples = sampler.chain[:, int(np.floor(nsteps/2)):, :].reshape((-1, ndim))
+        else:
+            
+            burn_in = int(np.floor(nsteps/2))
+            thin = 1
+            
+        samples = sampler.get_chain(discard=burn_in,
+                                    thin=thin,
+                                    flat=True)
+        
+        #Draw the linear amplitudes for each sample, so the output has the
+        #same parameters as the full fit
+        
+        if marginalise:
+            
+            samples = draw_amplitudes(samples,
+                                      galaxy_state)
         
         # Convert samples to pandas dataframe and save out
         
@@ -441,204 +574,681 @@ def sample(method,
         
         samples_df.to_hdf('../samples/'+gal_name+'_'+method+'_'+str(components)+'comp.h5',
                           'samples',mode='w')
+        
+        #Write out the convergence diagnostics next to the samples. The
+        #effective sample size is the number of post-burn-in steps over
+        #the autocorrelation time, for each walker
+        
+        diagnostics_df = pd.DataFrame({'tau':tau,
+                                       'ess':nwalkers*(steps-burn_in)/tau},
+                                      index=samples_df.columns[sampled_idx])
+        
+        diagnostics_df['steps'] = steps
+        diagnostics_df['burn_in'] = burn_in
+        diagnostics_df['thin'] = thin
+        diagnostics_df['converged'] = converged
+        
+        diagnostics_df.to_csv('../samples/'+gal_name+'_'+method+'_'+str(components)+'comp_convergence.csv',
+                              index_label='parameter')
+        
+        #Everything's been written out, so the checkpoint is no longer needed
+        
+        os.remove(chain_file)
             
     return samples_df,filter_dict
         
-#EMCEE-RELATED FUNCTIONS
+#INITIALISATION FUNCTIONS
 
-def lnprob(theta,
-           method,
-           components,
-           obs_flux,
-           stars):
+def linear_design(alpha,
+                  isrf,
+                  method,
+                  stars_flux):
     
-    lp = priors(theta,
-                method,
-                components)
+    #For fixed alpha_sCM20 and ISRF strengths, the model band fluxes are
+    #linear in omega_star and the grain amplitudes. Build up the columns:
+    #stars, then either the summed THEMIS mix (default) or each grain type
+    #separately for each component. alpha can also be an array (one per
+    #walker, with isrf components x walkers), giving a design matrix per
+    #walker, all gathered from the band flux cube in one go
     
-    if not np.isfinite(lp):
-        return -np.inf
-    return lp + lnlike(theta,
-                       method,
-                       components,
-                       obs_flux,
-                       stars)
+    alphas = np.atleast_1d(alpha)
+    isrfs = np.reshape(isrf,(len(isrf),len(alphas)))
     
-def priors(theta,
-           method,
-           components):
+    columns = [np.broadcast_to(stars_flux,(len(alphas),len(stars_flux)))]
     
-    #log_ISRF must be between -2 and 7.
-    #alpha_sCM20 must be between 2 and 7.
-    #Multiplicative factors must be greater than 0.
-    #Redshift must be between 0 and 15.
+    for log_u in isrfs:
+        
+        grains = grain_band_fluxes(alphas,
+                                   log_u)
+        
+        if method == 'default':
+            columns.append(np.sum(grains,axis=1))
+        else:
+            columns.extend(grains.transpose(1,0,2))
+            
+    design = np.stack(columns,axis=2)
     
-    #Also insist that each component increases in ISRF
-    #strength
-
-    global z
+    if np.ndim(alpha) == 0:
+        return design[0]
     
-    if not 0<=z<=15:
-        return -np.inf
+    return design
+
+def amplitudes_to_theta(amplitudes,
+                        alpha,
+                        isrf,
+                        method):
     
-    omega_star = theta[0]
+    #Turn the fitted linear amplitudes back into the sampled parameters.
+    #Only the product of the overall scaling and each abundance deviation
+    #is constrained, so put the mean amplitude into the dust scaling and
+    #the rest into the deviations
     
-    if not omega_star>=0:
-        return -np.inf
+    theta = [amplitudes[0]]
     
     if method == 'ascfree':
+        theta.append(alpha)
         
-        alpha = theta[1]
+    for component,log_u in enumerate(isrf):
+        
+        theta.append(log_u)
         
-        if not 2<=alpha<=7:
-            return -np.inf
-    
-    for component in range(components):
-    
         if method == 'default':
             
-            isrf = theta[2*component+1]
-            dust_scaling = theta[2*component+2]
-            
-            if not -2<=isrf<=7 or not dust_scaling>=0:
-                return -np.inf
+            theta.append(amplitudes[component+1])
             
-            if component > 0:
+        else:
             
-                if not isrf>=theta[2*(component-1)+1]:
-                    return -np.inf
+            grain_amplitudes = amplitudes[3*component+1:3*component+4]
+            dust_scaling = np.mean(grain_amplitudes)
             
-        if method == 'abundfree':
+            if dust_scaling > 0:
+                theta.extend(grain_amplitudes/dust_scaling)
+            else:
+                theta.extend([1,1,1])
             
-            isrf = theta[5*component+1]
-            y_sCM20 = theta[5*component+2]
-            y_lCM20 = theta[5*component+3]
-            y_aSilM5 = theta[5*component+4]
-            dust_scaling = theta[5*component+5]   
+            theta.append(dust_scaling)
             
-            if not -2<=isrf<=7 or not dust_scaling>=0\
-                or not y_sCM20>=0 or not y_lCM20>=0\
-                or not y_aSilM5>=0:
-                return -np.inf 
+    return np.array(theta)
+
+def find_map(galaxy_state,
+             scan_step=0.25):
+    
+    #Find the maximum a posteriori point. First, scan a coarse lattice in
+    #alpha_sCM20 and ISRF strength, solving for the linear amplitudes at
+    #each point by non-negative least squares (whitened by the covariance).
+    #Then polish the best of these with a local optimiser on the full
+    #likelihood
+    
+    method = galaxy_state['method']
+    components = galaxy_state['components']
+    obs_flux = galaxy_state['obs_flux']
+    stars_flux = galaxy_state['stars_flux']
+    
+    load_galaxy_state(galaxy_state)
+    
+    #The number of ISRF combinations grows quickly with the number of
+    #components, so scan more coarsely for more components
+    
+    alpha_stride = np.max([int(np.rint(scan_step/(alpha_axis[1]-alpha_axis[0]))),1])
+    isrf_stride = np.max([int(np.rint(scan_step*components/(isrf_axis[1]-isrf_axis[0]))),1])
+    
+    if method == 'ascfree':
+        alpha_scan = alpha_axis[::alpha_stride]
+    else:
+        alpha_scan = [5.0]
+        
+    whitened_flux = solve_triangular(cov_cholesky,obs_flux,lower=True)
+    
+    best_chisq = np.inf
+    
+    for alpha,isrf in product(alpha_scan,
+                              combinations_with_replacement(isrf_axis[::isrf_stride],
+                                                            components)):
+        
+        design = solve_triangular(cov_cholesky,
+                                  linear_design(alpha,
+                                                isrf,
+                                                method,
+                                                stars_flux),
+                                  lower=True)
+        
+        amplitudes,residual = nnls(design,whitened_flux)
+        
+        if residual**2 < best_chisq:
             
-            if component > 0:
+            best_chisq = residual**2
+            theta_scan = amplitudes_to_theta(amplitudes,
+                                             alpha,
+                                             isrf,
+                                             method)
             
-                if not isrf>=theta[5*(component-1)+1]:
-                    return -np.inf
+    result = minimize(lambda theta: -lnprob(theta,
+                                            method,
+                                            components,
+                                            obs_flux,
+                                            stars_flux),
+                      theta_scan,
+                      method='Nelder-Mead',
+                      options={'maxiter':2000*len(theta_scan),
+                               'xatol':1e-4,
+                               'fatol':1e-4})
+    
+    if np.isfinite(result.fun) and result.fun < -lnprob(theta_scan,
+                                                        method,
+                                                        components,
+                                                        obs_flux,
+                                                        stars_flux):
+        return result.x
+    
+    return theta_scan
+
+def initialise_walkers(theta_map,
+                       nwalkers,
+                       method,
+                       components):
+    
+    #Gaussian ball around the MAP. Scalings get a 1% relative scatter,
+    #ISRF strength and alpha_sCM20 an absolute one, and everything is
+    #kept inside the priors
+    
+    scatter = 1e-2*np.abs(theta_map)
+    
+    isrf_idx = nonlinear_index(method,
+                               components)[-components:]
+    
+    scatter[isrf_idx] = 1e-2
+    
+    if method == 'ascfree':
+        scatter[1] = 1e-2
         
-        if method == 'ascfree':
+    scatter[scatter == 0] = 1e-4
+    
+    pos = theta_map+scatter*np.random.normal(size=(nwalkers,len(theta_map)))
+    
+    positive_idx = np.setdiff1d(np.arange(len(theta_map)),isrf_idx)
+    
+    if method == 'ascfree':
+        positive_idx = np.setdiff1d(positive_idx,[1])
+        pos[:,1] = np.clip(pos[:,1],2,7)
+        
+    pos[:,positive_idx] = np.abs(pos[:,positive_idx])
+    pos[:,isrf_idx] = np.sort(np.clip(pos[:,isrf_idx],-2,7),axis=1)
+    
+    return pos
+
+#MARGINALISATION FUNCTIONS
+
+def nonlinear_index(method,
+                    components):
+    
+    #Positions in theta of the parameters that enter the model non-linearly,
+    #i.e. alpha_sCM20 (for ascfree) and the ISRF strength of each component
+    
+    if method == 'default':
+        isrf_idx = 1+2*np.arange(components)
+    else:
+        isrf_idx = {'abundfree':1,
+                    'ascfree':2}[method]+5*np.arange(components)
+        
+    if method == 'ascfree':
+        return np.append(1,isrf_idx)
+    
+    return isrf_idx
+
+def unpack_phi(phis,
+               method):
+    
+    #Split the non-linear parameters into alpha_sCM20 and the
+    #(components x nwalkers) ISRF strengths
+    
+    if method == 'ascfree':
+        return phis[:,0],phis[:,1:].T
+    
+    return np.full(len(phis),5.0),phis.T
+
+def solve_amplitudes(phis,
+                     method,
+                     components,
+                     obs_flux,
+                     stars_flux):
+    
+    #For each set of non-linear parameters, solve for the linear amplitudes
+    #(stars, then grains for each component) under the covariance. Use the
+    #normal equations for every walker at once, and fall back to
+    #non-negative least squares (for all of those walkers at once) for any
+    #with a negative amplitude.
+    #omega_star is ~1 while the dust scalings are ~1e21, so the design
+    #columns are scaled to unit norm first. fisher is the Fisher matrix for
+    #the scaled amplitudes (amplitudes*scale)
+    
+    alpha,isrf = unpack_phi(phis,
+                            method)
+    
+    design = linear_design(alpha,
+                           isrf,
+                           method,
+                           stars_flux)
+    
+    whitened_design = np.matmul(whitening,design)
+    whitened_flux = whitening.dot(obs_flux)
+    
+    scale = np.linalg.norm(whitened_design,axis=1)
+    scale[scale == 0] = 1
+    
+    scaled_design = whitened_design/scale[:,np.newaxis,:]
+    
+    fisher = np.matmul(scaled_design.transpose(0,2,1),scaled_design)
+    projection = np.matmul(scaled_design.transpose(0,2,1),whitened_flux)
+    
+    #Where the design is rank deficient (e.g. two components rounded to the
+    #same grid point, so their columns are identical) there's no unique
+    #best fit and the Laplace approximation doesn't hold. Rule these walkers
+    #out (chi^2 = inf) rather than let the singular solve take down the
+    #whole block. Same tolerance as np.linalg.matrix_rank
+    
+    eigenvalues = np.linalg.eigvalsh(fisher)
+    degenerate = eigenvalues[:,0] <= eigenvalues[:,-1]*fisher.shape[1]*np.finfo(float).eps
+    
+    fisher[degenerate] = np.identity(fisher.shape[1])
+    projection[degenerate] = 0
+    
+    amplitudes_mean = np.linalg.solve(fisher,projection[:,:,np.newaxis])[:,:,0]/scale
+    amplitudes = amplitudes_mean.copy()
+    
+    negative = np.any(amplitudes < 0,axis=1)
+    
+    if np.any(negative):
+        
+        amplitudes[negative] = general.batch_nnls(fisher[negative],
+                                                  projection[negative])/scale[negative]
         
-            isrf = theta[5*component+2]
-            y_sCM20 = theta[5*component+3]
-            y_lCM20 = theta[5*component+4]
-            y_aSilM5 = theta[5*component+5]
-            dust_scaling = theta[5*component+6]   
+    residual = np.matmul(whitened_design,amplitudes[:,:,np.newaxis])[:,:,0]-whitened_flux
+    chisq = np.sum(residual**2,axis=1)
+    chisq[degenerate] = np.inf
+    
+    return amplitudes,amplitudes_mean,fisher,scale,chisq
+
+def lnprob_marginal(phis,
+                    method,
+                    components,
+                    obs_flux,
+                    stars_flux):
+    
+    #Log-probability with the linear amplitudes marginalised over, using
+    #the Laplace approximation about the constrained (non-negative) best fit.
+    #This is -chi^2/2 at the best fit, minus half the log-determinant of the
+    #Fisher matrix for the amplitudes (put back together from the scaled one,
+    #which keeps slogdet well-conditioned). The Fisher matrix is the
+    #unconstrained one even where the best fit has amplitudes pinned at zero:
+    #the curvature of chi^2 doesn't depend on where the best fit is, and the
+    #part of the Gaussian cut off by the non-negativity prior is ignored
+    
+    phis = np.atleast_2d(phis)
+    
+    alpha,isrf = unpack_phi(phis,
+                            method)
+    
+    allowed = np.full(len(phis),0<=z<=15)
+    
+    allowed &= (2<=alpha) & (alpha<=7)
+    
+    for component in range(components):
+        
+        allowed &= (-2<=isrf[component]) & (isrf[component]<=7)
+        
+        if component > 0:
             
-            if not -2<=isrf<=7 or not dust_scaling>=0\
-                or not y_sCM20>=0 or not y_lCM20>=0\
-                or not y_aSilM5>=0:
-                return -np.inf 
+            allowed &= isrf[component]>=isrf[component-1]
             
-            if component > 0:
+    probability = np.full(len(phis),-np.inf)
+    
+    if np.any(allowed):
+        
+        _,_,fisher,scale,chisq = solve_amplitudes(phis[allowed],
+                                                  method,
+                                                  components,
+                                                  obs_flux,
+                                                  stars_flux)
+        
+        log_det = np.linalg.slogdet(fisher)[1]+2*np.sum(np.log(scale),axis=1)
+        
+        probability[allowed] = -0.5*chisq-0.5*log_det
+        
+    return probability
+
+def draw_amplitudes(phis,
+                    galaxy_state,
+                    max_draws=100):
+    
+    #For each sample of the non-linear parameters, draw the linear amplitudes
+    #from their (Gaussian) conditional posterior, truncated to be
+    #non-negative by rejection. If that keeps failing, fall back to the
+    #non-negative least squares solution. Then turn it all back into the
+    #full set of parameters. The draws are made in whitened coordinates
+    #(amplitude = mean + L^-T x, with L L^T the Fisher matrix and x ~ N(0,1)),
+    #since the amplitudes' scales differ by ~1e21 and a covariance matrix
+    #for them loses the small-variance directions
+    
+    method = galaxy_state['method']
+    
+    load_galaxy_state(galaxy_state)
+    
+    alpha,isrf = unpack_phi(phis,
+                            method)
+    
+    amplitudes,\
+        amplitudes_mean,\
+        fisher,\
+        scale,\
+        _ = solve_amplitudes(phis,
+                             method,
+                             galaxy_state['components'],
+                             galaxy_state['obs_flux'],
+                             galaxy_state['stars_flux'])
+        
+    thetas = []
+    
+    for i in range(len(phis)):
+        
+        fisher_cholesky = cholesky(fisher[i],lower=True)
+        
+        offsets = solve_triangular(fisher_cholesky.T,
+                                   np.random.normal(size=(len(scale[i]),max_draws)),
+                                   lower=False)
+        
+        draws = amplitudes_mean[i]+offsets.T/scale[i]
+        
+        positive = np.where(np.all(draws >= 0,axis=1))[0]
+        
+        if len(positive) > 0:
+            amplitudes[i] = draws[positive[0]]
             
-                if not isrf>=theta[5*(component-1)+2]:
-                    return -np.inf
-                
-    return 0.0
+        thetas.append(amplitudes_to_theta(amplitudes[i],
+                                          alpha[i],
+                                          isrf[:,i],
+                                          method))
+        
+    return np.array(thetas)
+
+#EMCEE-RELATED FUNCTIONS
+
+def init_worker(grid_dir):
+    
+    #Each worker memory-maps the model grid once, and then only needs a
+    #small galaxy state with each block of walkers
+    
+    global model_grid
+    model_grid = general.read_model_grid(grid_dir)
+    
+def chunk_affinity(theta,
+                   galaxy_state):
+    
+    #Blocks of walkers with the same redshift and filters share band fluxes,
+    #so the scheduler tries to keep them on the same workers
+    
+    return (galaxy_state['z'],tuple(galaxy_state['keys']))
+
+def set_band_fluxes(redshift,
+                    filter_keys):
+    
+    #Build the filter response matrix and band flux cube for this redshift
+    #and set of filters. Pixel catalogues share these between rows, so only
+    #rebuild them when they change
+    
+    global band_flux_key,response,band_fluxes,alpha_axis,isrf_axis
+    
+    if globals().get('band_flux_key') == (redshift,tuple(filter_keys)):
+        return
+    
+    response = general.filter_response(model_grid['wavelength']*(1+redshift),
+                                       general.read_filters(filter_keys),
+                                       filter_keys)
+    
+    band_fluxes = general.band_flux_grid(response,
+                                         model_grid)
+    
+    alpha_axis = model_grid['alpha']
+    isrf_axis = model_grid['logU']
+    
+    band_flux_key = (redshift,tuple(filter_keys))
+    
+def grain_band_fluxes(alpha,
+                      isrf):
+    
+    #Band fluxes of each grain type for this alpha_sCM20 and ISRF strength,
+    #either interpolated between grid points or rounded to the nearest one
+    
+    if interpolate:
+        
+        return general.interpolate_grid(band_fluxes,
+                                        alpha,
+                                        isrf,
+                                        alpha_axis,
+                                        isrf_axis)
+    
+    return band_fluxes[general.grid_index(alpha,alpha_axis),
+                       general.grid_index(isrf,isrf_axis)]
 
-def lnlike(theta,
+def load_galaxy_state(galaxy_state):
+    
+    global z,cov_cholesky,interpolate,whitening,whitening_cholesky
+    
+    z = galaxy_state['z']
+    cov_cholesky = galaxy_state['cov_cholesky']
+    interpolate = galaxy_state.get('interpolate',False)
+    
+    set_band_fluxes(galaxy_state['z'],
+                    galaxy_state['keys'])
+    
+    #L^-1, for whitening the design matrices in marginalised mode. Like the
+    #band fluxes, keep it until the covariance changes (a new galaxy), rather
+    #than rebuilding it for every block of walkers
+    
+    if not np.array_equal(globals().get('whitening_cholesky'),cov_cholesky):
+        
+        whitening = solve_triangular(cov_cholesky,
+                                     np.identity(len(cov_cholesky)),
+                                     lower=True)
+        
+        whitening_cholesky = cov_cholesky
+    
+def evaluate_chunk(theta,
+                   galaxy_state):
+    
+    load_galaxy_state(galaxy_state)
+    
+    if galaxy_state.get('marginalise',False):
+        
+        return lnprob_marginal(theta,
+                               galaxy_state['method'],
+                               galaxy_state['components'],
+                               galaxy_state['obs_flux'],
+                               galaxy_state['stars_flux'])
+    
+    return lnprob(theta,
+                  galaxy_state['method'],
+                  galaxy_state['components'],
+                  galaxy_state['obs_flux'],
+                  galaxy_state['stars_flux'])
+
+def lnprob_chunked(theta,
+                   galaxy_state,
+                   pool=None,
+                   chunks=1):
+    
+    #emcee (in vectorize mode) hands us the whole ensemble at once. Split
+    #this into blocks of walkers so each pool task evaluates a block in one
+    #NumPy pass, rather than pickling every walker over separately
+    
+    if pool is None or chunks == 1:
+        return evaluate_chunk(theta,
+                              galaxy_state)
+    
+    theta_chunks = np.array_split(theta,chunks)
+    
+    results = pool.starmap(evaluate_chunk,
+                           [(theta_chunk,
+                             galaxy_state) for theta_chunk in theta_chunks])
+    
+    return np.concatenate(results)
+
+def lnprob(theta,
            method,
            components,
            obs_flux,
-           stars):
+           stars_flux):
+    
+    #theta can either be a single set of parameters or an (nwalkers x ndim)
+    #array, in which case we return a log-probability for each walker
+    
+    thetas = np.atleast_2d(theta)
+    
+    lp = priors(thetas,
+                method,
+                components)
+    
+    probability = np.full(len(thetas),-np.inf)
+    
+    valid = np.isfinite(lp)
+    
+    if np.any(valid):
+        probability[valid] = lp[valid] + lnlike(thetas[valid],
+                                                method,
+                                                components,
+                                                obs_flux,
+                                                stars_flux)
+        
+    if np.ndim(theta) == 1:
+        probability = probability[0]
+    
+    return probability
 
-    global z
+def unpack_theta(thetas,
+                 method,
+                 components):
     
-    omega_star = theta[0]
+    #Pull out the parameters for each walker. The ISRF strength and
+    #scalings come out as (components x nwalkers) arrays
+    
+    omega_star = thetas[:,0]
     
     if method == 'ascfree':
         
-        alpha = theta[1]
+        alpha = thetas[:,1]
+        
+    else:
+        
+        alpha = np.full(len(thetas),5.0)
+        
+    if method == 'default':
+        
+        isrf = thetas[:,1::2].T
+        dust_scaling = thetas[:,2::2].T
+        
+        y_sCM20 = np.ones(isrf.shape)
+        y_lCM20 = np.ones(isrf.shape)
+        y_aSilM5 = np.ones(isrf.shape)
+        
+    if method in ['abundfree','ascfree']:
+        
+        #ascfree has alpha_sCM20 as an extra parameter before the components
+        
+        offset = {'abundfree':1,
+                  'ascfree':2}[method]
+        
+        isrf = thetas[:,offset::5].T
+        y_sCM20 = thetas[:,offset+1::5].T
+        y_lCM20 = thetas[:,offset+2::5].T
+        y_aSilM5 = thetas[:,offset+3::5].T
+        dust_scaling = thetas[:,offset+4::5].T
+        
+    return omega_star,alpha,isrf,y_sCM20,y_lCM20,y_aSilM5,dust_scaling
     
-    for component in range(components):
+def priors(thetas,
+           method,
+           components):
     
-        if method == 'default':
-            
-            isrf = theta[2*component+1]
-            dust_scaling = theta[2*component+2]
-                
-            y_sCM20 = 1
-            y_lCM20 = 1
-            y_aSilM5 = 1    
-            alpha = 5
-            
-        if method == 'abundfree':
-            
-            isrf = theta[5*component+1]
-            y_sCM20 = theta[5*component+2]
-            y_lCM20 = theta[5*component+3]
-            y_aSilM5 = theta[5*component+4]
-            dust_scaling = theta[5*component+5]
-                
-            alpha = 5
+    #log_ISRF must be between -2 and 7.
+    #alpha_sCM20 must be between 2 and 7.
+    #Multiplicative factors must be greater than 0.
+    #Redshift must be between 0 and 15.
+    
+    #Also insist that each component increases in ISRF
+    #strength
+
+    global z
+    
+    omega_star,\
+        alpha,\
+        isrf,\
+        y_sCM20,\
+        y_lCM20,\
+        y_aSilM5,\
+        dust_scaling = unpack_theta(thetas,
+                                    method,
+                                    components)
+    
+    allowed = np.full(len(thetas),0<=z<=15)
+    
+    allowed &= omega_star>=0
+    allowed &= (2<=alpha) & (alpha<=7)
+    
+    for component in range(components):
         
-        if method == 'ascfree':
+        allowed &= (-2<=isrf[component]) & (isrf[component]<=7)
+        allowed &= dust_scaling[component]>=0
+        allowed &= y_sCM20[component]>=0
+        allowed &= y_lCM20[component]>=0
+        allowed &= y_aSilM5[component]>=0
         
-            isrf = theta[5*component+2]
-            y_sCM20 = theta[5*component+3]
-            y_lCM20 = theta[5*component+4]
-            y_aSilM5 = theta[5*component+5]
-            dust_scaling = theta[5*component+6]
-            
-        small_grains,\
-            large_grains,\
-            silicates = general.read_sed(isrf,
-                                         alpha,
-                                         sCM20_df,
-                                         lCM20_df,
-                                         aSilM5_df) 
-            
-        if component == 0:
-            
-            total = dust_scaling*y_sCM20*small_grains+\
-                        dust_scaling*y_lCM20*large_grains+\
-                        dust_scaling*y_aSilM5*silicates
-                    
-        else:
+        if component > 0:
+            
+            allowed &= isrf[component]>=isrf[component-1]
             
-            total += dust_scaling*y_sCM20*small_grains+\
-                        dust_scaling*y_lCM20*large_grains+\
-                        dust_scaling*y_aSilM5*silicates 
+    return np.where(allowed,0.0,-np.inf)
+
+def lnlike(thetas,
+           method,
+           components,
+           obs_flux,
+           stars_flux):
+    
+    omega_star,\
+        alpha,\
+        isrf,\
+        y_sCM20,\
+        y_lCM20,\
+        y_aSilM5,\
+        dust_scaling = unpack_theta(thetas,
+                                    method,
+                                    components)
     
     #Include stars
     
-    total += omega_star*stars
+    total = omega_star[:,np.newaxis]*stars_flux
+    
+    for component in range(components):
+        
+        #Look up the pre-convolved band fluxes for this combination
+        #of ISRF strength and alpha
+        
+        grains = grain_band_fluxes(alpha,
+                                   isrf[component])
+        
+        small_grains = grains[:,0,:]
+        large_grains = grains[:,1,:]
+        silicates = grains[:,2,:]
+        
+        total += dust_scaling[component][:,np.newaxis]*( y_sCM20[component][:,np.newaxis]*small_grains+\
+                                                         y_lCM20[component][:,np.newaxis]*large_grains+\
+                                                         y_aSilM5[component][:,np.newaxis]*silicates )
             
-    filter_fluxes = filter_convolve(total,
-                                    z)
+    filter_fluxes = np.abs(total)
     
-    flux_diff = (filter_fluxes-obs_flux)[np.newaxis]
+    flux_diff = filter_fluxes-obs_flux
     
-    chisq = covariance_matrix(flux_diff,total_err,flux_diff.T)
+    chisq = general.calculate_chisq(flux_diff,cov_cholesky)
     
     likelihood = -0.5*chisq
     
     return likelihood
-
-def filter_convolve(flux,
-                    z):
-    
-    #Convolve this SED with the various filters we have to give
-    #a monochromatic flux
-    
-    #Account for redshift
-    
-    wavelength_redshifted = wavelength * (1+z)
-    
-    filter_fluxes = [np.abs( (trapz(filter_dict[key][1]*np.interp(filter_dict[key][0],
-                                                                  wavelength_redshifted,
-                                                                  flux),\
-                                    filter_dict[key][0])/
-                                    trapz(filter_dict[key][1],filter_dict[key][0])) ) for key in keys]
-    
-    return np.array(filter_fluxes)
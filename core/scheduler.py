@@ -0,0 +1,691 @@
+# -*- coding: utf-8 -*-
+"""
+Galaxy and walker scheduler for THEMCMC
+
+@author: Tom Williams
+
+v1.00.
+"""
+
+#Ensure python3 compatibility
+from __future__ import absolute_import, print_function, division
+
+import numpy as np
+import os
+import socket
+import time
+import traceback
+from collections import deque
+import multiprocessing
+from multiprocessing import cpu_count
+from multiprocessing.connection import wait
+
+#THEMCMC imports
+
+import memory
+
+#One set of workers runs both levels of work. A worker takes a galaxy and
+#drives its sampler; every step, the sampler splits its walkers into blocks
+#and hands them back to the scheduler. Any worker without a galaxy, or
+#waiting on its own blocks, picks up blocks -- its own galaxy's first, then
+#galaxies it already has the band fluxes for, then anything. So once a
+#galaxy is done, its worker helps out with the ones still running rather
+#than sitting idle
+
+#Environment variables the BLAS/LAPACK and OpenMP runtimes read for their
+#thread counts
+
+thread_variables = ['OMP_NUM_THREADS',
+                    'OPENBLAS_NUM_THREADS',
+                    'MKL_NUM_THREADS',
+                    'VECLIB_MAXIMUM_THREADS',
+                    'NUMEXPR_NUM_THREADS']
+
+def available_cores():
+    
+    #Cores this process is allowed to run on (all of them under
+    #mpirun --bind-to none)
+    
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return cpu_count()
+
+def thread_budget(n_workers,
+                  n_cores=None):
+    
+    #Share the cores out between the workers on a node, so NumPy's BLAS and
+    #the LAPACK in fortran_funcs don't each start a thread per core in every
+    #worker and oversubscribe the machine
+    
+    if n_cores is None:
+        n_cores = available_cores()
+    
+    return max(1,n_cores//max(n_workers,1))
+
+def limit_threads(n_threads):
+    
+    #Set the thread count for anything that starts up later through the
+    #environment, and for libraries that are already loaded through
+    #threadpoolctl (if it's installed). Returns the libraries it limited
+    
+    global thread_limiter
+    
+    for variable in thread_variables:
+        os.environ[variable] = str(n_threads)
+    
+    try:
+        from threadpoolctl import threadpool_limits, threadpool_info
+    except ImportError:
+        return []
+    
+    thread_limiter = threadpool_limits(limits=n_threads)
+    
+    return [info['internal_api']+' ('+str(info['num_threads'])+')' for info in threadpool_info()]
+
+class MemoryPlanner(object):
+    
+    #Decides how many workers each node runs at once, from the memory they
+    #actually use. Until a worker on a node has got through a step of its
+    #galaxy's sampler (the calibration run), only that one is active. After
+    #that, each node runs as many as fit under its ceiling, counting the
+    #pages the workers share (the memory-mapped grid and the libraries)
+    #once. The workers keep reporting in, so if memory gets tight the plan
+    #shrinks, and if it frees up parked workers are brought back. Active
+    #workers share the node's cores for their BLAS/OpenMP threads
+    
+    def __init__(self,
+                 ceiling=None,
+                 headroom=0.9,
+                 n_threads=None,
+                 interval=10):
+        
+        #ceiling: memory (bytes) the workers on each node can use between
+        #them. None to use whatever's free, less a margin (headroom)
+        
+        self.ceiling = ceiling
+        self.headroom = headroom
+        self.n_threads = n_threads
+        self.interval = interval
+        self.reports = {}
+        self.layout = None
+    
+    def report(self,
+               worker,
+               usage):
+        
+        #Keep the peak, since a galaxy's memory goes up and down as it runs
+        
+        usage['peak'] = usage['private']
+        
+        if worker in self.reports:
+            usage['peak'] = max(usage['peak'],self.reports[worker]['peak'])
+        
+        self.reports[worker] = usage
+    
+    def replan(self,
+               retired,
+               used):
+        
+        #Threads for each active worker. Workers that have already been
+        #given work stay active first, so parking the rest frees the most
+        
+        hosts = {}
+        
+        for worker in self.reports:
+            if worker not in retired:
+                hosts.setdefault(self.reports[worker]['host'],[]).append(worker)
+        
+        active = {}
+        layout = []
+        summary = []
+        
+        for host in sorted(hosts):
+            
+            workers = sorted(hosts[host],key=lambda worker: (worker not in used,worker))
+            reports = [self.reports[worker] for worker in workers]
+            
+            shared = max([report['shared'] for report in reports])
+            available = max(reports,key=lambda report: report['time'])['available']
+            calibrated = [report['peak'] for report in reports if report['calibrated']]
+            
+            #Memory already held by these workers is theirs to keep using
+            
+            budget = sum([report['private'] for report in reports])+shared+self.headroom*available
+            
+            if self.ceiling is not None:
+                budget = min(budget,self.ceiling)
+            
+            n_active = 1
+            per_worker = 0
+            
+            if len(calibrated) > 0:
+                
+                per_worker = max([report['peak'] for report in reports])
+                n_active = int((budget-shared)//max(per_worker,1))
+                n_active = min(max(n_active,1),len(workers))
+            
+            n_threads = self.n_threads
+            
+            if n_threads is None:
+                n_threads = thread_budget(n_active,reports[0]['cores'])
+            
+            for worker in workers[:n_active]:
+                active[worker] = n_threads
+            
+            layout.append((host,n_active,n_threads))
+            summary.append('%s: %d of %d workers x %d threads (%.2f GB each, %.2f GB shared, %.2f GB free)' % \
+                           (host,n_active,len(workers),n_threads,per_worker/1e9,shared/1e9,available/1e9))
+        
+        #Only say so when the layout changes, not every time the numbers
+        #move a little or another worker reports in
+        
+        if layout != self.layout:
+            
+            self.layout = layout
+            print('Memory plan:\n'+'\n'.join(summary))
+        
+        return active
+
+class LocalBackend(object):
+    
+    #Worker processes on this machine, each with a pipe to the scheduler
+    #(which runs in this process and sits idle, so doesn't count towards the
+    #thread budget). The workers are always forked, whatever the platform's
+    #default start method: they rely on inheriting master_themcmc's globals
+    #(args, flux_df, the model grid), which spawn or forkserver would start
+    #them without
+    
+    def __init__(self,
+                 n_workers,
+                 n_threads=None):
+        
+        self.n_workers = n_workers
+        self.is_master = True
+        
+        if n_threads is None:
+            n_threads = thread_budget(n_workers)
+        
+        self.n_threads = n_threads
+        self.layout = {socket.gethostname():[n_workers,n_threads,available_cores()]}
+    
+    def start(self,
+              target,
+              kwargs=None):
+        
+        #Run target(conn,**kwargs) in each worker
+        
+        if kwargs is None:
+            kwargs = {}
+        
+        context = multiprocessing.get_context('fork')
+        
+        self.conns = []
+        self.processes = []
+        self.listening = []
+        
+        for i in range(self.n_workers):
+            
+            master_conn,worker_conn = context.Pipe()
+            
+            process = context.Process(target=target,
+                                      args=(worker_conn,),
+                                      kwargs=kwargs)
+            process.start()
+            
+            self.conns.append(master_conn)
+            self.processes.append(process)
+            self.listening.append(master_conn)
+    
+    def send(self,
+             worker,
+             message):
+        
+        self.conns[worker].send(message)
+        
+        #A stopped worker closes its end of the pipe once it exits, so stop
+        #listening to it
+        
+        if message[0] == 'stop':
+            self.listening.remove(self.conns[worker])
+    
+    def recv(self):
+        
+        conn = wait(self.listening)[0]
+        
+        return self.conns.index(conn),conn.recv()
+    
+    def stop(self):
+        
+        for process in self.processes:
+            process.join()
+    
+    def abort(self):
+        
+        for process in self.processes:
+            process.terminate()
+
+class MPILink(object):
+    
+    #A worker rank's connection to the scheduler on rank 0
+    
+    def __init__(self,
+                 comm):
+        
+        self.comm = comm
+    
+    def send(self,
+             message):
+        
+        self.comm.send(message,dest=0)
+    
+    def recv(self):
+        
+        return self.comm.recv(source=0)
+
+class MPIBackend(object):
+    
+    #Rank 0 schedules, and every other rank is a worker
+    
+    def __init__(self,
+                 n_threads=None):
+        
+        from mpi4py import MPI
+        
+        self.MPI = MPI
+        self.comm = MPI.COMM_WORLD
+        self.n_workers = self.comm.Get_size()-1
+        self.is_master = self.comm.Get_rank() == 0
+        
+        if self.n_workers < 1:
+            raise Exception('MPI needs at least 2 processes (a scheduler and a worker)')
+        
+        #The thread budget is per node, shared between the workers on it
+        #(the scheduler rank sits idle)
+        
+        node_comm = self.comm.Split_type(MPI.COMM_TYPE_SHARED)
+        
+        node_workers = node_comm.Get_size()-node_comm.allreduce(int(self.is_master))
+        
+        if n_threads is None:
+            n_threads = thread_budget(node_workers)
+        
+        self.n_threads = n_threads
+        
+        layout = self.comm.gather((socket.gethostname(),
+                                   node_workers,
+                                   n_threads,
+                                   available_cores()),root=0)
+        
+        if self.is_master:
+            self.layout = dict((host,[workers,threads,cores]) for host,workers,threads,cores in layout)
+    
+    def start(self,
+              target,
+              kwargs=None):
+        
+        #The workers are already running
+        
+        pass
+    
+    def link(self):
+        
+        return MPILink(self.comm)
+    
+    def send(self,
+             worker,
+             message):
+        
+        self.comm.send(message,dest=worker+1)
+    
+    def recv(self):
+        
+        status = self.MPI.Status()
+        
+        message = self.comm.recv(source=self.MPI.ANY_SOURCE,
+                                 status=status)
+        
+        return status.Get_source()-1,message
+    
+    def stop(self):
+        
+        pass
+    
+    def abort(self):
+        
+        self.comm.Abort(1)
+
+class SchedulerPool(object):
+    
+    #Stands in for a multiprocessing pool in the sampler. starmap sends the
+    #blocks of walkers to the scheduler and, while they're out, works
+    #through blocks itself (from this galaxy or any other)
+    
+    def __init__(self,
+                 link,
+                 affinity=None,
+                 report_interval=None):
+        
+        self.link = link
+        self.affinity = affinity
+        self.report_interval = report_interval
+        self.last_report = -np.inf
+        self.calibrated = False
+    
+    def request(self):
+        
+        #Ask the scheduler for work, every so often saying how much memory
+        #this process uses so it can re-plan
+        
+        usage = None
+        
+        if self.report_interval is not None and \
+            time.time()-self.last_report > self.report_interval:
+            
+            usage = memory.process_memory()
+            usage.update({'host':socket.gethostname(),
+                          'cores':available_cores(),
+                          'available':memory.available_memory(),
+                          'calibrated':self.calibrated,
+                          'time':time.time()})
+            
+            self.last_report = time.time()
+        
+        self.link.send(('request',usage))
+        
+        return self.link.recv()
+    
+    def starmap(self,
+                func,
+                iterable):
+        
+        calls = [(func,tuple(args)) for args in iterable]
+        
+        key = None
+        
+        if self.affinity is not None:
+            key = self.affinity(*calls[0][1])
+        
+        self.link.send(('submit',(key,calls)))
+        
+        while True:
+            
+            kind,payload = self.request()
+            
+            if kind == 'results':
+                
+                #A step of the sampler has been through, so it holds all the
+                #memory it's going to. Report it straight away
+                
+                if not self.calibrated:
+                    self.calibrated = True
+                    self.last_report = -np.inf
+                
+                return payload
+            
+            if kind == 'chunk':
+                self.evaluate(payload)
+            
+            if kind == 'threads':
+                limit_threads(payload)
+            
+            if kind == 'stop':
+                raise Exception('Scheduler stopped while waiting for walkers')
+    
+    def evaluate(self,
+                 chunk):
+        
+        driver,idx,func,args = chunk
+        
+        self.link.send(('result',(driver,idx,func(*args))))
+
+def worker_loop(link,
+                run_task,
+                affinity=None,
+                n_threads=None,
+                report_interval=None):
+    
+    if n_threads is not None:
+        limit_threads(n_threads)
+    
+    pool = SchedulerPool(link,
+                         affinity=affinity,
+                         report_interval=report_interval)
+    
+    while True:
+        
+        kind,payload = pool.request()
+        
+        if kind == 'stop':
+            return
+        
+        if kind == 'threads':
+            limit_threads(payload)
+        
+        try:
+            
+            if kind == 'task':
+                
+                run_task(payload,
+                         pool)
+                link.send(('done',payload))
+            
+            if kind == 'chunk':
+                pool.evaluate(payload)
+        
+        except Exception:
+            
+            link.send(('error',traceback.format_exc()))
+            return
+
+def schedule(backend,
+             tasks,
+             max_active=None,
+             planner=None):
+    
+    #Hand out galaxies (tasks) and blocks of walkers (chunks) as workers ask
+    #for work. Workers with nothing suitable to do wait until there is. With
+    #a planner, only the workers it has room for get work; the rest are
+    #parked, or shut down if they've been used (to give their memory back)
+    
+    if max_active is None:
+        max_active = backend.n_workers
+    
+    tasks = deque(tasks)
+    chunks = []
+    pending = {}
+    driving = {}
+    last_key = {}
+    waiting = []
+    n_running = backend.n_workers
+    
+    active = None
+    used = set()
+    retired = set()
+    threads = {}
+    
+    def pick_chunk(worker,
+                   match):
+        
+        for i,chunk in enumerate(chunks):
+            if match(chunk):
+                return chunks.pop(i)
+        
+        return None
+    
+    def dispatch(worker):
+        
+        #A galaxy waiting on its blocks gets its results as soon as they're
+        #all in, and works through its own blocks first. Otherwise, start a
+        #new galaxy if there are any left, then help out with blocks that use
+        #the same band fluxes (so they don't need rebuilding), then anything
+        
+        if worker in pending and pending[worker][1] == 0:
+            return ('results',pending.pop(worker)[0])
+        
+        chunk = pick_chunk(worker,
+                           lambda chunk: chunk[0] == worker)
+        
+        if chunk is None and active is not None and worker not in active:
+            
+            if worker in driving:
+                return None
+            
+            if worker in used or (len(tasks) == 0 and len(driving) == 0):
+                
+                retired.add(worker)
+                
+                return ('stop',None)
+            
+            return None
+        
+        if chunk is None and active is not None and threads.get(worker) != active[worker]:
+            
+            threads[worker] = active[worker]
+            
+            return ('threads',active[worker])
+        
+        if chunk is None and worker not in driving and len(tasks) > 0 and \
+            len(driving) < max_active:
+            
+            driving[worker] = tasks.popleft()
+            used.add(worker)
+            
+            return ('task',driving[worker])
+        
+        if chunk is None:
+            chunk = pick_chunk(worker,
+                               lambda chunk: chunk[4] == last_key.get(worker))
+        
+        if chunk is None and len(chunks) > 0:
+            chunk = chunks.pop(0)
+        
+        if chunk is not None:
+            
+            last_key[worker] = chunk[4]
+            used.add(worker)
+            
+            return ('chunk',chunk[:4])
+        
+        if worker not in driving and len(tasks) == 0 and len(driving) == 0:
+            return ('stop',None)
+        
+        return None
+    
+    while n_running > 0:
+        
+        worker,(kind,payload) = backend.recv()
+        
+        if kind == 'request':
+            
+            waiting.append(worker)
+            
+            if planner is not None and payload is not None:
+                
+                planner.report(worker,
+                               payload)
+                
+                active = planner.replan(retired,
+                                        used)
+        
+        elif kind == 'submit':
+            
+            key,calls = payload
+            
+            pending[worker] = [[None]*len(calls),len(calls)]
+            last_key[worker] = key
+            
+            chunks.extend([(worker,i,func,args,key) for i,(func,args) in enumerate(calls)])
+        
+        elif kind == 'result':
+            
+            driver,idx,value = payload
+            
+            pending[driver][0][idx] = value
+            pending[driver][1] -= 1
+        
+        elif kind == 'done':
+            
+            del driving[worker]
+        
+        elif kind == 'error':
+            
+            #Stop everything, as a failed galaxy would have done before
+            
+            raise Exception('Worker '+str(worker)+' failed:\n'+payload)
+        
+        still_waiting = []
+        
+        for other in waiting:
+            
+            reply = dispatch(other)
+            
+            if reply is None:
+                
+                still_waiting.append(other)
+                continue
+            
+            backend.send(other,reply)
+            
+            if reply[0] == 'stop':
+                n_running -= 1
+        
+        waiting = still_waiting
+
+def describe_layout(backend):
+    
+    #One line per node: workers, threads each, and cores
+    
+    lines = []
+    
+    for host in sorted(backend.layout):
+        
+        workers,threads,cores = backend.layout[host]
+        
+        lines.append('%s: %d workers x %d threads on %d cores' % (host,workers,threads,cores))
+    
+    return '\n'.join(lines)
+
+def run_tasks(tasks,
+              run_task,
+              backend,
+              max_active=None,
+              affinity=None,
+              planner=None):
+    
+    #Run run_task(task,pool) for every task. Call this from every process
+    #(every MPI rank): the master schedules, and the workers do the work
+    
+    report_interval = None
+    
+    if planner is not None:
+        report_interval = planner.interval
+    
+    settings = {'run_task':run_task,
+                'affinity':affinity,
+                'n_threads':backend.n_threads,
+                'report_interval':report_interval}
+    
+    if backend.is_master:
+        
+        backend.start(worker_loop,
+                      settings)
+        
+        try:
+            
+            schedule(backend,
+                     tasks,
+                     max_active=max_active,
+                     planner=planner)
+        
+        except BaseException:
+            
+            backend.abort()
+            raise
+        
+        backend.stop()
+    
+    else:
+        
+        worker_loop(backend.link(),
+                    **settings)
@@ -7,70 +7,218 @@ Compress each dust component
 #Ensure python3 compatibility
 from __future__ import absolute_import, print_function, division
 
-import pandas as pd
 import os
+import sys
 import glob
+import time
 import numpy as np
-from tqdm import tqdm
+from multiprocessing import Pool, cpu_count
 
 os.chdir(os.getcwd())
 
-#First, create the names
+sys.path.append('../core')
+import general
 
-res_names = glob.glob('grid/*.RES')
+#Optionally also write a low-rank version of the grid (basis spectra plus
+#coefficients), reproducing every model to within this fractional tolerance
 
-wavelength = np.loadtxt(res_names[0],
-                        unpack=True,
-                        skiprows=8,
-                        usecols=(0))
+compress = False
+tolerance = 1e-3
 
-names = []
+#Number of RES files each worker parses at a time, and how many get written
+#to the grid between flushes
 
-for res_name in res_names:
-    
-    res_name = res_name.split('/')[1].split('.RES')[0]
-    columns = res_name.split('_')
-    names.append('alpha_sCM20:'+columns[1]+',logU:'+columns[2])
-        
-#Set up a pandas DataFrame for each component (small- and large-carbons,
-#and silicates), and save wavelength separately
+chunk_size = 500
 
-frequency = 3e8/(wavelength*1e-6)
+grid_dir = '../core/models'
 
-wavelength_df = pd.DataFrame(columns=['wavelength'],data=wavelength)
+def read_res(res_name):
+    
+    #Much quicker than np.loadtxt. Skip the 8 header lines, then pull out
+    #the wavelength and the sCM20, lCM20, and pyroxine and olivine columns
+    
+    with open(res_name,'r') as res_file:
+        lines = res_file.readlines()[8:]
+    
+    n_cols = len(lines[0].split())
+    
+    data = np.array(''.join(lines).split(),dtype=float).reshape(-1,n_cols)
+    
+    return data[:,0],data[:,1],data[:,2],data[:,3]+data[:,4]
 
-sCM20_df = pd.DataFrame(columns=names,data=np.zeros([len(wavelength),len(names)]))
-lCM20_df = pd.DataFrame(columns=names,data=np.zeros([len(wavelength),len(names)]))
-aSilM5_df = pd.DataFrame(columns=names,data=np.zeros([len(wavelength),len(names)]))
+def read_bin(bin_name):
+    
+    #DustEM output with the BINARY keyword. An 8 byte tag and the number of
+    #grain types and wavelengths, then the wavelength and each grain type's
+    #SED as float64 blocks, so no parsing needed
+    
+    with open(bin_name,'rb') as bin_file:
+        
+        if bin_file.read(8) != b'DUSTEMSB':
+            raise Exception(bin_name+' is not a binary DustEM SED')
+        
+        n_type,n_wave = np.frombuffer(bin_file.read(8),dtype='<i4')
+        
+        data = np.frombuffer(bin_file.read(),dtype='<f8').reshape(n_type+1,n_wave)
+    
+    return data[0],data[1],data[2],data[3]+data[4]
 
-#Read in each grid and put into the dataframe
+def read_sed_file(sed_name):
+    
+    if sed_name.endswith('.BIN'):
+        return read_bin(sed_name)
+    
+    return read_res(sed_name)
 
-for res_name in tqdm(res_names,
-              desc='Total'):
-      
-    small_grains,\
-        large_grains,\
-        pyroxine,\
-        olivine, = np.loadtxt(res_name,
-                              unpack=True,
-                              skiprows=8,
-                              usecols=(1,2,3,4))
-      
-    res_name_split = res_name.split('/')[1].split('.RES')[0]
-    columns = res_name_split.split('_')
-    identifier = 'alpha_sCM20:'+columns[1]+',logU:'+columns[2]
-          
-    sCM20_df[identifier] = small_grains/frequency
-    lCM20_df[identifier] = large_grains/frequency
-    aSilM5_df[identifier] = (pyroxine+olivine)/frequency
- 
-sCM20_df.to_hdf('../core/models.h5',
-                mode='w',key='sCM20')
-wavelength_df.to_hdf('../core/models.h5',
-                     key='wavelength')
-lCM20_df.to_hdf('../core/models.h5',
-                key='lCM20')
-aSilM5_df.to_hdf('../core/models.h5',
-                key='aSilM5')
+def parse_chunk(res_names):
+    
+    #Read in a chunk of RES (or BIN) files, converting to per unit frequency
+    
+    seds = []
+    
+    for res_name in res_names:
+        
+        wavelength,\
+            small_grains,\
+            large_grains,\
+            silicates = read_sed_file(res_name)
+        
+        frequency = 3e8/(wavelength*1e-6)
+        
+        seds.append([small_grains/frequency,
+                     large_grains/frequency,
+                     silicates/frequency])
+    
+    return np.array(seds)
 
-print('Complete!')
\ No newline at end of file
+if __name__ == '__main__':
+    
+    start_time = time.time()
+    
+    #First, pull the grid points out of the names
+    
+    res_names = np.array(sorted(glob.glob('grid/*.RES')+glob.glob('grid/*.BIN')))
+    
+    #Each grid point should come from one SED file. A .RES and a .BIN for
+    #the same point means the output format was switched part way through
+    #building the grid, and there's no telling which is right
+    
+    stems = [os.path.splitext(res_name)[0] for res_name in res_names]
+    n_both = len(stems)-len(set(stems))
+    
+    if n_both > 0:
+        raise Exception(str(n_both)+' grid points have both a .RES and a .BIN file in grid/, remove one set')
+    
+    alpha = []
+    isrf = []
+    
+    for res_name in res_names:
+        
+        columns = os.path.splitext(os.path.basename(res_name))[0].split('_')
+        
+        alpha.append(float(columns[1]))
+        isrf.append(float(columns[2]))
+    
+    alpha = np.array(alpha)
+    isrf = np.array(isrf)
+    
+    arrays = {'wavelength':read_sed_file(res_names[0])[0],
+              'alpha':np.unique(alpha),
+              'logU':np.unique(isrf)}
+    
+    header = general.create_grid_header(arrays,
+                                        [len(arrays['alpha']),
+                                         len(arrays['logU']),
+                                         len(arrays['wavelength'])])
+    
+    #Make sure the files fill the grid exactly, since anything missing would
+    #otherwise be left as zeros
+    
+    idx_alpha,idx_isrf = general.check_grid_columns(alpha,
+                                                    isrf,
+                                                    arrays['alpha'],
+                                                    arrays['logU'])
+    
+    #Keep track of the modification time of the RES file that went into each
+    #grid point. If the grid is the same shape as last time, only the RES
+    #files that have changed since need reading in
+    
+    mtime_file = os.path.join(grid_dir,'res_mtimes.npy')
+    
+    res_mtimes = np.array([os.path.getmtime(res_name) for res_name in res_names])
+    
+    built_mtimes = np.full([len(arrays['alpha']),len(arrays['logU'])],-1.0)
+    
+    mode = 'w+'
+    
+    if os.path.exists(os.path.join(grid_dir,'header.json')) and \
+        os.path.exists(mtime_file):
+        
+        if general.read_grid_header(grid_dir) == header:
+            
+            built_mtimes = np.load(mtime_file)
+            mode = 'r+'
+    
+    todo = np.where(res_mtimes != built_mtimes[idx_alpha,idx_isrf])[0]
+    
+    print('Reading '+str(len(todo))+' of '+str(len(res_names))+' RES files')
+    
+    #Set up the (preallocated) grid on disk
+    
+    general.write_grid_header(header,
+                              grid_dir)
+    
+    for name in arrays:
+        
+        grid_array = general.open_grid_array(header,
+                                             grid_dir,
+                                             name,
+                                             mode='w+')
+        grid_array[:] = arrays[name]
+        grid_array.flush()
+    
+    grid_arrays = [general.open_grid_array(header,
+                                           grid_dir,
+                                           grain_type,
+                                           mode=mode) for grain_type in general.grain_types]
+    
+    #Parse the RES files in parallel, writing each chunk straight into the
+    #grid as it comes back
+    
+    chunks = [todo[i:i+chunk_size] for i in range(0,len(todo),chunk_size)]
+    
+    pool = Pool(cpu_count())
+    
+    n_read = 0
+    
+    for chunk,seds in zip(chunks,
+                          pool.imap(parse_chunk,
+                                    [res_names[chunk] for chunk in chunks])):
+        
+        for i,grid_array in enumerate(grid_arrays):
+            grid_array[idx_alpha[chunk],idx_isrf[chunk],:] = seds[:,i,:]
+            grid_array.flush()
+        
+        built_mtimes[idx_alpha[chunk],idx_isrf[chunk]] = res_mtimes[chunk]
+        np.save(mtime_file,built_mtimes)
+        
+        n_read += len(chunk)
+        
+        elapsed = time.time()-start_time
+        
+        print('%d/%d files, %.1f files/s' % (n_read,
+                                            len(todo),
+                                            n_read/elapsed))
+    
+    pool.close()
+    pool.join()
+    
+    del grid_arrays
+    
+    if compress:
+        
+        general.compress_model_grid(general.read_model_grid(grid_dir),
+                                    '../core/models_compressed',
+                                    tolerance=tolerance)
+    
+    print('Complete! Took %.2fm' % ( (time.time()-start_time)/60 ))
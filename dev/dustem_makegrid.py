@@ -9,44 +9,710 @@ Create a DustEM grid
 from __future__ import absolute_import, print_function, division
 
 import os
+import sys
 import numpy as np
+import pandas as pd
 import multiprocessing
+import subprocess
+import hashlib
+import shutil
 import time
+import sysconfig
+from itertools import product
+
+sys.path.append('../core')
+import general
+
+from dustem_compressgrid import read_sed_file, parse_chunk
+
+#Number of grid points sent to a worker at a time. Each chunk is a run of
+#neighbouring ISRF strengths at fixed alpha_sCM20
+
+chunk_size = 50
+
+#Threads per DustEM run, if it was built with OpenMP (make omp in
+#dustem/src). Leave at 1 for full grids, where every core is already running
+#its own grid point, and raise it for rerunning a few slow points
+
+dustem_threads = 1
+
+#Have DustEM write each SED as raw binary (.BIN) rather than text (.RES).
+#Smaller, full precision, and much quicker to read back in
+
+binary = False
+
+sed_extension = '.BIN' if binary else '.RES'
+
+#Number of times to try a failed grid point again before giving up
+
+max_retries = 3
+
+#Recompute the checksums of finished grid points when resuming, rather than
+#just checking the files are there
+
+verify = False
+
+manifest_file = '../dev/grid_manifest.csv'
+
+#In adaptive mode, start from a lattice this many grid points apart and
+#only run DustEM where interpolating between the points we have doesn't
+#reproduce the band fluxes in these filters to within tolerance. The rest
+#of the grid is filled in by interpolation
+
+adaptive = False
+coarse_step = 32
+tolerance = 0.01
+
+#Where the adaptive grid is written. It's built in a directory next to it
+#and only moved into place once it's complete, and an existing grid there
+#is only replaced if overwrite_grid is set
+
+adaptive_grid_dir = '../core/models'
+overwrite_grid = False
+
+filters = ['Spitzer_3.6','Spitzer_8.0','WISE_12','WISE_22','Spitzer_24',
+           'PACS_70','PACS_100','PACS_160','SPIRE_250','SPIRE_350','SPIRE_500']
+
+#In batched mode, DustEM is called in-process through f2py (make batch in
+#dustem/src) rather than once per grid point. Each worker reads the optical
+#data once, and computes all the alpha_sCM20 values for an ISRF strength in
+#one go, writing straight to the model grid rather than to RES files
+
+batched = False
+
+#The manifest covers the whole grid, so only write it out every so often
+#(in seconds)
+
+manifest_interval = 60
+
+def file_checksum(file_name):
+    
+    with open(file_name,'rb') as checksum_file:
+        return hashlib.md5(checksum_file.read()).hexdigest()
+
+def init_worker():
+    
+    #Each worker runs DustEM in its own directory, so that runs don't
+    #trample each other's GRAIN.DAT and output files. The shared input data
+    #is linked in, and DUSTEM_DATA_PATH points DustEM at it
+    
+    global work_dir
+    
+    work_dir = os.path.join(os.getcwd(),'work',str(os.getpid()))+'/'
+    
+    if os.path.exists(work_dir):
+        shutil.rmtree(work_dir)
+    
+    os.makedirs(os.path.join(work_dir,'data'))
+    os.makedirs(os.path.join(work_dir,'out'))
+    
+    for data_name in os.listdir('data'):
+        os.symlink(os.path.abspath(os.path.join('data',data_name)),
+                   os.path.join(work_dir,'data',data_name))
+    
+    for dir_name in ['oprop','hcap']:
+        os.symlink(os.path.abspath(dir_name),
+                   os.path.join(work_dir,dir_name))
+
+def init_batch_worker():
+    
+    #Read in GRAIN_orig.DAT (alpha_sCM20 of 5, G0 of 1) and the optical
+    #data, ready to compute models from
+    
+    global dustem_batch,n_type,n_wave
+    
+    sys.path.append('src')
+    import dustem_batch
+    
+    os.environ['DUSTEM_DATA_PATH'] = os.getcwd()+'/'
+    
+    n_type,n_wave = dustem_batch.batch_init('GRAIN_orig.DAT')
+
+def run_batch(isrf_alpha):
+    
+    #All the alpha_sCM20 values for one ISRF strength, converted to per unit
+    #frequency and with pyroxine and olivine summed, as in the grid
+    
+    j,alpha = isrf_alpha
+    
+    wavelength,seds = dustem_batch.batch_sed(10**j,
+                                             alpha,
+                                             5.0,
+                                             1,
+                                             n_type,
+                                             n_wave)
+    
+    frequency = 3e8/(wavelength*1e-6)
+    
+    return j,wavelength,np.stack([seds[:,0,:]/frequency,
+                                  seds[:,1,:]/frequency,
+                                  (seds[:,2,:]+seds[:,3,:])/frequency],axis=1)
+
+def batched_grid(alpha,
+                 isrf,
+                 pool,
+                 grid_dir='../core/models'):
+    
+    #Fill the model grid an ISRF strength at a time. Which ISRF strengths are
+    #done is kept alongside the grid, so an interrupted run picks up from
+    #where it left off
+    
+    start = time.time()
+    
+    done_file = os.path.join(grid_dir,'isrf_done.npy')
+    
+    wavelength = pool.apply(run_batch,((isrf[0],alpha[:1]),))[1]
+    
+    arrays = {'wavelength':wavelength,
+              'alpha':alpha,
+              'logU':isrf}
+    
+    header = general.create_grid_header(arrays,
+                                        [len(alpha),
+                                         len(isrf),
+                                         len(wavelength)])
+    
+    isrf_done = np.zeros(len(isrf),dtype=bool)
+    mode = 'w+'
+    
+    if os.path.exists(os.path.join(grid_dir,'header.json')) and \
+        os.path.exists(done_file):
+        
+        if general.read_grid_header(grid_dir) == header:
+            
+            isrf_done = np.load(done_file)
+            mode = 'r+'
+    
+    general.write_grid_header(header,
+                              grid_dir)
+    
+    for name in arrays:
+        
+        grid_array = general.open_grid_array(header,
+                                             grid_dir,
+                                             name,
+                                             mode='w+')
+        grid_array[:] = arrays[name]
+        grid_array.flush()
+    
+    grid_arrays = [general.open_grid_array(header,
+                                           grid_dir,
+                                           grain_type,
+                                           mode=mode) for grain_type in general.grain_types]
+    
+    todo = np.where(~isrf_done)[0]
+    
+    print(str(len(isrf)-len(todo))+' of '+str(len(isrf))+' ISRF strengths already done')
+    
+    n_done = 0
+    
+    for j,wavelength,seds in pool.imap_unordered(run_batch,
+                                                 [(isrf[idx],alpha) for idx in todo]):
+        
+        idx = np.where(isrf == j)[0][0]
+        
+        for grain,grid_array in enumerate(grid_arrays):
+            grid_array[:,idx,:] = seds[:,grain,:]
+            grid_array.flush()
+        
+        isrf_done[idx] = True
+        np.save(done_file,isrf_done)
+        
+        n_done += 1
+        
+        rate = n_done/(time.time()-start)
+        
+        print('%d/%d ISRF strengths done, %.1f models/s, ETA %.2fm' % (n_done,
+                                                                     len(todo),
+                                                                     rate*len(alpha),
+                                                                     (len(todo)-n_done)/rate/60))
 
 def run_dustem(alpha_isrf):
     
     i,j = alpha_isrf
     
-    if not os.path.exists('../dev/grid/SED_%.2f_%.2f.RES' % (i,j)):
-    
-        with open('data/GRAIN_orig.DAT', 'r') as grain_file:
-            filedata = grain_file.read()
-         
-            # Replace the target string
-            filedata = filedata.replace('5.00','%.2f' % i)
-            filedata = filedata.replace('1.000000','%.6f' % 10**j)
-             
-            # Write the file out again
-            with open('data/GRAIN_%.2f_%.2f.DAT' % (i,j), 'w') as grain_file:
-                grain_file.write(filedata)
-         
-        #Run the DustEM code
-         
-        os.system('./src/dustem GRAIN_%.2f_%.2f.DAT SED_%.2f_%.2f.RES' % (i,j,i,j))
-         
-        #Remove the GRAIN.DAT files
-         
-        os.remove('data/GRAIN_%.2f_%.2f.DAT' % (i,j))
-        
-        #Move file to /dev/grid
-        
-        os.rename('out/SED_%.2f_%.2f.RES' % (i,j), 
-                  '../dev/grid/SED_%.2f_%.2f.RES' % (i,j))
+    start = time.time()
     
-if __name__ == '__main__':
+    with open('data/GRAIN_orig.DAT', 'r') as grain_file:
+        filedata = grain_file.read()
+    
+    # Replace the target string
+    filedata = filedata.replace('5.00','%.2f' % i)
+    filedata = filedata.replace('1.000000','%.6f' % 10**j)
+    
+    if binary:
+        filedata = filedata.replace('quiet','quiet binary')
+    
+    # Write the file out into the private data directory
+    with open(os.path.join(work_dir,'data','GRAIN.DAT'), 'w') as grain_file:
+        grain_file.write(filedata)
+    
+    res_name = os.path.join(work_dir,'out','SED'+sed_extension)
+    
+    if os.path.exists(res_name):
+        os.remove(res_name)
+    
+    #Run the DustEM code
+    
+    env = dict(os.environ,
+               DUSTEM_DATA_PATH=work_dir,
+               OMP_NUM_THREADS=str(dustem_threads))
+    
+    with open(os.devnull,'w') as devnull:
+        return_code = subprocess.call(['./src/dustem','GRAIN.DAT','SED'+sed_extension],
+                                      env=env,
+                                      stdout=devnull,
+                                      stderr=devnull)
+    
+    if return_code != 0 or not os.path.exists(res_name) or os.path.getsize(res_name) == 0:
+        return i,j,'failed','',time.time()-start
+    
+    checksum = file_checksum(res_name)
+    
+    #Move file to /dev/grid. Go via a temporary name, so a half-copied file
+    #never appears under the final name
+    
+    grid_name = '../dev/grid/SED_%.2f_%.2f' % (i,j)+sed_extension
+    
+    shutil.move(res_name,grid_name+'.tmp')
+    os.rename(grid_name+'.tmp',grid_name)
+    
+    return i,j,'done',checksum,time.time()-start
+
+def run_chunk(chunk):
+    
+    return [run_dustem(alpha_isrf) for alpha_isrf in chunk]
+
+def write_manifest(manifest_df):
+    
+    #Write to a temporary file first, so an interruption never leaves a
+    #corrupted manifest
+    
+    manifest_df.to_csv(manifest_file+'.tmp')
+    os.rename(manifest_file+'.tmp',manifest_file)
+
+def read_manifest(alpha_isrf):
+    
+    #The manifest records the status, number of attempts and checksum of
+    #every grid point
+    
+    index = ['%.2f_%.2f' % (i,j) for i,j in alpha_isrf]
+    
+    manifest_df = pd.DataFrame({'alpha':[i for i,j in alpha_isrf],
+                                'logU':[j for i,j in alpha_isrf],
+                                'status':'pending',
+                                'attempts':0,
+                                'checksum':'',
+                                'seconds':np.nan},
+                               index=index)
+    
+    if os.path.exists(manifest_file):
+        
+        old_manifest_df = pd.read_csv(manifest_file,
+                                      index_col=0,
+                                      dtype={'checksum':str}).fillna({'checksum':''})
+        old_manifest_df = old_manifest_df[old_manifest_df.index.isin(index)]
+        
+        manifest_df.loc[old_manifest_df.index] = old_manifest_df[manifest_df.columns].values
+    
+    #Anything that was running when we were interrupted needs doing again,
+    #as does anything whose output has gone missing (or changed)
+    
+    manifest_df.loc[manifest_df['status'] == 'running','status'] = 'pending'
+    
+    for idx in manifest_df.index[manifest_df['status'] == 'done']:
+        
+        grid_name = '../dev/grid/SED_'+idx+sed_extension
+        
+        if not os.path.exists(grid_name) or \
+            (verify and file_checksum(grid_name) != manifest_df.loc[idx,'checksum']):
+            manifest_df.loc[idx,'status'] = 'pending'
+    
+    #Grid points made before there was a manifest
+    
+    for idx in manifest_df.index[manifest_df['status'] == 'pending']:
+        
+        grid_name = '../dev/grid/SED_'+idx+sed_extension
+        
+        if os.path.exists(grid_name) and not os.path.exists(manifest_file):
+            manifest_df.loc[idx,'status'] = 'done'
+            manifest_df.loc[idx,'checksum'] = file_checksum(grid_name)
+    
+    #And retry failed points, up to a limit
+    
+    manifest_df.loc[(manifest_df['status'] == 'failed') & \
+                    (manifest_df['attempts'] < max_retries),'status'] = 'pending'
+    
+    return manifest_df
+
+def run_points(todo,
+               manifest_df,
+               pool):
+    
+    #Run DustEM for these grid points (given as manifest indices), keeping
+    #the manifest up to date as they finish. Points that fail are tried
+    #again straight away, up to max_retries attempts in all, so a long
+    #unattended run doesn't stop for the odd failure. Returns how many
+    #still failed after that
+    
+    todo = [idx for idx in todo if manifest_df.loc[idx,'status'] == 'pending']
+    attempted = list(todo)
+    
+    while len(todo) > 0:
+        
+        run_pass(todo,
+                 manifest_df,
+                 pool)
+        
+        todo = [idx for idx in todo if manifest_df.loc[idx,'status'] == 'failed' and \
+                                       manifest_df.loc[idx,'attempts'] < max_retries]
+        
+        if len(todo) > 0:
+            
+            print('Retrying '+str(len(todo))+' failed grid points')
+            
+            manifest_df.loc[todo,'status'] = 'pending'
+    
+    n_failed = int(np.sum(manifest_df.loc[attempted,'status'] == 'failed'))
+    
+    if n_failed > 0:
+        print(str(n_failed)+' grid points failed after '+str(max_retries)+' attempts')
+    
+    return n_failed
+
+def run_pass(todo,
+             manifest_df,
+             pool):
+    
+    #Run each of these grid points once
     
     start = time.time()
+    
+    #Split into chunks of neighbouring points. These come back in whatever
+    #order they finish
+    
+    chunks = [list(zip(manifest_df.loc[todo[k:k+chunk_size],'alpha'],
+                       manifest_df.loc[todo[k:k+chunk_size],'logU'])) for k in range(0,len(todo),chunk_size)]
+    
+    manifest_df.loc[todo,'status'] = 'running'
+    write_manifest(manifest_df)
+    
+    n_done = 0
+    n_failed = 0
+    
+    manifest_time = time.time()
+    
+    for results in pool.imap_unordered(run_chunk,chunks):
+        
+        for i,j,status,checksum,seconds in results:
+            
+            idx = '%.2f_%.2f' % (i,j)
+            
+            manifest_df.loc[idx,'status'] = status
+            manifest_df.loc[idx,'checksum'] = checksum
+            manifest_df.loc[idx,'seconds'] = seconds
+            manifest_df.loc[idx,'attempts'] += 1
+            
+            if status == 'failed':
+                n_failed += 1
+            else:
+                n_done += 1
+        
+        if time.time()-manifest_time > manifest_interval:
+            
+            write_manifest(manifest_df)
+            manifest_time = time.time()
+        
+        #Estimate how long is left from the rate so far
+        
+        rate = (n_done+n_failed)/(time.time()-start)
+        eta = (len(todo)-n_done-n_failed)/rate
+        
+        print('%d/%d done, %d failed, ETA %.2fm' % (n_done,
+                                                   len(todo),
+                                                   n_failed,
+                                                   eta/60))
+    
+    write_manifest(manifest_df)
+
+def cell_points(cell):
+    
+    #The midpoints of the edges and the centre of a cell (given as the grid
+    #indices of its alpha_sCM20 and logU edges), leaving out the corners
+    
+    i0,i1,j0,j1 = cell
+    
+    i_mid = (i0+i1)//2
+    j_mid = (j0+j1)//2
+    
+    corners = set(product([i0,i1],[j0,j1]))
+    
+    points = set([(i_mid,j0),(i_mid,j1),(i0,j_mid),(i1,j_mid),(i_mid,j_mid)])
+    
+    return sorted(points-corners)
 
+def split_cell(cell):
+    
+    #Split a cell in half along each side that can still be split
+    
+    i0,i1,j0,j1 = cell
+    
+    i_mid = (i0+i1)//2
+    j_mid = (j0+j1)//2
+    
+    alpha_edges = [(i0,i_mid),(i_mid,i1)] if i1-i0 > 1 else [(i0,i1)]
+    isrf_edges = [(j0,j_mid),(j_mid,j1)] if j1-j0 > 1 else [(j0,j1)]
+    
+    return [(a0,a1,u0,u1) for (a0,a1),(u0,u1) in product(alpha_edges,isrf_edges)]
+
+def interpolate_cell(corner_values,
+                     cell,
+                     i,
+                     j):
+    
+    #Bilinearly interpolate values at the corners of a cell, ordered
+    #(i0,j0), (i0,j1), (i1,j0), (i1,j1), to grid points i,j
+    
+    i0,i1,j0,j1 = cell
+    
+    frac_alpha = np.reshape((np.array(i)-i0)/(i1-i0),np.shape(i)+(1,)*(np.ndim(corner_values[0])))
+    frac_isrf = np.reshape((np.array(j)-j0)/(j1-j0),np.shape(j)+(1,)*(np.ndim(corner_values[0])))
+    
+    return (1-frac_alpha)*(1-frac_isrf)*corner_values[0]+\
+           (1-frac_alpha)*frac_isrf*corner_values[1]+\
+           frac_alpha*(1-frac_isrf)*corner_values[2]+\
+           frac_alpha*frac_isrf*corner_values[3]
+
+def adaptive_grid(alpha,
+                  isrf,
+                  manifest_df,
+                  pool):
+    
+    #Refine the grid only where it needs it. Each round, run DustEM at the
+    #edge midpoints and centre of every cell, and split any cell where
+    #bilinear interpolation from its corners misses the band fluxes there by
+    #more than the tolerance
+    
+    alpha_idx = np.unique(np.append(np.arange(0,len(alpha),coarse_step),len(alpha)-1))
+    isrf_idx = np.unique(np.append(np.arange(0,len(isrf),coarse_step),len(isrf)-1))
+    
+    cells = [(alpha_idx[k],alpha_idx[k+1],isrf_idx[l],isrf_idx[l+1]) for k in range(len(alpha_idx)-1)
+                                                                      for l in range(len(isrf_idx)-1)]
+    
+    leaves = []
+    band_fluxes = {}
+    response = None
+    
+    level = 0
+    
+    while len(cells) > 0:
+        
+        needed = set()
+        
+        for cell in cells:
+            needed.update(product(cell[:2],cell[2:]))
+            needed.update(cell_points(cell))
+        
+        needed = sorted(needed-set(band_fluxes))
+        
+        names = ['%.2f_%.2f' % (alpha[i],isrf[j]) for i,j in needed]
+        
+        run_points(names,
+                   manifest_df,
+                   pool)
+        
+        if np.any(manifest_df.loc[names,'status'] != 'done'):
+            raise Exception('DustEM failed for some grid points, even after retrying them')
+        
+        #Pass the new models through the filters
+        
+        res_names = ['../dev/grid/SED_'+name+sed_extension for name in names]
+        
+        if response is None and len(res_names) > 0:
+            
+            wavelength = read_sed_file(res_names[0])[0]
+            response = general.filter_response(wavelength,
+                                               general.read_filters(filters),
+                                               filters)
+        
+        chunks = [res_names[k:k+chunk_size] for k in range(0,len(res_names),chunk_size)]
+        
+        seds = pool.map(parse_chunk,chunks)
+        
+        if len(seds) > 0:
+            
+            seds = np.concatenate(seds)
+            
+            for point,sed in zip(needed,seds):
+                band_fluxes[point] = sed.dot(response.T)
+        
+        #See which cells need splitting
+        
+        new_cells = []
+        
+        for cell in cells:
+            
+            points = cell_points(cell)
+            
+            if len(points) == 0:
+                leaves.append(cell)
+                continue
+            
+            corner_values = [band_fluxes[corner] for corner in product(cell[:2],cell[2:])]
+            
+            error = 0
+            
+            for i,j in points:
+                
+                interpolated = interpolate_cell(corner_values,
+                                                cell,
+                                                i,
+                                                j)
+                
+                peak = np.max(np.abs(band_fluxes[(i,j)]),axis=-1)
+                peak[peak == 0] = 1
+                
+                error = np.max([error,
+                                np.max(np.max(np.abs(interpolated-band_fluxes[(i,j)]),axis=-1)/peak)])
+            
+            if error > tolerance:
+                new_cells.extend(split_cell(cell))
+            else:
+                leaves.append(cell)
+        
+        print('Level %d: %d cells, %d split, %d DustEM runs so far' % (level,
+                                                                       len(cells),
+                                                                       len(new_cells),
+                                                                       len(band_fluxes)))
+        
+        cells = new_cells
+        level += 1
+    
+    write_adaptive_grid(alpha,
+                        isrf,
+                        wavelength,
+                        sorted(band_fluxes),
+                        leaves,
+                        pool)
+    
+def check_grid_dir(grid_dir):
+    
+    if os.path.exists(os.path.join(grid_dir,'header.json')) and not overwrite_grid:
+        raise Exception('There is already a model grid in '+grid_dir+', set overwrite_grid to replace it')
+
+def write_adaptive_grid(alpha,
+                        isrf,
+                        wavelength,
+                        computed,
+                        leaves,
+                        pool,
+                        grid_dir=adaptive_grid_dir):
+    
+    #Write out the full lattice as a model grid. Points DustEM was run for
+    #go in as they are, and everything else is interpolated from the
+    #corners of the cell it falls in
+    
+    check_grid_dir(grid_dir)
+    
+    final_dir = grid_dir
+    grid_dir = final_dir+'_partial'
+    
+    shutil.rmtree(grid_dir,ignore_errors=True)
+    
+    arrays = {'wavelength':wavelength,
+              'alpha':alpha,
+              'logU':isrf}
+    
+    header = general.create_grid_header(arrays,
+                                        [len(alpha),
+                                         len(isrf),
+                                         len(wavelength)])
+    
+    general.write_grid_header(header,
+                              grid_dir)
+    
+    for name in arrays:
+        
+        grid_array = general.open_grid_array(header,
+                                             grid_dir,
+                                             name,
+                                             mode='w+')
+        grid_array[:] = arrays[name]
+        grid_array.flush()
+    
+    grid_arrays = [general.open_grid_array(header,
+                                           grid_dir,
+                                           grain_type,
+                                           mode='w+') for grain_type in general.grain_types]
+    
+    is_computed = np.zeros([len(alpha),len(isrf)],dtype=bool)
+    
+    for k in range(0,len(computed),chunk_size*10):
+        
+        points = computed[k:k+chunk_size*10]
+        res_names = ['../dev/grid/SED_%.2f_%.2f' % (alpha[i],isrf[j])+sed_extension for i,j in points]
+        
+        seds = np.concatenate(pool.map(parse_chunk,
+                                       [res_names[l:l+chunk_size] for l in range(0,len(res_names),chunk_size)]))
+        
+        idx_alpha = np.array([i for i,j in points])
+        idx_isrf = np.array([j for i,j in points])
+        
+        for grain,grid_array in enumerate(grid_arrays):
+            grid_array[idx_alpha,idx_isrf,:] = seds[:,grain,:]
+        
+        is_computed[idx_alpha,idx_isrf] = True
+    
+    #Fill in each cell. Cells share edges with their neighbours, which may
+    #have been split further. Go from the largest cells to the smallest, so
+    #along a shared edge the finer cell (interpolating between more DustEM
+    #runs) has the last word. Points DustEM was run for are never touched
+    
+    for cell in sorted(leaves,
+                       key=lambda cell: ((cell[1]-cell[0])*(cell[3]-cell[2]),cell),
+                       reverse=True):
+        
+        i0,i1,j0,j1 = cell
+        
+        i,j = np.meshgrid(np.arange(i0,i1+1),np.arange(j0,j1+1),indexing='ij')
+        
+        fill = ~is_computed[i0:i1+1,j0:j1+1]
+        
+        if not np.any(fill):
+            continue
+        
+        for grid_array in grid_arrays:
+            
+            corner_values = [np.array(grid_array[corner]) for corner in product(cell[:2],cell[2:])]
+            
+            grid_array[i[fill],j[fill],:] = interpolate_cell(corner_values,
+                                                             cell,
+                                                             i[fill],
+                                                             j[fill])
+    
+    for grid_array in grid_arrays:
+        grid_array.flush()
+    
+    del grid_arrays
+    
+    #Swap the finished grid in. Directories can't be renamed over each
+    #other, so move any old grid aside first
+    
+    if os.path.exists(final_dir):
+        
+        shutil.rmtree(final_dir+'_old',ignore_errors=True)
+        os.rename(final_dir,final_dir+'_old')
+    
+    os.rename(grid_dir,final_dir)
+    
+    shutil.rmtree(final_dir+'_old',ignore_errors=True)
+    
+    print('Ran DustEM for %d of %d grid points' % (len(computed),len(alpha)*len(isrf)))
+
+if __name__ == '__main__':
+    
+    start = time.time()
+    
     os.chdir(os.getcwd())
     
     #Move into the DustEM directory
@@ -56,7 +722,7 @@ if __name__ == '__main__':
     #Check if DustEM has already been compiled
     
     if not os.path.exists('src/dustem'):
-    
+        
         #Edit DM constants.f90
         
         with open('src/DM_constants.f90', 'r') as constants_file:
@@ -68,7 +734,7 @@ if __name__ == '__main__':
         # Write the file out again
         with open('src/DM_constants.f90', 'w') as constants_file:
             constants_file.write(filedata)
-            
+        
         #And compile DustEM
         
         os.chdir('src')
@@ -76,32 +742,99 @@ if __name__ == '__main__':
         os.system('make')
         
         os.chdir('../')
+    
+    if batched and not os.path.exists(os.path.join('src','dustem_batch'+sysconfig.get_config_var('EXT_SUFFIX'))):
+        
+        os.chdir('src')
+        os.system('make batch')
         
+        os.chdir('../')
+    
     #Create grid directories if they don't exist
     
     if not os.path.exists('out'):
-    
+        
         os.mkdir('out')
     
     if not os.path.exists('../dev/grid'):
-    
-        os.mkdir('../dev/grid')
         
+        os.mkdir('../dev/grid')
+    
     #Set up values for alpha_sCM20 and the ISRF strength
     
-    alpha = np.arange(2,7.01,0.01)
-    isrf = np.arange(-2,7.01,0.01)
+    alpha = np.round(np.arange(2,7.01,0.01),2)
+    isrf = np.round(np.arange(-2,7.01,0.01),2)
+    
+    if batched:
+        
+        n_proc = multiprocessing.cpu_count()
+        
+        print('Using '+str(n_proc)+' processes')
+        
+        pool = multiprocessing.Pool(n_proc,
+                                    initializer=init_batch_worker)
+        
+        try:
+            
+            batched_grid(alpha,
+                         isrf,
+                         pool)
+        
+        finally:
+            
+            pool.terminate()
+            pool.join()
+        
+        print('Complete! Took %.2fm' % ((time.time()-start)/60))
+        
+        sys.exit()
     
     alpha_isrf = [(x,y) for x in alpha for y in isrf]
     
+    #Work out what's left to do
+    
+    manifest_df = read_manifest(alpha_isrf)
+    
+    print(str(np.sum(manifest_df['status'] == 'done'))+' of '+str(len(manifest_df))+' grid points already done')
+    
     #Set up multiprocessing pool with number of processors
     
-    n_proc = multiprocessing.cpu_count()
+    n_proc = max(1,multiprocessing.cpu_count()//dustem_threads)
     
     print('Using '+str(n_proc)+' processes')
     
-    pool = multiprocessing.Pool(n_proc)
-     
-    pool.map(run_dustem,alpha_isrf)
+    pool = multiprocessing.Pool(n_proc,
+                                initializer=init_worker)
+    
+    try:
+        
+        if adaptive:
+            
+            #Check before spending any time running DustEM
+            
+            check_grid_dir(adaptive_grid_dir)
+            
+            adaptive_grid(alpha,
+                          isrf,
+                          manifest_df,
+                          pool)
+        
+        else:
+            
+            run_points(manifest_df.index[manifest_df['status'] == 'pending'],
+                       manifest_df,
+                       pool)
+    
+    finally:
+        
+        pool.terminate()
+        pool.join()
+        
+        #Mark anything we didn't get to as pending again
+        
+        manifest_df.loc[manifest_df['status'] == 'running','status'] = 'pending'
+        write_manifest(manifest_df)
+        
+        shutil.rmtree('work',ignore_errors=True)
     
-    print('Complete! Took %.2fm' % ((time.time()-start)/60))
\ No newline at end of file
+    print('Complete! Took %.2fm' % ((time.time()-start)/60))
@@ -0,0 +1,93 @@
+"""
+Measure the interpolation error of a coarser model grid, and optionally
+write it out
+
+@author: Tom Williams
+"""
+
+#Ensure python3 compatibility
+from __future__ import absolute_import, print_function, division
+
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+os.chdir(os.getcwd())
+
+sys.path.append('../core')
+import general
+
+#Strides (in grid points) to try along alpha_sCM20 and logU. The full grid
+#is in steps of 0.01, and the strides need to divide the axes exactly
+
+strides = [(1,5),(5,5),(5,10),(10,10),(10,20),(20,20)]
+
+#Write out the coarsest grid with a maximum error below this tolerance
+
+tolerance = 0.01
+
+#Measure the errors in band fluxes through these filters, rather than for
+#the full spectrum. Set to None to use the spectrum
+
+filters = ['Spitzer_24','PACS_70','PACS_160','SPIRE_250','SPIRE_500']
+
+model_grid = general.read_model_grid('../core/models')
+
+response = None
+
+if filters is not None:
+    
+    os.chdir('../core')
+    response = general.filter_response(model_grid['wavelength'],
+                                       general.read_filters(filters),
+                                       filters)
+    os.chdir('../dev')
+
+error_dict = {'alpha_stride':[],
+              'isrf_stride':[],
+              'reduction':[],
+              'median_error':[],
+              'max_error':[]}
+
+for alpha_stride,isrf_stride in strides:
+    
+    errors = general.interpolation_error(model_grid,
+                                         alpha_stride,
+                                         isrf_stride,
+                                         response=response)
+    
+    errors = np.array([errors[grain_type] for grain_type in general.grain_types])
+    
+    error_dict['alpha_stride'].append(alpha_stride)
+    error_dict['isrf_stride'].append(isrf_stride)
+    error_dict['reduction'].append(alpha_stride*isrf_stride)
+    error_dict['median_error'].append(np.median(errors))
+    error_dict['max_error'].append(np.max(errors))
+    
+    print('Strides %d,%d: median error %.2e, max error %.2e' % (alpha_stride,
+                                                               isrf_stride,
+                                                               np.median(errors),
+                                                               np.max(errors)))
+    
+error_df = pd.DataFrame(error_dict)
+error_df.to_csv('grid_interpolation_error.csv',
+                index=False)
+
+#Write out the smallest grid that meets the tolerance
+
+error_df = error_df[error_df['max_error'] < tolerance]
+
+if len(error_df) > 0:
+    
+    idx = error_df['reduction'].idxmax()
+    
+    print('Writing grid with strides %d,%d' % (error_df['alpha_stride'][idx],
+                                              error_df['isrf_stride'][idx]))
+    
+    general.coarsen_model_grid(model_grid,
+                               '../core/models_coarse',
+                               error_df['alpha_stride'][idx],
+                               error_df['isrf_stride'][idx])
+    
+print('Complete!')
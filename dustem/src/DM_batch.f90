@@ -0,0 +1,124 @@
+! DUSTEM batch driver, to be called from Python through f2py
+! Reads GRAIN.DAT and all the optical data once (BATCH_INIT), then computes
+! SEDs for many (G0, size distribution power law) configurations (BATCH_SED)
+! without re-reading anything or writing .RES files.
+! G0 only enters through the radiation field, and the power law index only
+! through the size distribution of one grain type, so for each G0 the SED per
+! size is computed once and then integrated over each size distribution.
+
+MODULE MBATCH
+
+  USE CONSTANTS
+  IMPLICIT NONE
+
+  REAL (KIND=dp), ALLOCATABLE :: isrfuv_ref(:)   ! radiation field for the G0 in GRAIN.DAT
+  REAL (KIND=dp), ALLOCATABLE :: ava_ref(:,:)    ! size distributions as read in GRAIN.DAT
+  REAL (KIND=dp)              :: g0_ref          ! G0 in GRAIN.DAT
+
+END MODULE MBATCH
+
+!----------------------------------------------------------------
+
+SUBROUTINE BATCH_INIT(grain_file, n_type, n_wave)
+! reads the .DAT files for this GRAIN file (in data/)
+
+  USE CONSTANTS
+  USE UTILITY
+  USE IN_OUT
+  USE MBATCH
+
+  IMPLICIT NONE
+
+  CHARACTER (LEN=*), INTENT (IN) :: grain_file
+  INTEGER, INTENT (OUT)          :: n_type, n_wave
+  TYPE (FICH)                    :: fgrain
+
+  fgrain = FICH (grain_file, 11)
+
+  CALL READ_DATA(fgrain)
+
+  IF (ALLOCATED(isrfuv_ref)) DEALLOCATE (isrfuv_ref, ava_ref, sizesed)
+  ALLOCATE (isrfuv_ref(n_qabs), ava_ref(ntype,nsize_max))
+  ALLOCATE (sizesed(ntype,nsize_max,n_qabs))
+
+  isrfuv_ref = isrfuv
+  ava_ref = ava
+  g0_ref = g0
+  sizesed = 0.0_dp
+
+  n_type = ntype
+  n_wave = n_qabs
+
+END SUBROUTINE BATCH_INIT
+
+!----------------------------------------------------------------
+
+SUBROUTINE BATCH_SED(g0_new, alphas, alpha_ref, alpha_type, n_alpha, n_type, n_wave, wavelength, seds)
+! SEDs (4*pi*nu*I_nu/NH, erg/s/H, as in SED.RES) for radiation field scaling
+! g0_new and each power law index in alphas. The size distribution of
+! grain type alpha_type is a^-alpha, where GRAIN.DAT has a^-alpha_ref
+
+  USE CONSTANTS
+  USE UTILITY
+  USE MCOMPUTE
+  USE MBATCH
+
+  IMPLICIT NONE
+
+  DOUBLE PRECISION, INTENT (IN)  :: g0_new, alpha_ref
+  INTEGER, INTENT (IN)           :: alpha_type, n_alpha, n_type, n_wave
+  DOUBLE PRECISION, INTENT (IN)  :: alphas(n_alpha)
+  DOUBLE PRECISION, INTENT (OUT) :: wavelength(n_wave)
+  DOUBLE PRECISION, INTENT (OUT) :: seds(n_alpha,n_type,n_wave)
+
+  REAL (KIND=dp)                 :: tmp(n_qabs), ava_k(nsize_max), mass_k
+  REAL (KIND=dp)                 :: xx(nsize_max), yy(nsize_max)
+  INTEGER                        :: i, k, kt, ns_i, flag_cut
+
+  ! scale the radiation field, and redo the high frequency cut as READ_DATA
+  ! does (isrfuv is stored in frequency order)
+  isrfuv = isrfuv_ref * g0_new / g0_ref
+  g0 = g0_new
+
+  flag_cut = 0
+  jfreqmax = 1
+  DO i=1,n_qabs
+     tmp(i) = isrfuv(n_qabs-i+1)
+     IF (flag_cut == 0 .AND. tmp(i) <= istiny) THEN
+       jfreqmax = i
+     ELSE IF (flag_cut == 0 .AND. tmp(i) > istiny) THEN
+       flag_cut = 1
+     ENDIF
+  ENDDO
+  jfreqmax = jfreqmax + 1
+  jfreqmax = n_qabs -jfreqmax +1
+  hnumax = xhp * freq_qabs(jfreqmax)
+
+  ! SED per size for every grain type
+  ava = ava_ref
+  nuinuem = 0.0_dp
+  nuinuemtot = 0.0_dp
+  CALL COMPUTE
+
+  ! and integrate over each size distribution
+  DO k=1,n_alpha
+     DO i=1,ntype
+        ns_i = nsize(i)
+        xx(1:ns_i) = si_ava_l(i,1:ns_i)
+        ava_k(1:ns_i) = ava_ref(i,1:ns_i)
+        mass_k = masstot(i)
+        IF (i == alpha_type) THEN
+           ava_k(1:ns_i) = ava_ref(i,1:ns_i) * EXP(-(alphas(k)-alpha_ref) * si_ava_l(i,1:ns_i))
+           yy(1:ns_i) = ava_k(1:ns_i) * rho(i,1:ns_i) * 4.0_dp * xpi / 3.0_dp
+           mass_k = XINTEG2 (1, ns_i, ns_i, xx(1:ns_i), yy(1:ns_i))
+        ENDIF
+        DO kt=1,n_qabs
+           yy(1:ns_i) = sizesed(i,1:ns_i,kt) * ava_k(1:ns_i)
+           seds(k,i,kt) = XINTEG2 (1, ns_i, ns_i, xx(1:ns_i), yy(1:ns_i)) * mprop(i) * xmp / mass_k
+        ENDDO
+     ENDDO
+  ENDDO
+
+  wavelength = lamb_qabs * 1.0e4_dp
+
+END SUBROUTINE BATCH_SED
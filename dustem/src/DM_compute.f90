@@ -174,6 +174,12 @@ SUBROUTINE COMPUTE
      IF (INDEX(t_opt(i),'BETA') > 0)   n_beta   = 1 
      IF (INDEX(t_opt(i),'DTLS') > 0)   n_dtls   = 1 
 
+     ! sizes are independent, so in the OpenMP build (make omp) they are
+     ! shared out between threads. Each size is computed exactly as in the
+     ! serial build and the size integrals below stay serial, so the SEDs are
+     ! the same. Output files are written in size order (ORDERED)
+     !$OMP PARALLEL DO SCHEDULE(DYNAMIC,1) ORDERED &
+     !$OMP& PRIVATE(j, kt, temp, t2, hcap, dpt, uint, dpu, nuflux_j, nufluxp_j, spnuflux_j, nuf, fz0)
      DO j=1,nsize(i)                               ! loop on sizes
 
         CALL GET_TDIST( &
@@ -202,13 +208,6 @@ SUBROUTINE COMPUTE
 
         IF ((INDEX(t_opt(i),'CHRG') > 0 ) .OR. (INDEX(t_opt(i),'SPIN') > 0 )) THEN
           CALL ZDIST(i, j, size_ava(i,j), zmean(j), sd_z(j), jpe(j), hpe(j), hspe(j), jgas(j), cgas(j))
-          IF (n_zdist > 0) THEN 
-             WRITE (UNIT = fzdist%unit, FMT='(/,A2,A20,1x,10(1PE12.4,3X),i4)') '# ',gtype(i),size_ava(i,j),zmin,zmax,zeq,zmean(j), &
-                  & sd_z(j),jpe(j),hpe(j),jgas(j),cgas(j),nzb
-             DO kt = 1, nzb
-                WRITE (UNIT = fzdist%unit, FMT='(1P,2(E18.10E3,1X))') zb(kt),fz(kt)
-             ENDDO
-          ENDIF
           IF (INDEX(t_opt(i),'ZM') > 0 ) THEN                     ! zm: 1st pass
              ALLOCATE (fz0(nzb))
              fz0 = fz
@@ -235,6 +234,15 @@ SUBROUTINE COMPUTE
            nuflux(j,:) = nuflux(j,:) + spnuflux(j,:)
         ENDIF
 
+        !$OMP ORDERED
+        IF (((INDEX(t_opt(i),'CHRG') > 0 ) .OR. (INDEX(t_opt(i),'SPIN') > 0 )) .AND. (n_zdist > 0)) THEN
+           WRITE (UNIT = fzdist%unit, FMT='(/,A2,A20,1x,10(1PE12.4,3X),i4)') '# ',gtype(i),size_ava(i,j),zmin,zmax,zeq,zmean(j), &
+                & sd_z(j),jpe(j),hpe(j),jgas(j),cgas(j),nzb
+           DO kt = 1, nzb
+              WRITE (UNIT = fzdist%unit, FMT='(1P,2(E18.10E3,1X))') zb(kt),fz(kt)
+           ENDDO
+        ENDIF
+
         IF (n_ftemp > 0) THEN
            WRITE (UNIT = ftemp%unit, FMT='(/,A2,A20,1x,5(1PE12.4,6X),i4)') '# ',gtype(i),size_ava(i,j),tempequi(j), &
                 & tempmoy(j),tempmax(j),t_rot(j),ndist
@@ -242,6 +250,7 @@ SUBROUTINE COMPUTE
               WRITE (UNIT = ftemp%unit, FMT='(1P,5(E18.10E3,1X))') temp(kt), dpt(kt), hcap(kt), uint(kt), dpu(kt)
            ENDDO
         ENDIF
+        !$OMP END ORDERED
 
         IF ((INDEX(t_opt(i),'CHRG')>0) .OR. (INDEX(t_opt(i),'SPIN')>0)) THEN 
            DEALLOCATE(zb,fz)
@@ -249,6 +258,7 @@ SUBROUTINE COMPUTE
         ENDIF
 
      ENDDO    ! end of size loop (j)
+     !$OMP END PARALLEL DO
 
      xx(1:ns_i) = si_ava_l(i,1:ns_i)
      DO kt=1,n_qabs
@@ -258,6 +268,14 @@ SUBROUTINE COMPUTE
        nuinuem(i,kt) = XINTEG2 (1, ns_i, ns_i, xx(1:ns_i), yy(1:ns_i))
      ENDDO
 
+     ! keep the size integrand (without the size distribution) for the batch driver
+     IF (ALLOCATED(sizesed)) THEN
+        DO kt=1,n_qabs
+           sizesed(i,1:ns_i,kt) = ( nuflux(1:ns_i,kt)/ size_ava(i,1:ns_i)**3 ) &
+                                * (enerabs(1:ns_i) / enerem(1:ns_i)) * f_mix(i,1:ns_i)
+        ENDDO
+     ENDIF
+
      ! get SED in erg/s/H (4*pi*nu*inu/NH)
      nuinuem(i,:) = nuinuem(i,:) * mprop(i) * xmp / masstot(i)
      nuinuemtot = nuinuemtot + nuinuem(i,:)
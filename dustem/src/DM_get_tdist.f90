@@ -7,6 +7,7 @@ MODULE MGET_TDIST
   REAL (KIND=dp), PUBLIC, ALLOCATABLE  :: u_cal(:), lu_cal(:)
   REAL (KIND=dp), PUBLIC, ALLOCATABLE  :: cal(:), lcal(:)
   REAL (KIND=dp), PUBLIC, ALLOCATABLE  :: t_cal(:)
+!$OMP THREADPRIVATE(u_cal, lu_cal, cal, lcal, t_cal)
 
   PRIVATE
   PUBLIC :: GET_TDIST
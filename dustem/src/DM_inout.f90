@@ -64,6 +64,7 @@ SUBROUTINE READ_DATA(fgrain)
   REAL (KIND=dp), ALLOCATABLE :: lambisrf(:)      ! wavelengths in microns for radiation field
   REAL (KIND=dp), ALLOCATABLE :: isrf(:)          ! radiation field
   INTEGER                     :: flag_cut
+  INTEGER                     :: env_status       ! status of DUSTEM_DATA_PATH lookup
   REAL (KIND=dp), ALLOCATABLE :: tmp1(:),tmp2(:), tmp3(:), tmp4(:), tmp5(:)
  
   !=====================================================
@@ -72,6 +73,7 @@ SUBROUTINE READ_DATA(fgrain)
   n_pdr_o = 0
   n_quiet = 0
   n_res_a = 0
+  n_binary = 0
   
   ! init type counters
   n_chrg = 0 
@@ -83,7 +85,10 @@ SUBROUTINE READ_DATA(fgrain)
 
   ! reading GRAIN.DAT, set up size dist and run parameters
   !-----------------------------------------------------------------
-!  CALL GETENVIRONMENT("DUSTEM_DATA_PATH",data_path) ! for paths set up in your bash
+  ! DUSTEM_DATA_PATH overrides the compiled-in data_path, so that several runs
+  ! can each use a private directory (own data/GRAIN.DAT and out/)
+  CALL GET_ENVIRONMENT_VARIABLE ("DUSTEM_DATA_PATH", c_tmp, STATUS=env_status)
+  IF ((env_status == 0) .AND. (LEN_TRIM(c_tmp) > 0)) data_path = TRIM(c_tmp)
   filename_tmp = TRIMCAT (data_path, dir_dat)
   filename_tmp = TRIMCAT (filename_tmp, fgrain%nom)
   OPEN (UNIT = fgrain%unit, FILE = filename_tmp, STATUS = 'old')
@@ -92,6 +97,7 @@ SUBROUTINE READ_DATA(fgrain)
 
   ! get global keywords (type insensitive)
   n_res_a = INDEX (the_char, 'RES_A')
+  n_binary = INDEX (the_char, 'BINARY')
   n_ftemp = INDEX (the_char, 'TEMP')
   n_quiet = INDEX (the_char, 'QUIET')
   n_pdr_o = INDEX (the_char, 'PDR')
@@ -1165,20 +1171,30 @@ SUBROUTINE WRITE_DATA(fsed)
 
   filename_tmp = TRIMCAT(data_path,dir_res)
   filename_tmp = TRIMCAT(filename_tmp,fsed%nom)
-  OPEN  (UNIT=fsed%unit, FILE=filename_tmp, STATUS='unknown')
-  WRITE (UNIT=fsed%unit, FMT='(A40)')            '# DUSTEM SED:  4*pi*nu*I_nu/NH (erg/s/H)'
-  WRITE (UNIT=fsed%unit, FMT='(A1)')             '#'
-  WRITE (UNIT=fsed%unit, FMT='(A14)')            '# Grain types '
-  WRITE (UNIT=fsed%unit, FMT='(A34)')            '# nr of grain types   nr of lambda'
-  WRITE (UNIT=fsed%unit, FMT='(A52)')            '# lambda (microns)   SED(1)...SED(ntype)   SED total'
-  WRITE (UNIT=fsed%unit, FMT='(A1)')             '#'
-  WRITE (UNIT=fsed%unit, FMT='(A2,10(A,X))')     '# ', (trim(gtype(i)), i=1,ntype)
-  WRITE (UNIT=fsed%unit, FMT='(I2,2x,I4)')       ntype, n_qabs
-  DO k=1,n_qabs
-     WRITE (UNIT=fsed%unit, FMT='(1P,25E16.6E3)') lamb_qabs(k)*1.0e4_dp, (nuinuem(i,k), i= 1,ntype), &
-                                                      nuinuemtot(k)
-  ENDDO
-  CLOSE (UNIT=fsed%unit)
+  IF (n_binary > 0) THEN
+     ! BINARY keyword: raw SED at full precision, no formatting. Header is the
+     ! tag 'DUSTEMSB' then ntype and n_qabs (4 byte integers), followed by
+     ! lambda (microns) and SED(1)...SED(ntype) as blocks of n_qabs reals
+     OPEN  (UNIT=fsed%unit, FILE=filename_tmp, STATUS='replace', ACCESS='stream', FORM='unformatted')
+     WRITE (UNIT=fsed%unit) 'DUSTEMSB', INT(ntype,4), INT(n_qabs,4), lamb_qabs(:)*1.0e4_dp, &
+                            ((nuinuem(i,k), k=1,n_qabs), i=1,ntype)
+     CLOSE (UNIT=fsed%unit)
+  ELSE
+     OPEN  (UNIT=fsed%unit, FILE=filename_tmp, STATUS='unknown')
+     WRITE (UNIT=fsed%unit, FMT='(A40)')            '# DUSTEM SED:  4*pi*nu*I_nu/NH (erg/s/H)'
+     WRITE (UNIT=fsed%unit, FMT='(A1)')             '#'
+     WRITE (UNIT=fsed%unit, FMT='(A14)')            '# Grain types '
+     WRITE (UNIT=fsed%unit, FMT='(A34)')            '# nr of grain types   nr of lambda'
+     WRITE (UNIT=fsed%unit, FMT='(A52)')            '# lambda (microns)   SED(1)...SED(ntype)   SED total'
+     WRITE (UNIT=fsed%unit, FMT='(A1)')             '#'
+     WRITE (UNIT=fsed%unit, FMT='(A2,10(A,X))')     '# ', (trim(gtype(i)), i=1,ntype)
+     WRITE (UNIT=fsed%unit, FMT='(I2,2x,I4)')       ntype, n_qabs
+     DO k=1,n_qabs
+        WRITE (UNIT=fsed%unit, FMT='(1P,25E16.6E3)') lamb_qabs(k)*1.0e4_dp, (nuinuem(i,k), i= 1,ntype), &
+                                                         nuinuemtot(k)
+     ENDDO
+     CLOSE (UNIT=fsed%unit)
+  ENDIF
 
 ! get and write extinction
   DO i=1,ntype
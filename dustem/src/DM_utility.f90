@@ -32,6 +32,7 @@ MODULE UTILITY
   INTEGER, PUBLIC                            :: n_fsize          ! to use SIZE_*.DAT files
   INTEGER, PUBLIC                            :: n_quiet          ! verbose off
   INTEGER, PUBLIC                            :: n_res_a          ! for size resolved SED output
+  INTEGER, PUBLIC                            :: n_binary         ! for SED output as raw binary
   INTEGER, PUBLIC                            :: n_sdist          ! for size distribution output
   INTEGER, PUBLIC                            :: n_zdist          ! for charge distribution output
   INTEGER, PUBLIC                            :: n_pdr_o          ! Write specific outputs for Meudon PDR code
@@ -173,6 +174,7 @@ MODULE UTILITY
   REAL (KIND=dp), PUBLIC, ALLOCATABLE        :: spnuinuemtot(:)  ! total emitted spinning spectrum (erg/s/H)
   REAL (KIND=dp), PUBLIC, ALLOCATABLE        :: nuinuemp(:,:)    ! polarized emitted spectrum nu*Inu per type 
   REAL (KIND=dp), PUBLIC, ALLOCATABLE        :: nuinuemptot(:)   ! total polarized emitted spectrum (erg/s/H)
+  REAL (KIND=dp), PUBLIC, ALLOCATABLE        :: sizesed(:,:,:)   ! size integrand of nuinuem without ava, array(ntype,nsize_max,n_qabs), kept by COMPUTE if allocated (batch driver)
 
 ! for charge distribution
   INTEGER, PUBLIC                     :: nzb                      ! nr of charge bins for zb and fz
@@ -183,6 +185,10 @@ MODULE UTILITY
   REAL (KIND=dp), PUBLIC, ALLOCATABLE :: jpe(:), hpe(:), hspe(:)  ! PE rate, heating and G coeff for spin as a function of size
   REAL (KIND=dp), PUBLIC, ALLOCATABLE :: jgas(:), cgas(:)         ! gas rate and cooling (electrons + ions) as a function of size
 
+! work variables set for one grain size at a time: each thread needs its own
+! copy when the size loop in COMPUTE runs in parallel (make omp)
+!$OMP THREADPRIVATE(nit, fdist, qauv, qaem, nzb, zmin, zmax, zeq, zb, fz)
+
   PRIVATE
 
   INTERFACE arth
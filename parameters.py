@@ -23,6 +23,28 @@ method = 'ascfree' #Options are default, abundfree and ascfree
 components = 2 #Number of dust components to fit
 overwrite_samples = False #Rerun the MCMC if a samples file already exists
 
+###Sampler Parameters###
+
+optimise = False #Start the walkers from the maximum a posteriori point, found
+                 #by a grid scan and local optimiser, to cut down burn-in
+
+marginalise = False #Only sample alpha_sCM20 and the ISRF strengths, solving for
+                    #(and marginalising over) the linear amplitudes analytically
+
+interpolate = False #Interpolate between model grid points rather than rounding to the
+                    #nearest, so a coarser grid can be used
+grid_dir = 'models' #Model grid to use (e.g. models_coarse from dev/grid_interpolation.py, or
+                    #models_compressed from dev/dustem_compressgrid.py)
+prune = False #Only keep the model wavelengths needed for the filters in filters.csv
+
+adaptive = False #Run until converged (using the autocorrelation time), rather
+                 #than a fixed number of steps
+tau_factor = 50 #In adaptive mode, stop once the chain is this many autocorrelation
+                #times long
+max_steps = 10000 #In adaptive mode, maximum number of steps to run
+checkpoint = 50 #Write the chain to disk every this many steps, so an interrupted
+                #run resumes from the last checkpoint
+
 ###Output Parameters###
 
 plot_sed = False #Produce SED and corner plots
@@ -37,8 +59,21 @@ dustem_output = False #Produce a DustEM code snippet
 
 overwrite_plots = True #Overwrite any already created plots
 
-###MPI Settings###
+import_profile = False #Report how long startup took, and which heavy modules
+                       #were loaded
+
+###Parallel Settings###
+
+chunks = 4 #Split each galaxy's walkers into this many blocks every step. Any
+           #idle worker picks these up, so slow galaxies get help from the rest
+
+threads = 0 #BLAS/OpenMP threads per worker. 0 shares each node's cores out
+            #between the workers on it
+
+max_memory = 0 #Memory (GB) the workers on each node can use between them. The
+               #fitter measures what each worker needs and runs as many as fit.
+               #0 uses whatever is free
 
 mpi = True #Run w/MPI or not
-mpi_processes = 5 #If running MPI, use this many processes
-                  #(should be number of cores/4)
+mpi_processes = 5 #If running MPI, use this many processes. One schedules and
+                  #the rest are workers, so this should be number of cores+1
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Shared set-up for the THEMCMC tests
+
+@author: Tom Williams
+
+v1.00.
+"""
+
+#Ensure python3 compatibility
+from __future__ import absolute_import, print_function, division
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+#The fitter's modules live in core/ and import each other by name
+
+core_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'core')
+
+if core_dir not in sys.path:
+    sys.path.insert(0,core_dir)
+
+import general
+import sampler_themcmc
+
+def make_model_grid():
+    
+    #A small synthetic grid in the same layout as general.read_model_grid
+    #gives: smooth, positive SEDs per unit hydrogen (~1e-21), varying with
+    #alpha_sCM20 and logU
+    
+    alpha = np.arange(2,7.01,0.5)
+    isrf = np.arange(-2,7.01,0.5)
+    wavelength = np.logspace(0,3,300)
+    
+    model_grid = {'alpha':alpha,
+                  'logU':isrf,
+                  'wavelength':wavelength}
+    
+    alpha_mesh,isrf_mesh,wavelength_mesh = np.meshgrid(alpha,
+                                                       isrf,
+                                                       wavelength,
+                                                       indexing='ij')
+    
+    for i,grain_type in enumerate(general.grain_types):
+        
+        peak = 150/(1+i)/10**(isrf_mesh/6)
+        
+        model_grid[grain_type] = 1e-21*(1+0.1*i*alpha_mesh)*10**(isrf_mesh/4)*\
+                                 (wavelength_mesh/peak)**-2*np.exp(-peak/wavelength_mesh)*(1+i)
+    
+    return model_grid
+
+def make_filters(centres):
+    
+    #Triangular filters, unevenly sampled, in the same form as
+    #general.read_filters
+    
+    filter_dict = {}
+    keys = []
+    
+    for centre in centres:
+        
+        key = 'test_'+str(centre)
+        
+        filter_wavelength = np.sort(centre*(1+0.3*(np.random.RandomState(int(centre)).uniform(-1,1,40))))
+        transmission = 1-np.abs(filter_wavelength/centre-1)/0.3
+        
+        filter_dict[key] = filter_wavelength,transmission
+        keys.append(key)
+    
+    return filter_dict,keys
+
+@pytest.fixture
+def synthetic_galaxy():
+    
+    #Load a synthetic grid, filters and galaxy into the sampler module, the
+    #way set_band_fluxes and load_galaxy_state would. Returns the pieces so
+    #tests can build their own galaxy_state
+    
+    model_grid = make_model_grid()
+    filter_dict,keys = make_filters([3.6,8,12,24,70,100,160,250,350,500])
+    
+    z = 0.01
+    
+    response = general.filter_response(model_grid['wavelength']*(1+z),
+                                       filter_dict,
+                                       keys)
+    
+    sampler_themcmc.model_grid = model_grid
+    sampler_themcmc.response = response
+    sampler_themcmc.band_fluxes = general.band_flux_grid(response,
+                                                         model_grid)
+    sampler_themcmc.alpha_axis = model_grid['alpha']
+    sampler_themcmc.isrf_axis = model_grid['logU']
+    sampler_themcmc.band_flux_key = (z,tuple(keys))
+    
+    #Stars: a steeply falling spectrum, so they only matter at short
+    #wavelengths
+    
+    stars_flux = response.dot(100*model_grid['wavelength']**-2)
+    
+    return {'model_grid':model_grid,
+            'filter_dict':filter_dict,
+            'keys':keys,
+            'z':z,
+            'response':response,
+            'stars_flux':stars_flux}
+
+def galaxy_state(galaxy,
+                 method,
+                 components,
+                 obs_flux,
+                 relative_error=0.05,
+                 interpolate=False):
+    
+    #Diagonal covariance from a fractional error on each band
+    
+    covariance = np.diag((relative_error*obs_flux)**2)
+    
+    return {'method':method,
+            'components':components,
+            'obs_flux':obs_flux,
+            'stars_flux':galaxy['stars_flux'],
+            'cov_cholesky':general.factorise_covariance(covariance),
+            'covariance':covariance,
+            'z':galaxy['z'],
+            'keys':galaxy['keys'],
+            'interpolate':interpolate}
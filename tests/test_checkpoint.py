@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the checkpointed chain storage
+
+@author: Tom Williams
+
+v1.00.
+"""
+
+#Ensure python3 compatibility
+from __future__ import absolute_import, print_function, division
+
+import os
+
+import numpy as np
+import pandas as pd
+import emcee
+
+from checkpoint import CheckpointBackend
+
+def run_chain(filename,
+              nsteps,
+              checkpoint_interval=10):
+    
+    #A short run on a Gaussian, through the checkpointing backend
+    
+    np.random.seed(3)
+    
+    nwalkers,ndim = 8,2
+    
+    backend = CheckpointBackend(filename,
+                                checkpoint_interval=checkpoint_interval)
+    backend.load(nwalkers,ndim)
+    
+    sampler = emcee.EnsembleSampler(nwalkers,
+                                    ndim,
+                                    lambda theta: -0.5*np.sum(theta**2),
+                                    backend=backend)
+    sampler.run_mcmc(np.random.normal(size=(nwalkers,ndim)),nsteps)
+    
+    return sampler,backend
+
+def test_round_trip(tmp_path):
+    
+    #Everything flushed comes back as it was, along with whether the run
+    #was complete and had converged
+    
+    filename = str(tmp_path/'galaxy_chain.h5')
+    
+    sampler,backend = run_chain(filename,25)
+    backend.flush(complete=True,
+                  converged=True)
+    
+    reloaded = CheckpointBackend(filename)
+    reloaded.load(8,2)
+    
+    assert reloaded.iteration == 25
+    assert reloaded.complete
+    assert reloaded.converged
+    assert np.array_equal(reloaded.get_chain(),sampler.get_chain())
+    assert np.array_equal(reloaded.get_log_prob(),sampler.get_log_prob())
+    assert np.array_equal(reloaded.accepted,backend.accepted)
+
+def test_interrupted_write(tmp_path):
+    
+    #Steps appended after the last status update (a write cut off part way)
+    #are dropped on reload, from the file as well, so carrying on from there
+    #leaves a chain that reloads cleanly
+    
+    filename = str(tmp_path/'galaxy_chain.h5')
+    
+    sampler,backend = run_chain(filename,25)
+    
+    assert backend.saved_iteration == 20
+    
+    #Write out the last 5 steps, then put the status back as though the
+    #write had stopped before getting to it
+    
+    backend.flush()
+    
+    with pd.HDFStore(filename) as store:
+        store.put('status',pd.DataFrame({'iteration':[20],
+                                         'complete':[False],
+                                         'converged':[False]}))
+    
+    reloaded = CheckpointBackend(filename)
+    reloaded.load(8,2)
+    
+    assert reloaded.iteration == 20
+    assert np.array_equal(reloaded.get_chain(),sampler.get_chain()[:20])
+    assert len(pd.read_hdf(filename,'chain')) == 20*8
+    
+    resumed = emcee.EnsembleSampler(8,
+                                    2,
+                                    lambda theta: -0.5*np.sum(theta**2),
+                                    backend=reloaded)
+    resumed.run_mcmc(resumed.get_last_sample(),15)
+    reloaded.flush()
+    
+    final = CheckpointBackend(filename)
+    final.load(8,2)
+    
+    assert final.iteration == 35
+    assert np.array_equal(final.get_chain(),resumed.get_chain())
+
+def test_corrupt_file(tmp_path):
+    
+    #A file that isn't readable HDF5 is thrown away, and the run starts over
+    
+    filename = str(tmp_path/'galaxy_chain.h5')
+    
+    with open(filename,'w') as f:
+        f.write('not an HDF5 file')
+    
+    backend = CheckpointBackend(filename)
+    backend.load(8,2)
+    
+    assert backend.iteration == 0
+    assert not os.path.exists(filename)
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the model grid handling
+
+@author: Tom Williams
+
+v1.00.
+"""
+
+#Ensure python3 compatibility
+from __future__ import absolute_import, print_function, division
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import general
+from conftest import make_model_grid, make_filters
+
+def write_grid(model_grid,
+               grid_dir):
+    
+    general.subset_model_grid(model_grid,
+                              grid_dir,
+                              np.arange(len(model_grid['alpha'])),
+                              np.arange(len(model_grid['logU'])),
+                              np.arange(len(model_grid['wavelength'])))
+    
+    return general.read_model_grid(grid_dir)
+
+def test_pruned_grid_follows_source(tmp_path):
+    
+    #The pruned grid is reused while the source grid stays the same, and
+    #rewritten once the source changes
+    
+    source_dir = str(tmp_path/'models')
+    pruned_dir = os.path.join(source_dir,'pruned')
+    
+    filter_dict,keys = make_filters([24,70,160])
+    
+    def prune(model_grid):
+        
+        return general.prune_model_grid(model_grid,
+                                        pruned_dir,
+                                        filter_dict,
+                                        keys,
+                                        0,
+                                        0.1)
+    
+    model_grid = write_grid(make_model_grid(),
+                            source_dir)
+    
+    pruned = prune(model_grid)
+    header_time = os.stat(os.path.join(pruned_dir,'header.json')).st_mtime_ns
+    
+    assert len(pruned['wavelength']) < len(model_grid['wavelength'])
+    
+    prune(model_grid)
+    
+    assert os.stat(os.path.join(pruned_dir,'header.json')).st_mtime_ns == header_time
+    
+    #Same shape and axes, but new models
+    
+    changed_grid = make_model_grid()
+    changed_grid['sCM20'] *= 2
+    
+    del model_grid
+    
+    model_grid = write_grid(changed_grid,
+                            source_dir)
+    
+    #Make sure the rewrite shows up even on filesystems with coarse
+    #timestamps
+    
+    for name in general.grain_types:
+        
+        filename = os.path.join(source_dir,name+'.bin')
+        os.utime(filename,ns=(0,os.stat(filename).st_mtime_ns+10**9))
+    
+    pruned = prune(model_grid)
+    
+    assert np.allclose(pruned['sCM20'],
+                       np.array(changed_grid['sCM20'])[:,:,np.isin(changed_grid['wavelength'],pruned['wavelength'])],
+                       rtol=1e-10,
+                       atol=0)
+
+def write_model_file(model_file,
+                     model_grid,
+                     drop=None):
+    
+    #A models.h5 in the layout dustem_makegrid writes: one column per model,
+    #named by its alpha_sCM20 and logU
+    
+    pd.DataFrame({'wavelength':model_grid['wavelength']}).to_hdf(model_file,key='wavelength',mode='w')
+    
+    for grain_type in general.grain_types:
+        
+        columns = {}
+        
+        for i,alpha in enumerate(model_grid['alpha']):
+            for j,isrf in enumerate(model_grid['logU']):
+                columns['alpha_sCM20:%.2f,logU:%.2f' % (alpha,isrf)] = model_grid[grain_type][i,j]
+        
+        if drop is not None:
+            del columns[drop]
+        
+        pd.DataFrame(columns).to_hdf(model_file,key=grain_type)
+
+def test_convert_model_grid(tmp_path):
+    
+    #A complete grid converts exactly, and an incomplete one is refused
+    #rather than written out with holes in it
+    
+    model_grid = make_model_grid()
+    model_file = str(tmp_path/'models.h5')
+    
+    write_model_file(model_file,
+                     model_grid)
+    
+    general.convert_model_grid(model_file,
+                               str(tmp_path/'models'))
+    
+    converted = general.read_model_grid(str(tmp_path/'models'))
+    
+    for name in ['alpha','logU','wavelength']+general.grain_types:
+        assert np.array_equal(converted[name],model_grid[name])
+    
+    write_model_file(model_file,
+                     model_grid,
+                     drop='alpha_sCM20:4.00,logU:1.00')
+    
+    with pytest.raises(Exception,match='models'):
+        general.convert_model_grid(model_file,
+                                   str(tmp_path/'incomplete'))
+    
+    #Uneven logU spacing
+    
+    uneven_grid = dict(model_grid)
+    uneven_grid['logU'] = np.append(model_grid['logU'][:-1],7.2)
+    
+    write_model_file(model_file,
+                     uneven_grid)
+    
+    with pytest.raises(Exception,match='evenly spaced'):
+        general.convert_model_grid(model_file,
+                                   str(tmp_path/'uneven'))
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the filter convolution and the likelihood
+
+@author: Tom Williams
+
+v1.00.
+"""
+
+#Ensure python3 compatibility
+from __future__ import absolute_import, print_function, division
+
+import numpy as np
+import pytest
+from scipy.integrate import trapezoid
+
+import general
+import sampler_themcmc
+from conftest import make_model_grid, make_filters
+
+def filter_convolve(flux,
+                    wavelength,
+                    filter_dict,
+                    keys):
+    
+    #The original convolution: interpolate the SED onto each filter's
+    #wavelengths and integrate, normalised by the filter's area
+    
+    return np.array([np.abs(trapezoid(filter_dict[key][1]*np.interp(filter_dict[key][0],
+                                                                     wavelength,
+                                                                     flux),
+                                      filter_dict[key][0])/
+                            trapezoid(filter_dict[key][1],filter_dict[key][0])) for key in keys])
+
+def test_filter_response_matches_interp():
+    
+    #The response matrix gives the same band fluxes as interpolating and
+    #integrating directly, including for a filter running off the red end
+    #of the SED (where np.interp takes the edge value)
+    
+    rs = np.random.RandomState(0)
+    
+    wavelength = make_model_grid()['wavelength']*1.05
+    filter_dict,keys = make_filters([3.6,24,250,900])
+    
+    response = general.filter_response(wavelength,
+                                       filter_dict,
+                                       keys)
+    
+    for flux in [wavelength**-2,rs.uniform(0,1,len(wavelength))]:
+        
+        assert np.allclose(response.dot(flux),
+                           filter_convolve(flux,
+                                           wavelength,
+                                           filter_dict,
+                                           keys),
+                           rtol=1e-12,
+                           atol=0)
+
+#Where each component's parameters start, and how many there are
+
+layout = {'default':(1,2),
+          'abundfree':(1,5),
+          'ascfree':(2,5)}
+
+class SerialPool(object):
+    
+    #Runs the blocks of walkers one after another, in this process
+    
+    def starmap(self,
+                func,
+                iterable):
+        
+        return [func(*args) for args in iterable]
+
+def random_thetas(rs,
+                  method,
+                  components,
+                  nwalkers):
+    
+    #Walkers spread over the prior, in the parameter order the sampler uses
+    
+    columns = [rs.uniform(0.5,2,nwalkers)]
+    
+    if method == 'ascfree':
+        columns.append(rs.uniform(2,7,nwalkers))
+    
+    isrf = np.sort(rs.uniform(-2,7,(nwalkers,components)),axis=1)
+    
+    for component in range(components):
+        
+        columns.append(isrf[:,component])
+        
+        if method != 'default':
+            columns.extend(rs.uniform(0.5,1.5,(3,nwalkers)))
+        
+        columns.append(1e21*rs.uniform(0.2,2,nwalkers))
+    
+    return np.column_stack(columns)
+
+def baseline_lnprob(theta,
+                    method,
+                    components,
+                    galaxy,
+                    stars,
+                    obs_flux,
+                    covariance):
+    
+    #The original per-walker likelihood: build the full SED at the nearest
+    #grid point, add the stars, convolve with the filters, and take
+    #chi^2 = r C^-1 r
+    
+    model_grid = galaxy['model_grid']
+    
+    offset,n_per_component = layout[method]
+    
+    alpha = 5.0
+    
+    if method == 'ascfree':
+        alpha = theta[1]
+    
+    i = np.argmin(np.abs(model_grid['alpha']-alpha))
+    
+    total = theta[0]*stars
+    
+    for component in range(components):
+        
+        parameters = theta[offset+n_per_component*component:offset+n_per_component*(component+1)]
+        
+        isrf = parameters[0]
+        dust_scaling = parameters[-1]
+        abundances = parameters[1:4] if method != 'default' else np.ones(3)
+        
+        j = np.argmin(np.abs(model_grid['logU']-isrf))
+        
+        for abundance,grain_type in zip(abundances,general.grain_types):
+            total = total+dust_scaling*abundance*model_grid[grain_type][i,j]
+    
+    flux_diff = filter_convolve(total,
+                                model_grid['wavelength']*(1+galaxy['z']),
+                                galaxy['filter_dict'],
+                                galaxy['keys'])-obs_flux
+    
+    return -0.5*flux_diff.dot(np.linalg.solve(covariance,flux_diff))
+
+@pytest.mark.parametrize('method',['default','abundfree','ascfree'])
+@pytest.mark.parametrize('components',[1,2])
+def test_lnprob_matches_baseline(synthetic_galaxy,
+                                 method,
+                                 components):
+    
+    #The vectorised likelihood (all walkers at once, from the band flux
+    #cube, split into blocks as the sampler does) against evaluating each
+    #walker on its own, and against the original formula
+    
+    rs = np.random.RandomState(2)
+    
+    model_grid = synthetic_galaxy['model_grid']
+    stars = 100*model_grid['wavelength']**-2
+    
+    thetas = random_thetas(rs,
+                           method,
+                           components,
+                           50)
+    
+    #A few walkers outside the prior: negative omega_star, negative dust
+    #scaling and, with two components, ISRF strengths the wrong way round
+    
+    offset,n_per_component = layout[method]
+    
+    thetas[0,0] = -1
+    thetas[1,-1] = -1e21
+    
+    if components > 1:
+        thetas[2,offset+n_per_component] = thetas[2,offset]-1
+    
+    n_outside = 1+components
+    
+    obs_flux = synthetic_galaxy['stars_flux']+1e21*np.sum(sampler_themcmc.band_fluxes[6,12],axis=0)
+    
+    #Correlated errors, so the full covariance matters
+    
+    errors = 0.1*obs_flux
+    covariance = np.diag(errors**2)+0.3*np.outer(0.5*errors,0.5*errors)
+    
+    galaxy_state = {'method':method,
+                    'components':components,
+                    'obs_flux':obs_flux,
+                    'stars_flux':synthetic_galaxy['stars_flux'],
+                    'cov_cholesky':general.factorise_covariance(covariance),
+                    'z':synthetic_galaxy['z'],
+                    'keys':synthetic_galaxy['keys']}
+    
+    vectorised = sampler_themcmc.lnprob_chunked(thetas,
+                                                galaxy_state,
+                                                pool=SerialPool(),
+                                                chunks=4)
+    
+    per_walker = np.array([sampler_themcmc.lnprob(theta,
+                                                  method,
+                                                  components,
+                                                  obs_flux,
+                                                  synthetic_galaxy['stars_flux']) for theta in thetas])
+    
+    assert np.all(vectorised[:n_outside] == -np.inf)
+    assert np.all(np.isfinite(vectorised[n_outside:]))
+    assert np.array_equal(vectorised == -np.inf,per_walker == -np.inf)
+    assert np.allclose(vectorised[n_outside:],per_walker[n_outside:],rtol=1e-10,atol=0)
+    
+    for theta,value in zip(thetas[n_outside:],vectorised[n_outside:]):
+        
+        assert np.isclose(value,
+                          baseline_lnprob(theta,
+                                          method,
+                                          components,
+                                          synthetic_galaxy,
+                                          stars,
+                                          obs_flux,
+                                          covariance),
+                          rtol=1e-8,
+                          atol=0)
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the marginalised (reduced-dimension) sampling mode
+
+@author: Tom Williams
+
+v1.00.
+"""
+
+#Ensure python3 compatibility
+from __future__ import absolute_import, print_function, division
+
+import numpy as np
+import emcee
+import pytest
+
+import sampler_themcmc
+from conftest import galaxy_state
+
+def test_amplitude_draws_match_full_mcmc(synthetic_galaxy):
+    
+    #With the ISRF strength held fixed, the spread of the drawn omega_star
+    #and dust scaling should match what sampling them directly with the
+    #full likelihood gives, even though they differ in scale by ~1e21
+    
+    np.random.seed(42)
+    
+    log_u = 2.5
+    truth = np.array([1.0,log_u,1e21])
+    
+    sampler_themcmc.load_galaxy_state(galaxy_state(synthetic_galaxy,
+                                                   'default',
+                                                   1,
+                                                   np.ones(len(synthetic_galaxy['keys']))))
+    
+    grains = sampler_themcmc.grain_band_fluxes(5.0,log_u)
+    
+    obs_flux = truth[0]*synthetic_galaxy['stars_flux']+truth[2]*np.sum(grains,axis=0)
+    
+    state = galaxy_state(synthetic_galaxy,
+                         'default',
+                         1,
+                         obs_flux,
+                         relative_error=0.1)
+    
+    #Marginal draws
+    
+    thetas = sampler_themcmc.draw_amplitudes(np.full((4000,1),log_u),
+                                             state)
+    
+    #Full MCMC over the linear amplitudes, with the dust scaling in units
+    #of 1e21 so the sampler is well-conditioned
+    
+    sampler_themcmc.load_galaxy_state(state)
+    
+    def lnprob_amplitudes(amplitudes):
+        
+        theta = np.column_stack([amplitudes[:,0],
+                                 np.full(len(amplitudes),log_u),
+                                 amplitudes[:,1]*1e21])
+        
+        return sampler_themcmc.lnprob(theta,
+                                      'default',
+                                      1,
+                                      obs_flux,
+                                      synthetic_galaxy['stars_flux'])
+    
+    nwalkers = 32
+    
+    pos = np.array([1.0,1.0])*(1+1e-3*np.random.normal(size=(nwalkers,2)))
+    
+    sampler = emcee.EnsembleSampler(nwalkers,
+                                    2,
+                                    lnprob_amplitudes,
+                                    vectorize=True)
+    sampler.run_mcmc(pos,4000)
+    
+    chain = sampler.get_chain(discard=1000,flat=True)
+    
+    assert np.std(thetas[:,0]) > 0
+    assert np.std(thetas[:,2]) > 0
+    
+    assert np.isclose(np.mean(thetas[:,0]),np.mean(chain[:,0]),rtol=0.05)
+    assert np.isclose(np.mean(thetas[:,2]),1e21*np.mean(chain[:,1]),rtol=0.05)
+    assert np.isclose(np.std(thetas[:,0]),np.std(chain[:,0]),rtol=0.15)
+    assert np.isclose(np.std(thetas[:,2]),1e21*np.std(chain[:,1]),rtol=0.15)
+
+@pytest.mark.parametrize('method,components',[('ascfree',1),
+                                               ('default',2)])
+def test_solve_amplitudes_matches_per_walker(synthetic_galaxy,
+                                             method,
+                                             components):
+    
+    #The vectorised solve (one gather from the band flux cube, batched
+    #non-negative least squares) against doing each walker on its own with
+    #scipy's nnls
+    
+    from scipy.linalg import solve_triangular
+    from scipy.optimize import nnls
+    
+    rs = np.random.RandomState(1)
+    
+    sampler_themcmc.load_galaxy_state(galaxy_state(synthetic_galaxy,
+                                                   method,
+                                                   components,
+                                                   np.ones(len(synthetic_galaxy['keys']))))
+    
+    grains = sampler_themcmc.grain_band_fluxes(4.0,1.0)+0.3*sampler_themcmc.grain_band_fluxes(4.0,4.0)
+    
+    obs_flux = synthetic_galaxy['stars_flux']+1e21*np.sum(grains,axis=0)
+    obs_flux *= 1+0.05*rs.normal(size=len(obs_flux))
+    
+    state = galaxy_state(synthetic_galaxy,
+                         method,
+                         components,
+                         obs_flux)
+    
+    sampler_themcmc.load_galaxy_state(state)
+    
+    phis = np.sort(rs.uniform(-2,7,(200,components)),axis=1)
+    
+    if method == 'ascfree':
+        phis = np.column_stack([rs.uniform(2,7,200),phis])
+    
+    alpha,isrf = sampler_themcmc.unpack_phi(phis,
+                                            method)
+    
+    amplitudes,_,fisher,scale,chisq = sampler_themcmc.solve_amplitudes(phis,
+                                                                       method,
+                                                                       components,
+                                                                       obs_flux,
+                                                                       state['stars_flux'])
+    
+    lnprob = sampler_themcmc.lnprob_marginal(phis,
+                                             method,
+                                             components,
+                                             obs_flux,
+                                             state['stars_flux'])
+    
+    whitened_flux = solve_triangular(state['cov_cholesky'],obs_flux,lower=True)
+    
+    #Walkers with both components on the same grid point have identical
+    #columns, and are ruled out
+    
+    grid_points = sampler_themcmc.general.grid_index(isrf,sampler_themcmc.isrf_axis)
+    same_point = np.any(np.diff(grid_points,axis=0) == 0,axis=0)
+    
+    if components > 1:
+        assert np.any(same_point)
+    
+    assert np.all(lnprob[same_point] == -np.inf)
+    assert np.all(np.isfinite(lnprob[~same_point]))
+    
+    n_constrained = 0
+    
+    for i in range(len(phis)):
+        
+        if same_point[i]:
+            continue
+        
+        design = solve_triangular(state['cov_cholesky'],
+                                  sampler_themcmc.linear_design(alpha[i],
+                                                                isrf[:,i],
+                                                                method,
+                                                                state['stars_flux']),
+                                  lower=True)
+        
+        #Both solvers need the columns on a common scale, or the ~1e21
+        #difference between the stellar and dust columns looks like a
+        #rank deficiency
+        
+        column_norm = np.linalg.norm(design,axis=0)
+        
+        expected = np.linalg.lstsq(design/column_norm,whitened_flux,rcond=None)[0]/column_norm
+        
+        if np.any(expected < 0):
+            
+            n_constrained += 1
+            expected = nnls(design/column_norm,whitened_flux)[0]/column_norm
+        
+        expected_chisq = np.sum((design.dot(expected)-whitened_flux)**2)
+        expected_lnprob = -0.5*expected_chisq-0.5*np.linalg.slogdet(design.T.dot(design))[1]
+        
+        assert np.allclose(amplitudes[i],expected,rtol=1e-6,atol=1e-6*np.max(expected))
+        assert np.isclose(chisq[i],expected_chisq,rtol=1e-8)
+        assert np.isclose(lnprob[i],expected_lnprob,rtol=1e-8)
+    
+    #Make sure the non-negative fallback actually got exercised
+    
+    assert n_constrained > 0
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the galaxy and walker scheduler
+
+@author: Tom Williams
+
+v1.00.
+"""
+
+#Ensure python3 compatibility
+from __future__ import absolute_import, print_function, division
+
+import os
+import time
+
+import multiprocessing
+
+import numpy as np
+import pytest
+
+import scheduler
+
+def slow_square(task,
+                i):
+    
+    #Later blocks finish first, so the results come back out of order
+    
+    time.sleep(0.002*(12-i))
+    
+    return (task,i**2)
+
+def run_task(task,
+             pool):
+    
+    #Stand-in for master_themcmc.main: a few steps of a "sampler", each
+    #sending its walkers out in blocks. Saves what came back, since tasks
+    #don't return anything to the master
+    
+    out_dir,task_id = task
+    
+    steps = []
+    
+    for step in range(3):
+        
+        steps.append(pool.starmap(slow_square,
+                                  [(task_id,i) for i in range(12)]))
+    
+    np.save(os.path.join(out_dir,str(task_id)+'.npy'),
+            np.array(steps))
+
+@pytest.mark.parametrize('start_method',['fork','spawn','forkserver'])
+def test_results_come_back_in_order(tmp_path,
+                                    start_method):
+    
+    #Blocks are evaluated by whichever worker is free, but each galaxy
+    #should get its results back in the order it sent them out. The workers
+    #are forked whatever the default start method is (the lambda couldn't
+    #be sent to a spawned one)
+    
+    tasks = [(str(tmp_path),task_id) for task_id in range(5)]
+    
+    default_method = multiprocessing.get_start_method(allow_none=True)
+    multiprocessing.set_start_method(start_method,
+                                     force=True)
+    
+    try:
+        
+        scheduler.run_tasks(tasks,
+                            run_task,
+                            scheduler.LocalBackend(3,
+                                                   n_threads=1),
+                            affinity=lambda task,i: task)
+    
+    finally:
+        multiprocessing.set_start_method(default_method,
+                                         force=True)
+    
+    for task_id in range(5):
+        
+        steps = np.load(os.path.join(str(tmp_path),str(task_id)+'.npy'))
+        
+        expected = [(task_id,i**2) for i in range(12)]
+        
+        assert steps.shape == (3,12,2)
+        assert np.all(steps == np.array(expected))
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the THEMCMC fit service
+
+@author: Tom Williams
+
+v1.00.
+"""
+
+#Ensure python3 compatibility
+from __future__ import absolute_import, print_function, division
+
+import os
+import socket
+import sys
+import threading
+from multiprocessing.connection import Listener
+
+import pytest
+
+#The package lives at the top of the THEMCMC directory
+
+package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if package_dir not in sys.path:
+    sys.path.insert(0,package_dir)
+
+from themcmc_api import service
+
+def test_service_survives_bad_clients(tmp_path):
+    
+    #Clients that drop the connection, have the wrong key, or send a job the
+    #service doesn't know leave it running for the next one
+    
+    key_file = str(tmp_path/'service.key')
+    
+    listener = Listener(('localhost',0),
+                        authkey=service.write_authkey(key_file))
+    
+    wrong_key_file = str(tmp_path/'wrong.key')
+    
+    with open(wrong_key_file,'wb') as f:
+        f.write(b'wrong key')
+    
+    thread = threading.Thread(target=service.run_jobs,
+                              args=(listener,))
+    thread.daemon = True
+    thread.start()
+    
+    try:
+        
+        dropped = socket.create_connection(listener.address)
+        dropped.close()
+        
+        thread.join(0.5)
+        assert thread.is_alive()
+        
+        with pytest.raises(Exception):
+            service.FitClient(listener.address,wrong_key_file).submit('row',{})
+        
+        thread.join(0.5)
+        assert thread.is_alive()
+        
+        with pytest.raises(Exception,match='Unknown job kind'):
+            service.FitClient(listener.address,key_file).submit('spectrum',{})
+        
+        assert service.FitClient(listener.address,key_file).shutdown() is None
+    
+    finally:
+        
+        thread.join(10)
+        listener.close()
+    
+    assert not thread.is_alive()
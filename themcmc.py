@@ -9,6 +9,7 @@ Setup and run THEMCMC
 from __future__ import absolute_import, print_function, division
 
 import os
+import sys
 
 import pandas as pd
 
@@ -80,6 +81,50 @@ command += '--components '+str(components)+' '
 if overwrite_samples:
     
     command += '--overwritesamples '
+    
+#Optimiser-based initialisation
+    
+if optimise:
+    
+    command += '--optimise '
+    
+#Marginalising over the linear amplitudes
+    
+if marginalise:
+    
+    command += '--marginalise '
+    
+#Interpolating the model grid
+    
+if interpolate:
+    
+    command += '--interpolate '
+    
+command += '--griddir '+grid_dir+' '
+    
+if prune:
+    
+    command += '--prune '
+    
+#Adaptive stopping
+    
+if adaptive:
+    
+    command += '--adaptive --taufactor '+str(tau_factor)+' --maxsteps '+str(max_steps)+' '
+    
+command += '--checkpoint '+str(checkpoint)+' '
+
+#Blocks of walkers per galaxy
+
+command += '--chunks '+str(chunks)+' '
+
+#BLAS/OpenMP threads per worker
+
+command += '--threads '+str(threads)+' '
+
+#Memory ceiling per node
+
+command += '--maxmemory '+str(max_memory)+' '
 
 #Specify MPI so we know what kind of pool to use
 
@@ -113,6 +158,10 @@ if skirt_output:
     
     command += '--skirtoutput '
     
+if import_profile:
+    
+    command += '--importprofile '
+    
 command += '--fluxes '+fluxes+' '
 
 os.chdir('core')
@@ -121,5 +170,17 @@ os.chdir('core')
 
 if not os.path.exists('fortran_funcs.so'):
     os.system('make all')
+    
+#Convert the model grid into the memory-mapped format if it hasn't
+#already been
+    
+if not os.path.exists('models/header.json'):
+    
+    sys.path.append(os.getcwd())
+    import general
+    
+    print('Converting model grid')
+    
+    general.convert_model_grid('models.h5','models')
 
 os.system(command)
\ No newline at end of file
@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+"""
+THEMCMC, as a Python package
+
+@author: Tom Williams
+
+v1.00.
+"""
+
+#Ensure python3 compatibility
+from __future__ import absolute_import, print_function, division
+
+from themcmc_api.api import fit_catalogue, fit_row
+from themcmc_api.service import serve, FitClient
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+"""
+Run the THEMCMC fit service (python -m themcmc_api)
+
+@author: Tom Williams
+
+v1.00.
+"""
+
+#Ensure python3 compatibility
+from __future__ import absolute_import, print_function, division
+
+import argparse
+
+from themcmc_api.service import serve, default_address, default_key_file
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                 description='THEMCMC fit service.')
+parser.add_argument('--host',type=str,default=default_address[0],metavar='',
+                    help="Address to listen on.")
+parser.add_argument('--port',type=int,default=default_address[1],metavar='',
+                    help="Port to listen on.")
+parser.add_argument('--keyfile',type=str,default=default_key_file,metavar='',
+                    help="Where to write the service's key. Clients need to be able to read it.")
+parser.add_argument('--griddir',type=str,default='models',metavar='',
+                    help="Model grid to load up front.")
+
+args = parser.parse_args()
+
+serve(address=(args.host,args.port),
+      key_file=args.keyfile,
+      grid_dir=args.griddir)
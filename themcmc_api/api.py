@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Python interface to THEMCMC
+
+@author: Tom Williams
+
+v1.00.
+"""
+
+#Ensure python3 compatibility
+from __future__ import absolute_import, print_function, division
+
+import os
+import sys
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import pandas as pd
+
+#The fitter lives in core/ and, as when it's run through themcmc.py, works
+#from there (catalogues, filters.csv and the outputs are all one level up)
+
+core_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'core')
+
+if core_dir not in sys.path:
+    sys.path.append(core_dir)
+
+@contextmanager
+def in_core():
+    
+    cwd = os.getcwd()
+    os.chdir(core_dir)
+    
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+
+def fit_catalogue(fluxes,
+                  rows=None,
+                  **options):
+    
+    #Fit the galaxies in these rows (all of them by default) of a catalogue,
+    #in parallel. fluxes is relative to the THEMCMC directory, as in
+    #parameters.py, and any of master_themcmc's settings can be given as
+    #keyword arguments, named as the flags (e.g. method='ascfree',
+    #components=2, overwritesamples=True). Returns the samples for each
+    #galaxy, by name
+    
+    import master_themcmc
+    
+    with in_core():
+        
+        master_themcmc.setup(master_themcmc.make_args(fluxes=fluxes,
+                                                      **options))
+        
+        flux_df = master_themcmc.flux_df
+        args = master_themcmc.args
+        
+        if rows is None:
+            rows = range(len(flux_df))
+        
+        rows = list(rows)
+        
+        master_themcmc.fit(rows)
+        
+        samples = OrderedDict()
+        
+        for gal_row in rows:
+            
+            gal_name = flux_df['name'][gal_row]
+            
+            samples[gal_name] = pd.read_hdf('../samples/'+gal_name+'_'+args.method+'_'+str(args.components)+'comp.h5',
+                                            'samples')
+    
+    return samples
+
+def fit_row(fluxes,
+            gal_row,
+            **options):
+    
+    #Fit a single galaxy in this process, with the same settings as
+    #fit_catalogue. Returns its samples
+    
+    import master_themcmc
+    
+    with in_core():
+        
+        master_themcmc.setup(master_themcmc.make_args(fluxes=fluxes,
+                                                      **options))
+        
+        return master_themcmc.main(gal_row)
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Long-running THEMCMC fit service
+
+@author: Tom Williams
+
+v1.00.
+"""
+
+#Ensure python3 compatibility
+from __future__ import absolute_import, print_function, division
+
+import os
+import traceback
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+
+from themcmc_api.api import fit_catalogue, fit_row, in_core
+
+#Start one with python -m themcmc_api, then send it jobs through a
+#FitClient. It keeps the imports and the model grid loaded between jobs,
+#and the workers for each job are forked from it, so they start with all
+#of that already in place rather than paying for it every time
+
+#Jobs are unpickled by the service, so only let in clients that can read
+#the key it makes when it starts (a random one each time, in a file only
+#this user can read)
+
+default_address = ('localhost',6174)
+default_key_file = os.path.join(os.path.expanduser('~'),'.themcmc','service.key')
+
+def write_authkey(key_file):
+    
+    key_dir = os.path.dirname(os.path.abspath(key_file))
+    
+    if not os.path.exists(key_dir):
+        os.makedirs(key_dir,0o700)
+    
+    authkey = os.urandom(32)
+    
+    #Tighten the permissions before writing, in case it's an old file
+    
+    fd = os.open(key_file,os.O_WRONLY | os.O_CREAT | os.O_TRUNC,0o600)
+    os.chmod(key_file,0o600)
+    
+    with os.fdopen(fd,'wb') as f:
+        f.write(authkey)
+    
+    return authkey
+
+def read_authkey(key_file):
+    
+    with open(key_file,'rb') as f:
+        return f.read()
+
+def serve(address=default_address,
+          key_file=default_key_file,
+          grid_dir='models'):
+    
+    import master_themcmc
+    
+    with in_core():
+        master_themcmc.load_grid(grid_dir)
+    
+    listener = Listener(address,
+                        authkey=write_authkey(key_file))
+    
+    print('THEMCMC service listening on '+str(listener.address)+' (key in '+key_file+')')
+    
+    try:
+        run_jobs(listener)
+    finally:
+        
+        listener.close()
+        
+        if os.path.exists(key_file):
+            os.remove(key_file)
+
+def run_jobs(listener):
+    
+    #Run jobs one at a time (each one uses the whole machine), until told
+    #to shut down. Clients without the key are turned away, and clients
+    #that drop the connection part way are just forgotten about
+    
+    running = True
+    
+    while running:
+        
+        try:
+            conn = listener.accept()
+        except (AuthenticationError,EOFError,OSError):
+            continue
+        
+        try:
+            
+            kind,job = conn.recv()
+            
+            if kind == 'shutdown':
+                
+                running = False
+                reply = ('done',None)
+            
+            else:
+                reply = run_job(kind,
+                                job)
+            
+            conn.send(reply)
+        
+        except (EOFError,OSError):
+            pass
+        
+        finally:
+            conn.close()
+
+def run_job(kind,
+            job):
+    
+    #Any failure in the fit goes back to the client, rather than stopping
+    #the service
+    
+    try:
+        
+        if kind == 'catalogue':
+            return ('done',fit_catalogue(**job))
+        elif kind == 'row':
+            return ('done',fit_row(**job))
+        else:
+            return ('error','Unknown job kind '+repr(kind))
+    
+    except Exception:
+        
+        return ('error',traceback.format_exc())
+
+class FitClient(object):
+    
+    #Sends jobs to a running service, with the same arguments as
+    #themcmc_api.fit_catalogue and themcmc_api.fit_row. The key is read for each
+    #job, so a client carries on working if the service is restarted
+    
+    def __init__(self,
+                 address=default_address,
+                 key_file=default_key_file):
+        
+        self.address = address
+        self.key_file = key_file
+    
+    def submit(self,
+               kind,
+               job):
+        
+        conn = Client(self.address,
+                      authkey=read_authkey(self.key_file))
+        
+        try:
+            
+            conn.send((kind,job))
+            kind,payload = conn.recv()
+        
+        finally:
+            conn.close()
+        
+        if kind == 'error':
+            raise Exception('Fit failed in the THEMCMC service:\n'+payload)
+        
+        return payload
+    
+    def fit_catalogue(self,
+                      fluxes,
+                      rows=None,
+                      **options):
+        
+        if rows is not None:
+            rows = list(rows)
+        
+        options.update({'fluxes':fluxes,
+                        'rows':rows})
+        
+        return self.submit('catalogue',
+                           options)
+    
+    def fit_row(self,
+                fluxes,
+                gal_row,
+                **options):
+        
+        options.update({'fluxes':fluxes,
+                        'gal_row':gal_row})
+        
+        return self.submit('row',
+                           options)
+    
+    def shutdown(self):
+        
+        return self.submit('shutdown',
+                           None)